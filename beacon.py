@@ -1,18 +1,86 @@
-"""Module which broadcasts the UDP multicast beacon."""
+"""Module which broadcasts the UDP multicast beacon.
 
+Every send is two datagrams. The first, to port 5050, is the TCP port as ASCII digits and nothing
+else, exactly as before, so existing clients that parse the whole datagram as the port keep working.
+The second, to HEADER_PORT, is the TCP port as ASCII digits, a NUL byte, and a big-endian binary header:
+    header version (1 byte)
+    servo state (1 byte), 0 idle, 1 dispensing, 2 braking
+    device ID (8 bytes)
+    schedule version (4 bytes), as reported by the v2 protocol
+    next feeding time (4 bytes), seconds since 2000-01-01, NO_FEEDING if there is none
+    last time sync (4 bytes), seconds since 2000-01-01, 0 if the time has never been synced
+Clients can keep their copy of the schedule until the schedule version changes.
+
+The packet is only rebuilt when one of the fields changes. While nothing changes the
+beacon is sent less and less often, down to once every MAX_INTERVAL_MS.
+"""
+
+from micropython import const
+import struct
 import time
-import socket
+
+HEADER_VERSION  = const(1)
+HEADER_FORMAT   = ">BB8sLLL"
+NO_FEEDING      = const(0xFFFFFFFF)
+HEADER_PORT     = const(5051)  # Kept off the port-only beacon's port, where clients read the whole datagram as the port.
+MIN_INTERVAL_MS = const(1000)  # Send interval right after a change...
+MAX_INTERVAL_MS = const(16000) # ...doubled after every unchanged send, up to this.
 
 class Beacon:
-    def __init__(self,message:str):
+    def __init__(self, port:int, device_id:bytes):
         self.group = "226.1.1.1"
         self.port = 5050
+        self.header_port = HEADER_PORT
         self.ttl = 3
-        self.message = message.encode()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    
+        self.message = str(port).encode()
+        self._header_offset = len(self.message)+1
+        self.header_message = bytearray(self.message + b"\x00" + bytes(struct.calcsize(HEADER_FORMAT)))
+        self._device_id = device_id
+        self._fields = None
+        self.interval_ms = MIN_INTERVAL_MS
+        self._last_sent = None
+        # The socket is only created once the beacon is first sent, when the network is up
+        self.sock = None
+
+    def update(self, schedule_version:int, servo_state:int, next_feeding:int, last_sync:int) -> bool:
+        """ Set the state carried by the beacon. next_feeding and last_sync are in seconds since 2000,
+            or None if unknown. Returns True if anything changed, in which case the next send is due now.
+        """
+        fields = (schedule_version, servo_state,
+                  NO_FEEDING if next_feeding is None else next_feeding,
+                  0 if last_sync is None else last_sync)
+        if fields == self._fields:
+            return False
+        self._fields = fields
+        struct.pack_into(HEADER_FORMAT, self.header_message, self._header_offset, HEADER_VERSION, servo_state,
+                         self._device_id, schedule_version & 0xFFFFFFFF, fields[2], fields[3])
+        self.interval_ms = MIN_INTERVAL_MS
+        self._last_sent = None
+        return True
+
+    def send_if_due(self) -> bool:
+        """Send the beacon if the current interval has passed since the last send. Returns True if it was sent."""
+        now = time.ticks_ms()
+        if self._last_sent is not None and time.ticks_diff(now, self._last_sent) < self.interval_ms:
+            return False
+        if self._last_sent is not None:
+            self.interval_ms = min(self.interval_ms*2, MAX_INTERVAL_MS)
+        self._last_sent = now
+        self.send()
+        return True
+
+    def ms_until_due(self) -> int:
+        """ms until the next send is due, 0 if it is due now."""
+        if self._last_sent is None:
+            return 0
+        return max(self.interval_ms - time.ticks_diff(time.ticks_ms(), self._last_sent), 0)
+
     def send(self):
         try:
+            if self.sock is None:
+                import socket
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.sock.sendto(self.message, (self.group, self.port))
+            self.sock.sendto(self.header_message, (self.group, self.header_port))
         except Exception as e:
             print(f"Beacon exception: {e}")
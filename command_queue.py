@@ -0,0 +1,65 @@
+"""Module that passes dispense commands from the network core to the controller thread.
+
+The commands are kept in a fixed-size ring with one producer and one consumer. put() only
+moves the tail and the consumer only moves the head, and each command is written before the
+tail is moved past it, so neither side ever takes a lock or allocates.
+What happens to a command that arrives while the servo is running is up to the controller,
+see the POLICY_ constants.
+"""
+
+from micropython import const
+import array
+import metrics
+
+QUEUE_SIZE = const(8) # Commands that can wait at once, more are dropped.
+
+# What to do with a dispense command while the servo is running
+POLICY_QUEUE  = const(0) # Run it after the current run.
+POLICY_EXTEND = const(1) # Add its duration to the current run.
+POLICY_DROP   = const(2) # Forget it.
+
+class CommandQueue:
+    def __init__(self, size:int=QUEUE_SIZE):
+        self.size = size
+        self._durations = array.array('L', [0]*size)
+        self._sources = bytearray(size)
+        self._head = 0
+        self._tail = 0
+        # Commands dropped because the ring was full, and the most that have waited at once
+        self.drops = 0
+        self.peak = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of commands waiting."""
+        return self._tail-self._head
+
+    def put(self, duration_ms:int, source:int) -> bool:
+        """ Add a command, from the producer only. Returns False if it was dropped because the ring is full."""
+        depth = self._tail-self._head
+        if depth >= self.size:
+            self.drops += 1
+            metrics.count(metrics.COMMAND_DROPS)
+            return False
+        index = self._tail % self.size
+        self._durations[index] = duration_ms
+        self._sources[index] = source
+        # Only now is the command visible to the consumer
+        self._tail += 1
+        if depth+1 > self.peak:
+            self.peak = depth+1
+            metrics.peak(metrics.COMMAND_QUEUE_PEAK, self.peak)
+        return True
+
+    def duration(self) -> int:
+        """Duration, in ms, of the oldest command. Only valid while depth > 0."""
+        return self._durations[self._head % self.size]
+
+    def source(self) -> int:
+        """Source of the oldest command, see feeding_log.py. Only valid while depth > 0."""
+        return self._sources[self._head % self.size]
+
+    def pop(self) -> None:
+        """Remove the oldest command, from the consumer only."""
+        if self._tail != self._head:
+            self._head += 1
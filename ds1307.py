@@ -1,128 +1,345 @@
 """Driver for the DS1307 module with code for reading/writing NVRAM."""
+from machine import Pin
 from micropython import const
+from tools import days_since_2000
 import utime
 import _thread
+import metrics
 
 DATETIME_REG = const(0) 
 CHIP_HALT    = const(128)
 CONTROL_REG  = const(7) 
 RAM_REG      = const(8) 
+NVRAM_SIZE   = const(56) # Bytes of battery-backed RAM, registers 0x08-0x3F
+DATETIME_SIZE  = const(7)  # Time keeping registers, 0x00-0x06
+FORMATTED_SIZE = const(19) # Length of "YYYY-MM-DD HH:MM:SS"
+
+I2C_DEADLINE_MS     = const(50)   # Default time a driver call may spend retrying.
+BACKOFF_START_MS    = const(1)    # First delay between retries, doubled after every failure...
+BACKOFF_MAX_MS      = const(16)   # ...up to this.
+BREAKER_THRESHOLD   = const(3)    # Failed calls in a row that open the circuit breaker.
+BREAKER_COOLDOWN_MS = const(5000) # Calls fail fast for this long once the breaker is open.
+
+
+# Decoding and encoding tables, so converting a register costs a single lookup
+BCD_TO_DEC = bytes((value >> 4)*10 + (value & 0x0F) for value in range(256))
+DEC_TO_BCD = bytes((value // 10) << 4 | (value % 10) for value in range(100))
+
+
+class BusError(OSError):
+    """The DS1307 did not respond before the deadline, or the circuit breaker is open."""
+    pass
+
+
+def recover_bus(scl_pin:int, sda_pin:int) -> None:
+    """ Free an I2C bus where a slave holds SDA low in the middle of a byte, by clocking SCL
+        until SDA is released and then sending a STOP condition.
+        The I2C peripheral must be set up again afterwards, as this takes over the pins.
+    """
+    scl = Pin(scl_pin, Pin.OPEN_DRAIN, value=1)
+    sda = Pin(sda_pin, Pin.OPEN_DRAIN, value=1)
+    for i in range(9):
+        if sda.value():
+            break
+        scl.value(0)
+        utime.sleep_us(5)
+        scl.value(1)
+        utime.sleep_us(5)
+    # STOP: SDA goes high while SCL is high
+    sda.value(0)
+    utime.sleep_us(5)
+    scl.value(1)
+    utime.sleep_us(5)
+    sda.value(1)
+    utime.sleep_us(5)
 
 
 class DS1307(object):
-    """Driver for the DS1307 RTC."""
-    def __init__(self, i2c, addr=0x68):
+    """ Driver for the DS1307 RTC.
+        Every call gives up with a BusError after deadline_ms, retrying with exponential backoff
+        until then. After BREAKER_THRESHOLD failed calls in a row the circuit breaker opens: calls
+        fail immediately for BREAKER_COOLDOWN_MS, and recover() is called to get a fresh I2C object.
+        The time can be read without allocating any memory with datetime_into(), epoch_seconds()
+        and format_into(), which decode the registers from a buffer that is reused between calls.
+    """
+    def __init__(self, i2c, addr=0x68, deadline_ms:int=I2C_DEADLINE_MS, recover=None):
         self.i2c = i2c
         self.addr = addr
+        self.deadline_ms = deadline_ms
+        self.recover = recover
         self.mutex = _thread.allocate_lock()
         self.weekday_start = 1
         self.weekdays = ["Monday","Tuesday","Wednesday","Thursday","Friday","Saturday", "Sunday"]
-        self._halted = self.is_running()==False
+        self._failures = 0
+        self._breaker_opened = utime.ticks_ms()
+        # Register buffers, guarded by _buffer_lock from the read until they are decoded
+        self._buffer_lock = _thread.allocate_lock()
+        self._datetime_buffer = bytearray(DATETIME_SIZE)
+        self._register_buffer = bytearray(1)
+        try:
+            self._halted = self.is_running()==False
+        except BusError:
+            self._halted = False
         
 
     def _dec2bcd(self, value):
         """Convert decimal to binary coded decimal (BCD) format"""
-        return (value // 10) << 4 | (value % 10)
+        return DEC_TO_BCD[value]
     
 
     def _bcd2dec(self, value):
         """Convert binary coded decimal (BCD) format to decimal"""
-        return ((value >> 4) * 10) + (value & 0x0F)
+        return BCD_TO_DEC[value]
     
 
-    def datetime(self, datetime=None):
+    def datetime(self, datetime=None, deadline_ms:int=None):
         """Get or set datetime"""
-        if datetime is None:
-            buf = self._guaranteed_read(DATETIME_REG, 7)
-            return (
-                self._bcd2dec(buf[6]) + 2000, # year
-                self._bcd2dec(buf[5]), # month
-                self._bcd2dec(buf[4]), # day
-                self._bcd2dec(buf[3] - self.weekday_start), # weekday
-                self._bcd2dec(buf[2]), # hour
-                self._bcd2dec(buf[1]), # minute
-                self._bcd2dec(buf[0] & 0x7F) # second
-            )
-        buf = bytearray(7)
-        buf[0] = self._dec2bcd(datetime[6]) & 0x7F # second, msb = CH, 1=halt, 0=go
-        buf[1] = self._dec2bcd(datetime[5]) # minute
-        buf[2] = self._dec2bcd(datetime[4]) # hour
-        buf[3] = self._dec2bcd(datetime[3] + self.weekday_start) # weekday
-        buf[4] = self._dec2bcd(datetime[2]) # day
-        buf[5] = self._dec2bcd(datetime[1]) # month
-        buf[6] = self._dec2bcd(datetime[0] - 2000) # year
-        if (self._halted):
-            buf[0] |= CHIP_HALT
-        self._guranteed_write(DATETIME_REG, buf)
-        
-        
-    def start(self):
-        reg = self._guaranteed_read(DATETIME_REG, 1)[0]
-        reg &= ~CHIP_HALT
-        self._guranteed_write(DATETIME_REG, bytearray([reg]))
-        self._halted = False
-        
-        
-    def halt(self):
-        reg = self._guaranteed_read(DATETIME_REG, 1)[0]
-        reg |= CHIP_HALT
-        self._guranteed_write(DATETIME_REG, bytearray([reg]))
-        self._halted = True
-        
-        
-    def is_running(self) -> bool:
-        reg = self._guaranteed_read(DATETIME_REG, 1)[0]
+        buf = self._datetime_buffer
+        with self._buffer_lock:
+            if datetime is None:
+                self._read_into(DATETIME_REG, buf, deadline_ms)
+                return (
+                    BCD_TO_DEC[buf[6]] + 2000, # year
+                    BCD_TO_DEC[buf[5]], # month
+                    BCD_TO_DEC[buf[4]], # day
+                    (buf[3] - self.weekday_start) % 7, # weekday
+                    BCD_TO_DEC[buf[2]], # hour
+                    BCD_TO_DEC[buf[1]], # minute
+                    BCD_TO_DEC[buf[0] & 0x7F] # second
+                )
+            buf[0] = DEC_TO_BCD[datetime[6]] & 0x7F # second, msb = CH, 1=halt, 0=go
+            buf[1] = DEC_TO_BCD[datetime[5]] # minute
+            buf[2] = DEC_TO_BCD[datetime[4]] # hour
+            buf[3] = DEC_TO_BCD[datetime[3] + self.weekday_start] # weekday
+            buf[4] = DEC_TO_BCD[datetime[2]] # day
+            buf[5] = DEC_TO_BCD[datetime[1]] # month
+            buf[6] = DEC_TO_BCD[datetime[0] - 2000] # year
+            if (self._halted):
+                buf[0] |= CHIP_HALT
+            self._write(DATETIME_REG, buf, deadline_ms)
+        
+        
+    def datetime_into(self, values, deadline_ms:int=None):
+        """ Read the time into values, which must hold at least 7 numbers, in the order of the
+            datetime() tuple. Returns values.
+        """
+        buf = self._datetime_buffer
+        with self._buffer_lock:
+            self._read_into(DATETIME_REG, buf, deadline_ms)
+            values[0] = BCD_TO_DEC[buf[6]] + 2000 # year
+            values[1] = BCD_TO_DEC[buf[5]] # month
+            values[2] = BCD_TO_DEC[buf[4]] # day
+            values[3] = (buf[3] - self.weekday_start) % 7 # weekday
+            values[4] = BCD_TO_DEC[buf[2]] # hour
+            values[5] = BCD_TO_DEC[buf[1]] # minute
+            values[6] = BCD_TO_DEC[buf[0] & 0x7F] # second
+        return values
+        
+        
+    def epoch_seconds(self, deadline_ms:int=None) -> int:
+        """Read the time as seconds since 2000-01-01 00:00:00."""
+        buf = self._datetime_buffer
+        with self._buffer_lock:
+            self._read_into(DATETIME_REG, buf, deadline_ms)
+            days = days_since_2000(BCD_TO_DEC[buf[6]] + 2000, BCD_TO_DEC[buf[5]], BCD_TO_DEC[buf[4]])
+            return days*86400 + BCD_TO_DEC[buf[2]]*3600 + BCD_TO_DEC[buf[1]]*60 + BCD_TO_DEC[buf[0] & 0x7F]
+        
+        
+    def format_into(self, text:bytearray, deadline_ms:int=None) -> int:
+        """ Read the time and write it as ASCII "YYYY-MM-DD HH:MM:SS" to the first FORMATTED_SIZE bytes of text.
+            Returns the weekday, an index into weekdays, from the same read.
+        """
+        buf = self._datetime_buffer
+        with self._buffer_lock:
+            self._read_into(DATETIME_REG, buf, deadline_ms)
+            buf[0] &= 0x7F
+            text[0] = 0x32 # The year register only holds the years after 2000
+            text[1] = 0x30
+            # The registers are BCD already, each nibble is a digit
+            position = 2
+            for register in (6, 5, 4, 2, 1, 0):
+                text[position] = 0x30 + (buf[register] >> 4)
+                text[position+1] = 0x30 + (buf[register] & 0x0F)
+                position += 3
+            text[4] = text[7] = 0x2D # -
+            text[10] = 0x20
+            text[13] = text[16] = 0x3A # :
+            return (buf[3] - self.weekday_start) % 7
+        
+        
+    def start(self, deadline_ms:int=None):
+        with self._buffer_lock:
+            reg = self._read_into(DATETIME_REG, self._register_buffer, deadline_ms)
+            reg[0] &= ~CHIP_HALT
+            self._write(DATETIME_REG, reg, deadline_ms)
+            self._halted = False
+        
+        
+    def halt(self, deadline_ms:int=None):
+        with self._buffer_lock:
+            reg = self._read_into(DATETIME_REG, self._register_buffer, deadline_ms)
+            reg[0] |= CHIP_HALT
+            self._write(DATETIME_REG, reg, deadline_ms)
+            self._halted = True
+        
+        
+    def is_running(self, deadline_ms:int=None) -> bool:
+        with self._buffer_lock:
+            reg = self._read_into(DATETIME_REG, self._register_buffer, deadline_ms)[0]
         reg &= CHIP_HALT
         self._halted = reg != 0
         return self._halted == False
     
     
-    def read_nvram(self, address, length) -> bytearray:
+    def read_nvram(self, address, length, deadline_ms:int=None) -> bytearray:
         """Read length bytes, starting at address. The address is zero-based, relative to the start of RAM."""
-        return self._guaranteed_read(RAM_REG+address, length)
+        return self._read(RAM_REG+address, length, deadline_ms)
     
     
-    def write_nvram(self, address, bytes):
+    def write_nvram(self, address, bytes, deadline_ms:int=None):
         """Write bytes to NVRAM, starting at address. The address is zero-based, relative to the start of RAM."""
-        self._guranteed_write( RAM_REG+address, bytearray(bytes))
+        self._write(RAM_REG+address, bytearray(bytes), deadline_ms)
+        
+        
+    def read_all_nvram(self, deadline_ms:int=None) -> bytearray:
+        """Read the whole NVRAM in a single transaction."""
+        return self._read(RAM_REG, NVRAM_SIZE, deadline_ms)
+    
+    
+    def write_all_nvram(self, bytes, deadline_ms:int=None):
+        """Write the whole NVRAM in a single transaction."""
+        if len(bytes) != NVRAM_SIZE:
+            raise ValueError("NVRAM image must be 56 bytes.")
+        self._write(RAM_REG, bytearray(bytes), deadline_ms)
         
         
     def get_formatted_time(self) -> str:
         """Get the time in ISO8601 format"""
-        (year,month,mday,weekday,hour,minute,second) = self.datetime()
-        return f"{year:04d}-{month:02d}-{mday:02d} {hour:02d}:{minute:02d}:{second:02d}"
+        text = bytearray(FORMATTED_SIZE)
+        self.format_into(text)
+        return text.decode()
     
     
     def get_weekday(self) -> str:
         """Get an English string representation of the current weekday."""
-        (year,month,mday,weekday,hour,minute,second) = self.datetime()
-        return self.weekdays[weekday]
+        return self.weekdays[self.datetime()[3]]
     
     
-    def _guranteed_write(self, address:int, bytes:bytearray) -> None:
-        """ Retry the write untill it succeeds. Each failure causes a 1 ms delay.
-            This can hang forever if there is a hardware fault.
-        """
-        while True:
-            try:
-                with self.mutex:
-                    return self.i2c.writeto_mem(self.addr, address, bytes)            
-            except:
-                print("Retrying write.")
-                utime.sleep_ms(1)
+    def get_weekday_and_time(self) -> str:
+        """Get the weekday and the time in ISO8601 format, e.g. "Monday 2026-03-02 07:00:00", from a single read."""
+        text = bytearray(FORMATTED_SIZE)
+        weekday = self.format_into(text)
+        return f"{self.weekdays[weekday]} {text.decode()}"
+    
+    
+    def _write(self, address:int, bytes:bytearray, deadline_ms:int=None) -> None:
+        """Write to the registers starting at address, see _transfer()."""
+        self._transfer(address, bytes, True, deadline_ms)
                 
                 
-    def _guaranteed_read(self, address:int, length:int) -> bytearray:
-        """ Retry the read untill it succeeds. Each failure causes a 1 ms delay.
-            This can hang forever if there is a hardware fault.
+    def _read(self, address:int, length:int, deadline_ms:int=None) -> bytearray:
+        """Read length registers starting at address into a new buffer, see _transfer()."""
+        return self._read_into(address, bytearray(length), deadline_ms)
+    
+    
+    def _read_into(self, address:int, buf:bytearray, deadline_ms:int=None) -> bytearray:
+        """Fill buf with the registers starting at address, see _transfer(). Returns buf."""
+        self._transfer(address, buf, False, deadline_ms)
+        return buf
+    
+    
+    def _transfer(self, address:int, data, is_write:bool, deadline_ms:int=None):
+        """ Run one I2C transaction, retrying with capped exponential backoff until the deadline.
+            Raises BusError if it did not succeed in time, or right away if the breaker is open.
         """
+        if self._failures >= BREAKER_THRESHOLD:
+            if utime.ticks_diff(utime.ticks_ms(), self._breaker_opened) < BREAKER_COOLDOWN_MS:
+                raise BusError("I2C circuit breaker open")
+            # Cooldown is over, let this call through to probe the bus
+        if deadline_ms is None:
+            deadline_ms = self.deadline_ms
+        give_up = utime.ticks_add(utime.ticks_ms(), deadline_ms)
+        backoff = BACKOFF_START_MS
+        retries = 0
         while True:
             try:
+                waiting_since = utime.ticks_us()
                 with self.mutex:
-                    return self.i2c.readfrom_mem(self.addr, address, length)
-            except:
-                print("Retrying read.")
-                utime.sleep_ms(1)
-                
-            
+                    metrics.record_since(metrics.MUTEX_WAIT, waiting_since)
+                    if is_write:
+                        self.i2c.writeto_mem(self.addr, address, data)
+                    else:
+                        self.i2c.readfrom_mem_into(self.addr, address, data)
+                metrics.count_i2c(address, retries)
+                self._failures = 0
+                return
+            except OSError:
+                retries += 1
+                remaining = utime.ticks_diff(give_up, utime.ticks_ms())
+                if remaining <= 0:
+                    break
+                utime.sleep_ms(min(backoff, remaining))
+                backoff = min(backoff*2, BACKOFF_MAX_MS)
+        metrics.count_i2c(address, retries)
+        self._on_failure()
+        raise BusError(f"No response from the DS1307 after {retries} attempts")
+    
+    
+    def _on_failure(self) -> None:
+        self._failures += 1
+        if self._failures < BREAKER_THRESHOLD:
+            return
+        print("I2C bus fault, opening the circuit breaker.")
+        metrics.count(metrics.BUS_FAULTS)
+        self._breaker_opened = utime.ticks_ms()
+        if self.recover is not None:
+            with self.mutex:
+                try:
+                    self.i2c = self.recover()
+                except OSError as e:
+                    print(f"I2C bus recovery failed: {e}")
+        
+        
+
+class NvramStage(object):
+    """ Collects NVRAM edits in a shadow copy of the NVRAM and writes them out in one go.
+        Only the smallest contiguous range covering all edits since the last flush is written,
+        so any number of edits costs a single I2C transaction.
+    """
+    def __init__(self, rtc:DS1307, shadow:bytearray, offset:int=0):
+        """ shadow must hold the current content of NVRAM starting at offset,
+            it is updated in place as edits are staged.
+        """
+        self.rtc = rtc
+        self.shadow = shadow
+        self.offset = offset
+        self._dirty_start = len(shadow)
+        self._dirty_end = 0
+        
         
+    def write(self, address:int, bytes) -> None:
+        """Stage bytes at address, relative to the start of the shadow."""
+        end = address+len(bytes)
+        if address < 0 or end > len(self.shadow):
+            raise ValueError("Staged write outside of NVRAM.")
+        self.shadow[address:end] = bytes
+        if address < self._dirty_start:
+            self._dirty_start = address
+        if end > self._dirty_end:
+            self._dirty_end = end
+            
+            
+    def is_dirty(self) -> bool:
+        return self._dirty_end > self._dirty_start
+    
+    
+    def flush(self) -> int:
+        """Write the dirty range to NVRAM. Returns the number of bytes written."""
+        if not self.is_dirty():
+            return 0
+        start = self._dirty_start
+        end = self._dirty_end
+        self.rtc.write_nvram(self.offset+start, memoryview(self.shadow)[start:end])
+        self._dirty_start = len(self.shadow)
+        self._dirty_end = 0
+        return end-start
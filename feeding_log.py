@@ -0,0 +1,138 @@
+"""Module that keeps an append-only log of the feedings in a fixed-size file in flash.
+
+The file holds a ring of CAPACITY records. Each record is RECORD_SIZE bytes, big-endian:
+    sequence number (4 bytes), counting up from 0 for the first record ever written
+    start time (4 bytes), seconds since 2000-01-01
+    source (1 byte), one of SOURCE_SCHEDULE, SOURCE_MANUAL and SOURCE_BUTTON
+    padding (1 byte)
+    requested duration (2 bytes), deciseconds
+    actual duration (4 bytes), ms
+Record n is kept at position n % CAPACITY, unused positions are filled with 0xFF.
+Once the ring is full the oldest record is overwritten, so the file never grows.
+New records are kept in RAM and written out in batches, to spare the flash.
+"""
+
+from micropython import const
+import metrics
+import struct
+import time
+
+RECORD_FORMAT     = ">LLBxHL"
+RECORD_SIZE       = const(16)
+CAPACITY          = const(512)    # Records in the file, 8 kB.
+EMPTY             = const(0xFFFFFFFF) # Sequence number of an unused position.
+PENDING_RECORDS   = const(16)     # Records that can wait in RAM to be written out...
+BATCH_RECORDS     = const(8)      # ...they are written once there are this many...
+FLUSH_INTERVAL_MS = const(600000) # ...or once the oldest of them has waited this long.
+
+SOURCE_SCHEDULE = const(0)
+SOURCE_MANUAL   = const(1)
+SOURCE_BUTTON   = const(2)
+
+class FeedingLog:
+    def __init__(self, path:str, capacity:int=CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self._record = bytearray(RECORD_SIZE)
+        # Records not yet written to flash, in a ring. append() only moves _tail and flush() only
+        # moves _head, so a record can be appended from a timer callback in the middle of a flush.
+        self._pending = bytearray(PENDING_RECORDS*RECORD_SIZE)
+        self._head = 0
+        self._tail = 0
+        self._oldest_pending = time.ticks_ms()
+        # Sequence number after the newest record in the file, and after the newest record appended
+        self._flushed = self._open()
+        self.next_sequence = self._flushed
+
+    @property
+    def first_sequence(self) -> int:
+        """Sequence number of the oldest record still in the file."""
+        return max(0, self._flushed-self.capacity)
+
+    def append(self, source:int, start:int, requested_ds:int, actual_ms:int) -> bool:
+        """ Add a record for a feeding. It does not touch the flash and does not allocate, so it is safe to
+            call from a timer callback. Returns False if the record was dropped because too many are pending.
+        """
+        if self._tail-self._head >= PENDING_RECORDS:
+            metrics.count(metrics.LOG_DROPS)
+            return False
+        if self._tail == self._head:
+            self._oldest_pending = time.ticks_ms()
+        struct.pack_into(RECORD_FORMAT, self._pending, (self._tail % PENDING_RECORDS)*RECORD_SIZE,
+                         self.next_sequence, start, source, min(requested_ds, 0xFFFF), actual_ms)
+        self.next_sequence += 1
+        self._tail += 1
+        return True
+
+    def flush_if_due(self) -> int:
+        """Write the pending records out if there are enough of them, or they have waited long enough."""
+        pending = self._tail-self._head
+        if pending >= BATCH_RECORDS or (pending and
+                time.ticks_diff(time.ticks_ms(), self._oldest_pending) >= FLUSH_INTERVAL_MS):
+            return self.flush()
+        return 0
+
+    def flush(self) -> int:
+        """Write all pending records to the file. Returns the number of records written."""
+        tail = self._tail
+        written = 0
+        if tail == self._head:
+            return 0
+        try:
+            with open(self.path, "r+b") as f:
+                while self._head < tail:
+                    # Write as many records as are contiguous both in RAM and in the file
+                    index = self._head % PENDING_RECORDS
+                    position = self._flushed % self.capacity
+                    count = min(tail-self._head, PENDING_RECORDS-index, self.capacity-position)
+                    f.seek(position*RECORD_SIZE)
+                    f.write(memoryview(self._pending)[index*RECORD_SIZE:(index+count)*RECORD_SIZE])
+                    self._head += count
+                    self._flushed += count
+                    written += count
+        except OSError as e:
+            print(f"Could not write the feeding log: {e}")
+        return written
+
+    def read_into(self, cursor:int, buffer:bytearray) -> int:
+        """ Copy the records in the file from sequence number cursor onwards into buffer, as many as fit.
+            Starts at the oldest record instead if cursor has already been overwritten.
+            Returns the number of records copied, 0 once there are no more.
+        """
+        start = max(cursor, self.first_sequence)
+        count = min(self._flushed-start, len(buffer)//RECORD_SIZE)
+        if count <= 0:
+            return 0
+        view = memoryview(buffer)
+        copied = 0
+        with open(self.path, "rb") as f:
+            while copied < count:
+                position = (start+copied) % self.capacity
+                run = min(count-copied, self.capacity-position)
+                f.seek(position*RECORD_SIZE)
+                f.readinto(view[copied*RECORD_SIZE:(copied+run)*RECORD_SIZE])
+                copied += run
+        return count
+
+    def _open(self) -> int:
+        """Create the file if it does not exist, and return the sequence number after its newest record."""
+        record = self._record
+        try:
+            with open(self.path, "rb") as f:
+                newest = -1
+                for position in range(self.capacity):
+                    if f.readinto(record) != RECORD_SIZE:
+                        raise OSError("Feeding log is truncated")
+                    sequence = struct.unpack_from(">L", record)[0]
+                    # Skip unused positions, and anything that is not where its sequence number says
+                    if sequence != EMPTY and sequence % self.capacity == position and sequence > newest:
+                        newest = sequence
+                return newest+1
+        except OSError as e:
+            print(f"Starting a new feeding log: {e}")
+        for i in range(RECORD_SIZE):
+            record[i] = 0xFF
+        with open(self.path, "wb") as f:
+            for position in range(self.capacity):
+                f.write(record)
+        return 0
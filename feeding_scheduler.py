@@ -0,0 +1,108 @@
+"""Module that keeps a sorted list of the upcoming feeding events and works out
+when the next one is due, so the controller can sleep in between.
+
+The events are also indexed in two bitmaps of one bit per minute of the day, 180 bytes each:
+one marks the minutes that have a feeding, the other the minutes inside the guard window
+around a feeding. Both questions are then answered by a single bit test, however many
+slots there are.
+"""
+
+from micropython import const
+
+MINUTES_PER_DAY      = const(1440)
+MAX_CATCH_UP_MINUTES = const(5)   # Feedings missed because the clock jumped forward this far are still run.
+MAX_HOLD_MINUTES     = const(10)  # Backward clock jumps up to this far never repeat a feeding.
+MAX_SLEEP_MS         = const(600000) # Re-read the RTC at least this often, to catch drift between RTC and ticks.
+GUARD_MINUTES        = const(5)   # Minutes closer than this to a feeding are inside its guard window.
+BITMAP_SIZE          = const(180) # MINUTES_PER_DAY/8
+
+def _set_bit(bitmap:bytearray, minute:int) -> None:
+    bitmap[minute >> 3] |= 1 << (minute & 7)
+
+def _test_bit(bitmap:bytearray, minute:int) -> bool:
+    return bitmap[minute >> 3] & (1 << (minute & 7)) != 0
+
+class FeedingScheduler:
+    def __init__(self, feeding_time_handler, guard_minutes:int=GUARD_MINUTES):
+        self.feeding_time_handler = feeding_time_handler
+        self.guard_minutes = guard_minutes
+        self._events = []
+        self._deciseconds = {}
+        self._due_map = bytearray(BITMAP_SIZE)
+        self._guard_map = bytearray(BITMAP_SIZE)
+        self._last_checked = None
+        self.rebuild()
+        
+    def rebuild(self) -> None:
+        """Rebuild the sorted list of (minute of day, deciseconds) events and the bitmaps from the schedule."""
+        deciseconds_at = {}
+        handler = self.feeding_time_handler
+        for slot in range(handler.num_slots):
+            (hour, minute, deciseconds) = handler.get_feeding_time(slot)
+            if hour < 24 and minute < 60 and deciseconds > 0:
+                minute_of_day = hour*60+minute
+                # Only one feeding time per minute, the lowest slot wins
+                if minute_of_day not in deciseconds_at:
+                    deciseconds_at[minute_of_day] = deciseconds
+        due_map = bytearray(BITMAP_SIZE)
+        guard_map = bytearray(BITMAP_SIZE)
+        for minute_of_day in deciseconds_at:
+            _set_bit(due_map, minute_of_day)
+            for offset in range(1-self.guard_minutes, self.guard_minutes):
+                _set_bit(guard_map, (minute_of_day+offset) % MINUTES_PER_DAY)
+        # The bitmaps are replaced rather than updated in place, so other threads never see them half built
+        self._events = sorted(deciseconds_at.items())
+        self._deciseconds = deciseconds_at
+        self._due_map = due_map
+        self._guard_map = guard_map
+        
+    def is_due(self, minute_of_day:int) -> bool:
+        """True if a feeding starts at this minute of the day."""
+        return _test_bit(self._due_map, minute_of_day)
+    
+    def in_guard(self, minute_of_day:int) -> bool:
+        """True if this minute of the day is less than guard_minutes from a feeding, in either direction."""
+        return _test_bit(self._guard_map, minute_of_day)
+        
+    def due(self, now:int) -> int:
+        """ Return the total feeding duration in deciseconds that is due at absolute minute now,
+            0 if nothing is due. Every minute is only ever considered once, so a slot is never
+            fired twice when the clock is set back, and slots passed over when the clock is set
+            forward by up to MAX_CATCH_UP_MINUTES are fired late rather than skipped.
+        """
+        last = self._last_checked
+        if last is None or now < last-MAX_HOLD_MINUTES:
+            # First check, or a large backward jump: start afresh without firing
+            self._last_checked = now
+            return 0
+        if now <= last:
+            # This minute has already been handled
+            return 0
+        total = 0
+        for minute in range(max(last+1, now-MAX_CATCH_UP_MINUTES), now+1):
+            minute_of_day = minute % MINUTES_PER_DAY
+            if _test_bit(self._due_map, minute_of_day):
+                total += self._deciseconds[minute_of_day]
+        self._last_checked = now
+        return total
+    
+    def next_feeding(self, now:int) -> int:
+        """Absolute minute of the first feeding event after absolute minute now, or None if there are none."""
+        if not self._events:
+            return None
+        minute_of_day = now % MINUTES_PER_DAY
+        midnight = now-minute_of_day
+        for (event_minute, deciseconds) in self._events:
+            if event_minute > minute_of_day:
+                return midnight+event_minute
+        # Wrap around to the first event tomorrow
+        return midnight+MINUTES_PER_DAY+self._events[0][0]
+    
+    def ms_until_next(self, now:int, second:int) -> int:
+        """ Milliseconds from the current time, given as absolute minute and second,
+            until the start of the minute of the next feeding event.
+        """
+        next_feeding = self.next_feeding(now)
+        if next_feeding is None:
+            return MAX_SLEEP_MS
+        return min(((next_feeding-now)*60-second)*1000, MAX_SLEEP_MS)
@@ -1,18 +1,46 @@
 """Module that manages the feeding times, reading and writing them to NVRAM,
-and updating them in response to network client requests."""
+and keeping track of which of them have changed."""
 
-from ds1307 import DS1307
-from hardware_controller import HardwareController
-from tools import are_times_within_5_minutes
-import utime
+from ds1307 import DS1307, NvramStage, BusError
+from micropython import const
+import array
+import random
+import time
+
+NUM_SLOTS     = const(18) # Number of feeding time slots stored in NVRAM.
+SLOT_SIZE     = const(3)  # Bytes per slot: hour, minute, deciseconds.
+SCHEDULE_SIZE = const(54) # NUM_SLOTS*SLOT_SIZE, the part of NVRAM used for the schedule.
+BOOT_RETRY_MS = const(1000) # How long to wait before trying again if the RTC does not respond at boot.
 
 class FeedingTimeHandler:
     def __init__(self, rtc):
         self.rtc = rtc
         self.is_dirty = False
-        if not self.rtc.is_running():
-            self.rtc.start()
-            self.is_dirty = True
+        # RAM mirror of the schedule in NVRAM. All reads are served from here,
+        # all writes go through to NVRAM as well.
+        self._schedule = bytearray(SCHEDULE_SIZE)
+        # Nothing can be done without the schedule, so wait for the RTC to come back if it does not respond.
+        while True:
+            try:
+                if not self.rtc.is_running():
+                    self.rtc.start()
+                    self.is_dirty = True
+                self._load_schedule()
+                break
+            except BusError as e:
+                print(f"Could not read the RTC, trying again: {e}")
+                time.sleep_ms(BOOT_RETRY_MS)
+        # Edits are staged in the mirror and flushed as a single write.
+        self._stage = NvramStage(self.rtc, self._schedule)
+        self._batching = False
+        self.num_slots = NUM_SLOTS
+        self._listeners = []
+        # The schedule version is bumped on every change. It starts at a random value so that
+        # versions a client saw before a reboot are unlikely to be mistaken for current ones.
+        self.base_version = random.getrandbits(16) << 8
+        self.version = self.base_version
+        self._slot_versions = array.array('L', [self.version]*NUM_SLOTS)
+        self._pending_slots = 0
         if not self._is_memory_initialised():
             self._initialise_memory()
             # If the memory has not been set up it is safe to assume the time is not correct either
@@ -21,36 +49,106 @@ class FeedingTimeHandler:
     def get_feeding_time(self, time_slot:int) -> (int, int, int):
         """ Read the feeding time at a given slot.
             Returns a tuple of a daily feeding time: hour, minute, and feeding duration in deciseconds.
-
+            The value is read from the RAM mirror and does not touch the I2C bus.
         """
-        if time_slot < 0 or time_slot >= 18:
+        if time_slot < 0 or time_slot >= NUM_SLOTS:
             raise ValueError("Invalid time slot.")
-        addr = time_slot*3
-        return self.rtc.read_nvram(addr,3)
+        addr = time_slot*SLOT_SIZE
+        schedule = self._schedule
+        return (schedule[addr], schedule[addr+1], schedule[addr+2])
     
     def set_feeding_time(self, time_slot:int, hour:int, minute:int, deciseconds:int) -> None:
         """Save the feeding time at a given slot."""
-        if time_slot < 0 or time_slot >= 18:
+        if time_slot < 0 or time_slot >= NUM_SLOTS:
             raise ValueError("Invalid time slot.")
-        addr = time_slot*3
-        self.rtc.write_nvram(addr,[hour,minute,deciseconds])
+        addr = time_slot*SLOT_SIZE
+        self._stage.write(addr, bytes([hour,minute,deciseconds]))
+        self._pending_slots |= 1 << time_slot
+        if not self._batching:
+            self.commit()
         
     def erase_feeding_time(self, time_slot:int) -> None:
         """Erase a feeding time, marking it as unused."""
         self.set_feeding_time(time_slot,255,255,255)
+        
+    def begin_batch(self) -> None:
+        """ Start collecting schedule edits. The edits are visible immediately,
+            but are only written to NVRAM by commit().
+        """
+        self._batching = True
+        
+    def commit(self) -> None:
+        """ Write all edits made since begin_batch() to NVRAM in a single transaction.
+            If the write fails the edits stay staged for the next commit, but they are
+            already in the mirror, so the version is bumped and listeners notified regardless.
+        """
+        self._batching = False
+        try:
+            self._stage.flush()
+        finally:
+            if self._pending_slots:
+                self._bump_version(self._pending_slots)
+                self._pending_slots = 0
+                self._notify()
+        
+    @property
+    def schedule(self) -> memoryview:
+        """Read-only view of the raw schedule, NUM_SLOTS entries of hour, minute, deciseconds."""
+        return memoryview(self._schedule)
+        
+    def changes_since(self, version:int) -> list:
+        """ Return the slots that changed after the given schedule version, or None if
+            the version is not from this boot and the client needs the full schedule.
+        """
+        if version < self.base_version or version > self.version:
+            return None
+        return [slot for slot in range(NUM_SLOTS) if self._slot_versions[slot] > version]
+        
+    def _bump_version(self, slot_mask:int) -> None:
+        self.version += 1
+        for slot in range(NUM_SLOTS):
+            if slot_mask & (1 << slot):
+                self._slot_versions[slot] = self.version
+        
+    def add_listener(self, callback) -> None:
+        """Register a callback that is called without arguments whenever the schedule changes."""
+        self._listeners.append(callback)
+        
+    def _notify(self) -> None:
+        for callback in self._listeners:
+            callback()
+        
+    def revalidate(self) -> bool:
+        """ Compare the RAM mirror with NVRAM and reload it if they differ.
+            Returns True if the mirror was already in sync.
+        """
+        stored = self.rtc.read_all_nvram()[:SCHEDULE_SIZE]
+        if stored == self._schedule:
+            return True
+        print("Schedule mirror out of sync with NVRAM, reloading.")
+        self._schedule[:] = stored
+        self._bump_version((1 << NUM_SLOTS)-1)
+        self._notify()
+        return False
+    
+    def _load_schedule(self) -> None:
+        """Read the whole schedule from NVRAM into the RAM mirror in one transaction."""
+        self._schedule[:] = self.rtc.read_all_nvram()[:SCHEDULE_SIZE]
     
     def _initialise_memory(self) -> None:
         """ Initialise the memory to a known state with no feeding times.
             This will typically only run once, the first time the device is turned on.
         """
-        for i in range(18):
-            self.set_feeding_time(i,255,255,255)
+        self.begin_batch()
+        for i in range(NUM_SLOTS):
+            self.erase_feeding_time(i)
+        self.commit()
             
     def _is_memory_initialised(self) -> None:
         """ Check if the memory values are sane. Upon first power-on, the memory will be scrambled
             and the chance of it being in a sane state is very small.
         """
-        for i in range(18):
+        for i in range(NUM_SLOTS):
             val = self.get_feeding_time(i)
             if val[0] == 255 and val[1] == 255 and val[2] == 255:
                 # The time slot is unused
@@ -62,58 +160,3 @@ class FeedingTimeHandler:
                 # Found an invalid timeslot, the memory is in an invalid state
                 return False
         return True
-    
-    
-    def handle_client(self, client_socket:socket, hardware_controller:HardwareController) -> None:
-        """Read the request from the client and react accordingly."""
-        recv_data = []
-        while True:
-            nu_data = client_socket.read(1)
-            if nu_data is None or nu_data == b'':
-                break
-            recv_data.append(nu_data[0])
-            if len(recv_data) == 1 and recv_data[0] == b'u'[0]:
-                # Update
-                self._send_data(client_socket)
-                break
-            elif len(recv_data) == 5 and recv_data[0] == b'c'[0]:
-                # Create
-                self.set_feeding_time(recv_data[1], recv_data[2], recv_data[3], recv_data[4])
-                self._send_data(client_socket)
-                break
-            elif len(recv_data) == 2 and recv_data[0] == b'd'[0]:
-                # Delete
-                self.erase_feeding_time(recv_data[1])
-                self._send_data(client_socket)
-                break
-            elif len(recv_data) == 2 and recv_data[0] == b'm'[0]:
-                # Manual running
-                millis = recv_data[1]*100
-                print(f"Manual running for {millis} ms.")
-                hardware_controller.start_servo(millis)
-                break
-            elif len(recv_data) > 5:
-                # Client sent long request, goodbye
-                break
-        utime.sleep_ms(1)
-        client_socket.close()
-            
-    def _send_data(self, client_socket:socket) -> None:
-        for address in range(18):
-            (hour,minute,deciseconds) = self.get_feeding_time(address)
-            client_socket.write(bytearray([hour,minute,deciseconds]))
-            
-    def no_feeding_time_within_5_min(self) -> bool:
-        """ Return true if there is a feeding time starting within five minutes of the current time,
-            false otherwise."""
-        (year,month,mday,weekday,the_hour,the_minute,second) = self.rtc.datetime()
-        for address in range(18):
-            (hour,minute,deciseconds) = self.get_feeding_time(address)
-            if are_times_within_5_minutes(hour,minute, the_hour, the_minute):
-                return False
-        return True
-        
-    
-        
-
-            
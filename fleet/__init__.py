@@ -0,0 +1,291 @@
+"""Host-side library for running many feeders at once. Runs under CPython 3, not on the board.
+
+Feeders are found from their beacons, see beacon.py: an Inventory listens on the beacon
+multicast group, on both the port-only and the header beacon ports, and keeps track of
+every feeder heard from recently.
+A FleetClient then talks to any number of them in parallel with version 2 frames, see
+protocol.py, one connection per operation. It holds at most connections_per_feeder
+connections to each feeder and max_connections in all, retries failed operations, and
+reports the outcome and latency of each one as a Result.
+
+    inventory = Inventory()
+    await inventory.start()
+    feeders = await inventory.wait_for(count=4, timeout_s=5)
+    results = await FleetClient().run(feeders, "push_schedule", [(7, 0, 30), (18, 0, 20)])
+"""
+
+import asyncio
+import socket
+import struct
+import time
+
+# See beacon.py
+BEACON_GROUP = "226.1.1.1"
+BEACON_PORT = 5050
+BEACON_HEADER_PORT = 5051
+BEACON_HEADER_FORMAT = ">BB8sLLL"
+BEACON_HEADER_VERSION = 1
+NO_FEEDING = 0xFFFFFFFF
+SERVO_STATES = ("idle", "dispensing", "braking")
+
+# See protocol.py
+PROTOCOL_V2 = 2
+STATUS_OK = 0
+STATUS_NAMES = ("ok", "malformed", "invalid", "busy")
+NUM_SLOTS = 18
+SCHEDULE_SIZE = 3*NUM_SLOTS
+EMPTY_SLOT = (255, 255, 255)
+
+DISCOVERY_S = 17             # Longest time between beacons, see MAX_INTERVAL_MS in beacon.py, plus a second.
+EXPIRY_S = 60                # Feeders not heard from for this long are left out of the inventory.
+CONNECTIONS_PER_FEEDER = 1   # Keep the RAM each feeder spends on connections low.
+MAX_CONNECTIONS = 32
+ATTEMPTS = 3
+TIMEOUT_S = 2.0              # For each attempt, from connecting to the end of the reply.
+BACKOFF_S = 0.2              # Wait before the first retry, doubled for every one after.
+
+
+class Feeder:
+    """A feeder as last described by its beacon."""
+    def __init__(self, device_id:str, host:str, port:int):
+        self.device_id = device_id
+        self.host = host
+        self.port = port
+        self.servo_state = 0
+        self.schedule_version = None
+        self.next_feeding = None # Seconds since 2000-01-01, None if there is none
+        self.last_sync = None    # Seconds since 2000-01-01, None if the time was never synced
+        self.last_seen = None    # time.monotonic() when the last beacon came in
+
+    def __repr__(self) -> str:
+        return f"Feeder({self.device_id} at {self.host}:{self.port})"
+
+
+def parse_beacon(data:bytes):
+    """ Split a beacon into (port, header fields), where the header fields are None
+        for beacons from firmware that only sends the port. Returns None if it is not a beacon.
+    """
+    (port, separator, header) = bytes(data).partition(b"\x00")
+    if not port.isdigit():
+        return None
+    if separator and len(header) >= struct.calcsize(BEACON_HEADER_FORMAT) and header[0] == BEACON_HEADER_VERSION:
+        return (int(port), struct.unpack_from(BEACON_HEADER_FORMAT, header))
+    return (int(port), None)
+
+
+class Inventory(asyncio.DatagramProtocol):
+    """ The feeders heard from in the last expiry_s seconds, by device ID.
+        Feeders that only send their port are known by their address instead.
+    """
+    def __init__(self, group:str=BEACON_GROUP, port:int=BEACON_PORT, expiry_s:float=EXPIRY_S,
+                 header_port:int=BEACON_HEADER_PORT):
+        self.group = group
+        self.port = port
+        self.header_port = header_port
+        self.expiry_s = expiry_s
+        self._feeders = {}
+        self._addresses = {} # (host, port) to the feeder last heard from there
+        self._changed = asyncio.Event()
+        self._transports = []
+
+    async def start(self) -> None:
+        """Start listening. Beacons sent straight to this host's ports are heard as well."""
+        loop = asyncio.get_running_loop()
+        for port in (self.port, self.header_port):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", port))
+            try:
+                membership = socket.inet_aton(self.group) + socket.inet_aton("0.0.0.0")
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            except OSError as e:
+                print(f"Could not join the beacon group {self.group}, only hearing beacons sent to this host: {e}")
+            (transport, protocol) = await loop.create_datagram_endpoint(lambda: self, sock=sock)
+            self._transports.append(transport)
+
+    def close(self) -> None:
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+
+    def datagram_received(self, data:bytes, address:tuple) -> None:
+        beacon = parse_beacon(data)
+        if beacon is None:
+            return
+        (port, header) = beacon
+        host = address[0]
+        if header is None:
+            # Feeders that send the header send the port-only beacon as well, that is the same feeder
+            feeder = self._addresses.get((host, port))
+            device_id = f"{host}:{port}" if feeder is None else feeder.device_id
+        else:
+            device_id = header[2].hex()
+            # Until its first header came in, the feeder was known by its address
+            self._feeders.pop(f"{host}:{port}", None)
+        feeder = self._feeders.get(device_id)
+        if feeder is None or (feeder.host, feeder.port) != (host, port):
+            feeder = Feeder(device_id, host, port)
+            self._feeders[device_id] = feeder
+        self._addresses[(host, port)] = feeder
+        if header is not None:
+            (version, servo_state, raw_id, schedule_version, next_feeding, last_sync) = header
+            feeder.servo_state = servo_state
+            feeder.schedule_version = schedule_version
+            feeder.next_feeding = None if next_feeding == NO_FEEDING else next_feeding
+            feeder.last_sync = last_sync or None
+        feeder.last_seen = time.monotonic()
+        self._changed.set()
+
+    @property
+    def feeders(self) -> list:
+        """The live feeders, sorted by device ID."""
+        oldest = time.monotonic()-self.expiry_s
+        return [self._feeders[device_id] for device_id in sorted(self._feeders)
+                if self._feeders[device_id].last_seen >= oldest]
+
+    async def wait_for(self, count:int=None, timeout_s:float=DISCOVERY_S) -> list:
+        """ Wait until count feeders have been heard from, or timeout_s has passed, and return the live ones.
+            Without a count, listens for the whole timeout.
+        """
+        deadline = time.monotonic()+timeout_s
+        while count is None or len(self.feeders) < count:
+            remaining = deadline-time.monotonic()
+            if remaining <= 0:
+                break
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.feeders
+
+
+class FleetError(Exception):
+    """A feeder answered, but not with what was asked for."""
+    pass
+
+
+class Result:
+    """ Outcome of an operation on one feeder. value is what the operation returned, error the last
+        failure, as text. latency_ms is the time taken by the attempt that succeeded, or the last one,
+        None if there was no attempt, and elapsed_ms the time taken by all attempts, including waiting for a connection.
+    """
+    def __init__(self, feeder:Feeder):
+        self.feeder = feeder
+        self.ok = False
+        self.value = None
+        self.error = None
+        self.attempts = 0
+        self.latency_ms = None
+        self.elapsed_ms = None
+
+    def __repr__(self) -> str:
+        outcome = "ok" if self.ok else f"failed: {self.error}"
+        latency = "-" if self.latency_ms is None else f"{self.latency_ms:.1f}"
+        return f"Result({self.feeder.device_id} {outcome}, {self.attempts} attempts, {latency} ms)"
+
+
+def encode_frame(payload:bytes) -> bytes:
+    return struct.pack(">BH", PROTOCOL_V2, len(payload)) + payload
+
+
+def encode_schedule(schedule:list) -> bytes:
+    """ Commands that replace the whole schedule with a list of up to NUM_SLOTS (hour, minute, deciseconds),
+        emptying the slots after them.
+    """
+    if len(schedule) > NUM_SLOTS:
+        raise ValueError(f"A schedule has at most {NUM_SLOTS} feeding times")
+    commands = bytearray()
+    for slot in range(NUM_SLOTS):
+        if slot < len(schedule):
+            (hour, minute, deciseconds) = schedule[slot]
+            if not (0 <= hour < 24 and 0 <= minute < 60 and 0 < deciseconds <= 255):
+                raise ValueError(f"Not a feeding time: {schedule[slot]}")
+            commands += bytes((ord('c'), slot, hour, minute, deciseconds))
+        else:
+            commands += bytes((ord('d'), slot))
+    return bytes(commands)
+
+
+def decode_schedule(data:bytes) -> list:
+    """The (hour, minute, deciseconds) of the used slots in a schedule reply, in slot order."""
+    slots = [tuple(data[i:i+3]) for i in range(0, SCHEDULE_SIZE, 3)]
+    return [slot for slot in slots if slot != EMPTY_SLOT]
+
+
+class FleetClient:
+    def __init__(self, connections_per_feeder:int=CONNECTIONS_PER_FEEDER, max_connections:int=MAX_CONNECTIONS,
+                 attempts:int=ATTEMPTS, timeout_s:float=TIMEOUT_S, backoff_s:float=BACKOFF_S):
+        self.connections_per_feeder = connections_per_feeder
+        self.attempts = attempts
+        self.timeout_s = timeout_s
+        self.backoff_s = backoff_s
+        self._connections = asyncio.Semaphore(max_connections)
+        self._feeder_connections = {}
+
+    async def run(self, feeders:list, operation:str, *args) -> list:
+        """Run the named operation, e.g. "read_schedule", on all feeders at once. Returns a Result for each."""
+        return await asyncio.gather(*(self.attempt(feeder, getattr(self, operation), *args) for feeder in feeders))
+
+    async def attempt(self, feeder:Feeder, operation, *args) -> Result:
+        """Run operation(feeder, *args), retrying with backoff if it fails."""
+        result = Result(feeder)
+        started = time.perf_counter()
+        backoff = self.backoff_s
+        limit = self._feeder_connections.get(feeder.device_id)
+        if limit is None:
+            limit = asyncio.Semaphore(self.connections_per_feeder)
+            self._feeder_connections[feeder.device_id] = limit
+        while result.attempts < self.attempts:
+            if result.attempts:
+                await asyncio.sleep(backoff)
+                backoff *= 2
+            result.attempts += 1
+            async with limit, self._connections:
+                attempt_started = time.perf_counter()
+                try:
+                    result.value = await asyncio.wait_for(operation(feeder, *args), self.timeout_s)
+                    result.ok = True
+                except (OSError, EOFError, FleetError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    result.error = str(e) or type(e).__name__
+                result.latency_ms = (time.perf_counter()-attempt_started)*1000
+            if result.ok:
+                break
+        result.elapsed_ms = (time.perf_counter()-started)*1000
+        return result
+
+    async def exchange(self, feeder:Feeder, payload:bytes) -> tuple:
+        """Send one frame and return (schedule version, reply payload). Raises FleetError unless the status is ok."""
+        (reader, writer) = await asyncio.open_connection(feeder.host, feeder.port)
+        try:
+            writer.write(encode_frame(payload))
+            await writer.drain()
+            (version, length) = struct.unpack(">BH", await reader.readexactly(3))
+            if version != PROTOCOL_V2:
+                raise FleetError(f"Unknown reply version {version}")
+            reply = await reader.readexactly(length)
+        finally:
+            writer.close()
+        if len(reply) < 5:
+            raise FleetError("Short reply")
+        (status, schedule_version) = struct.unpack_from(">BL", reply)
+        if status != STATUS_OK:
+            raise FleetError(f"Request refused, {STATUS_NAMES[status] if status < len(STATUS_NAMES) else status}")
+        feeder.schedule_version = schedule_version
+        return (schedule_version, reply[5:])
+
+    async def read_schedule(self, feeder:Feeder) -> list:
+        """The feeder's schedule, as a list of (hour, minute, deciseconds)."""
+        (version, reply) = await self.exchange(feeder, b"u")
+        if len(reply) != SCHEDULE_SIZE:
+            raise FleetError("Short schedule")
+        return decode_schedule(reply)
+
+    async def push_schedule(self, feeder:Feeder, schedule:list) -> int:
+        """ Replace the feeder's schedule, in a single NVRAM commit, and check what it reads back.
+            Returns the new schedule version.
+        """
+        (version, reply) = await self.exchange(feeder, encode_schedule(schedule) + b"u")
+        if decode_schedule(reply) != [tuple(entry) for entry in schedule]:
+            raise FleetError("Schedule did not read back as pushed")
+        return version
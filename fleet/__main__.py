@@ -0,0 +1,111 @@
+"""Find the feeders on the network and read or replace their schedules, all at once.
+
+    python -m fleet list
+    python -m fleet read
+    python -m fleet push SCHEDULE_FILE
+
+The schedule file has one feeding time per line, as HH:MM and the run time in deciseconds,
+e.g. "07:00 30". Blank lines and lines starting with # are skipped. Feeders are found by
+listening for beacons for --wait seconds, or until --count of them have been heard. A feeder
+whose state has not changed for a while only sends its beacon every 16 seconds.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+from fleet import (BEACON_GROUP, BEACON_PORT, BEACON_HEADER_PORT, DISCOVERY_S, CONNECTIONS_PER_FEEDER, MAX_CONNECTIONS, ATTEMPTS, TIMEOUT_S,
+                   SERVO_STATES, FleetClient, Inventory)
+
+
+def read_schedule_file(path:str) -> list:
+    schedule = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            (clock, deciseconds) = line.split()
+            (hour, minute) = clock.split(":")
+            schedule.append((int(hour), int(minute), int(deciseconds)))
+    return schedule
+
+
+def format_schedule(schedule:list) -> str:
+    return " ".join(f"{hour:02d}:{minute:02d}/{deciseconds}" for (hour, minute, deciseconds) in schedule) or "-"
+
+
+async def run(args) -> int:
+    inventory = Inventory(args.group, args.beacon_port, header_port=args.header_port)
+    await inventory.start()
+    try:
+        feeders = await inventory.wait_for(args.count, args.wait)
+    finally:
+        inventory.close()
+    if args.only:
+        feeders = [feeder for feeder in feeders if feeder.device_id in args.only]
+    if args.command == "list":
+        rows = [{
+            "device_id": feeder.device_id, "address": f"{feeder.host}:{feeder.port}",
+            "servo": SERVO_STATES[feeder.servo_state] if feeder.servo_state < len(SERVO_STATES) else str(feeder.servo_state),
+            "schedule_version": feeder.schedule_version, "next_feeding": feeder.next_feeding, "last_sync": feeder.last_sync,
+        } for feeder in feeders]
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            for row in rows:
+                print(f"{row['device_id']:16s} {row['address']:21s} {row['servo']:10s} schedule version {row['schedule_version']}")
+            print(f"{len(rows)} feeders")
+        return 0
+
+    client = FleetClient(args.connections, args.max_connections, args.attempts, args.timeout)
+    if args.command == "read":
+        results = await client.run(feeders, "read_schedule")
+    else:
+        results = await client.run(feeders, "push_schedule", read_schedule_file(args.schedule))
+    rows = [{
+        "device_id": result.feeder.device_id, "ok": result.ok, "attempts": result.attempts,
+        "latency_ms": result.latency_ms, "elapsed_ms": result.elapsed_ms, "error": result.error,
+        "value": result.value,
+    } for result in results]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for (row, result) in zip(rows, results):
+            if not result.ok:
+                outcome = f"FAILED {result.error}"
+            elif args.command == "read":
+                outcome = format_schedule(result.value)
+            else:
+                outcome = f"schedule version {result.value}"
+            latency = "-" if result.latency_ms is None else f"{result.latency_ms:.1f}"
+            print(f"{row['device_id']:16s} {latency:>8s} ms  {result.attempts} attempts  {outcome}")
+        failed = sum(1 for result in results if not result.ok)
+        print(f"{len(results)-failed} of {len(results)} feeders ok")
+    return 0 if all(result.ok for result in results) else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m fleet", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("list", "read", "push"))
+    parser.add_argument("schedule", nargs="?", help="schedule file, for push")
+    parser.add_argument("--group", default=BEACON_GROUP, help="beacon multicast group")
+    parser.add_argument("--beacon-port", type=int, default=BEACON_PORT)
+    parser.add_argument("--header-port", type=int, default=BEACON_HEADER_PORT, help="port of the beacons with a header")
+    parser.add_argument("--wait", type=float, default=DISCOVERY_S, help="seconds to listen for beacons")
+    parser.add_argument("--count", type=int, help="stop listening once this many feeders are found")
+    parser.add_argument("--only", action="append", help="device ID to include, may be repeated")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS_PER_FEEDER, help="connections per feeder")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="connections in all")
+    parser.add_argument("--attempts", type=int, default=ATTEMPTS, help="attempts per feeder")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT_S, help="seconds per attempt")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    if args.command == "push" and args.schedule is None:
+        parser.error("push needs a schedule file")
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
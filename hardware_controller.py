@@ -1,13 +1,24 @@
 """Module for controlling the servo, and making sure it runs a determined amount of time.
 This module is also responsible for handling the push-button and keeping track of feeding times.
+Dispense commands from the network are passed to the controller thread through a CommandQueue,
+so the network never waits for the servo.
 """
-from machine import Pin, PWM
+from machine import Pin, PWM, Timer
+import array
 import time
-import utime
 from micropython import const
 import _thread
+import metrics
+from command_queue import CommandQueue, POLICY_QUEUE, POLICY_EXTEND, POLICY_DROP
+from feeding_log import FeedingLog, SOURCE_SCHEDULE, SOURCE_MANUAL, SOURCE_BUTTON
+from feeding_scheduler import FeedingScheduler, GUARD_MINUTES
+from feeding_time_handler import FeedingTimeHandler
+from soft_clock import SoftClock
 
 DEBOUNCE_TIME_MS = const(30)
+# How long the servo runs for a button press, as (minimum press duration, dispense time) in ms.
+# The last step whose minimum is reached is used.
+BUTTON_DISPENSE_STEPS = ((0, 300), (1000, 1000), (3000, 3000))
 
 # These values are for the Feetech FS5106R servo.
 # Your servo values may differ.
@@ -15,77 +26,306 @@ DEBOUNCE_TIME_MS = const(30)
 STOPPED_DUTY_CYCLE_NS = const(1500000) # Duty cycle when the servo is stopped, in nanoseconds.
 CW_ROTATION_DUTY_CYCLE_NS = const(700000) # Duty cycle when dispensing, in nanoseconds.
 FREQUENCY_HZ = const(50) # Servo frequency.
+BRAKE_TIME_MS = const(300) # Time to let the servo stop before the PWM is turned off.
+DISPENSE_RECORDS = const(16) # Most recent dispenses kept for dispense_record().
+
+# Servo states
+SERVO_IDLE       = const(0)
+SERVO_DISPENSING = const(1)
+SERVO_BRAKING    = const(2)
 
 class HardwareController:
-    def __init__(self, servoPin:int, buttonPin:int, feeding_time_handler:FeedingTimeHandler):
-        self.is_running = False
+    def __init__(self, servoPin:int, buttonPin:int, feeding_time_handler:FeedingTimeHandler, clock:SoftClock,
+                 debounce_ms:int=DEBOUNCE_TIME_MS, dispense_steps:tuple=BUTTON_DISPENSE_STEPS,
+                 feeding_log:FeedingLog=None, guard_minutes:int=GUARD_MINUTES, dispense_policy:int=POLICY_QUEUE):
         self.feeding_time_handler = feeding_time_handler
+        self.clock = clock
+        self.feeding_log = feeding_log
         self.mutex = _thread.allocate_lock()
+        # The servo is a state machine driven by one-shot timer callbacks:
+        # idle -> dispensing -> braking -> idle
+        self.servoPin = servoPin
+        self.pwm = None
+        self.servo_state = SERVO_IDLE
+        self._servo_timer = Timer()
+        self._dispense_start = time.ticks_ms()
+        # Source and start time of the current dispense, for the feeding log
+        self.dispense_source = SOURCE_MANUAL
+        self._dispense_started_at = 0
+        # Requested and actual duration of the last dispense, and timing error statistics
+        self.last_requested_ms = 0
+        self.last_actual_ms = 0
+        # Dispenses started and finished, a dispense has started but not finished while they differ
+        self.dispense_starts = 0
+        self.dispense_count = 0
+        # Source, requested ms and actual ms of the last DISPENSE_RECORDS dispenses, by dispense number
+        self._records = array.array('L', [0]*(3*DISPENSE_RECORDS))
+        self.total_abs_error_ms = 0
+        self.max_abs_error_ms = 0
+        # Dispense commands from the network, and from the controller thread itself (button and schedule).
+        # What happens to them while the servo is running depends on dispense_policy, see command_queue.py.
+        self.commands = CommandQueue()
+        self._local_commands = CommandQueue()
+        self.dispense_policy = dispense_policy
+        self.policy_drops = 0
+        self.scheduler = FeedingScheduler(feeding_time_handler, guard_minutes)
+        self._schedule_changed = False
+        self._recheck = True
+        self._deadline = time.ticks_ms()
+        # Start of the next feeding, in seconds since 2000, or None if the schedule is empty
+        self.next_feeding = None
+        # The controller thread blocks on this lock until something releases it.
+        self._event = _thread.allocate_lock()
+        self._event.acquire()
+        self._wake_timer = Timer()
+        feeding_time_handler.add_listener(self.on_schedule_changed)
+        # The button is handled by an edge interrupt, followed by a debounce timer.
+        self.debounce_ms = debounce_ms
+        self.dispense_steps = dispense_steps
         self.buttonPin = Pin(buttonPin, Pin.IN, Pin.PULL_UP)
-        self.lastDebounceTime = utime.ticks_ms()
-        self.lastButtonState = self.buttonPin.value()
         self.buttonState = self.buttonPin.value()
-        self.turn_off =  time.ticks_ms()
-        self.last_second = 0
-        self.pwm = PWM(Pin(servoPin))
-        self.pwm.freq(FREQUENCY_HZ)
-        self.stop_servo()
+        self.lastEdgeTime = time.ticks_ms()
+        self.pressStartTime = self.lastEdgeTime
+        self._pending_dispense_ms = 0
+        self._debounce_timer = Timer()
+        self.buttonPin.irq(handler=self._on_button_edge, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING)
         # The servo controller runs in its own thread to ensure accurate timing.
         _thread.start_new_thread(self.run,())
         
-    def start_servo(self, duration_ms:int) -> None:
+    @property
+    def is_running(self) -> bool:
+        """True while the servo is dispensing or braking."""
+        return self.servo_state != SERVO_IDLE
+        
+    def request_dispense(self, duration_ms:int, source:int=SOURCE_MANUAL) -> bool:
+        """ Ask the controller thread to dispense for duration_ms. Never blocks, and may be called from
+            one thread other than the controller thread. Returns False if the command queue is full.
+        """
+        if duration_ms <= 0:
+            return True
+        queued = self.commands.put(duration_ms, source)
+        self._signal()
+        return queued
+        
+    def start_servo(self, duration_ms:int, source:int=SOURCE_MANUAL) -> None:
+        """ Start dispensing for duration_ms, unless the servo is already running.
+            source is recorded in the feeding log, see feeding_log.py.
+            Only called from the controller thread, other threads use request_dispense().
+        """
+        if duration_ms <= 0:
+            return
+        # Read the clock outside the mutex, it may have to go to the RTC
+        started_at = self.clock.epoch_seconds()
         with self.mutex:
-            if not self.is_running:
-                self.is_running = True
-                self.turn_off = time.ticks_add(time.ticks_ms(),duration_ms)
+            if self.servo_state == SERVO_IDLE:
+                # The PWM is turned off after every run, so it is set up again each time
+                self.pwm = PWM(Pin(self.servoPin))
+                self.pwm.freq(FREQUENCY_HZ)
                 self.pwm.duty_ns(CW_ROTATION_DUTY_CYCLE_NS)
+                self._dispense_start = time.ticks_ms()
+                self.last_requested_ms = duration_ms
+                self.dispense_source = source
+                self._dispense_started_at = started_at
+                record = 3*((self.dispense_starts+1) % DISPENSE_RECORDS)
+                self._records[record] = source
+                self._records[record+1] = duration_ms
+                self._records[record+2] = 0
+                self.dispense_starts += 1
+                self.servo_state = SERVO_DISPENSING
+                self._servo_timer.init(mode=Timer.ONE_SHOT, period=duration_ms, callback=self._on_dispense_done)
         
-    def stop_servo(self) -> None:
+    def _on_dispense_done(self, timer) -> None:
+        """Timer callback at the end of a dispense: stop the servo and let it brake."""
+        # Timer callbacks may run between the bytecodes of a thread that holds the mutex,
+        # so never block on it here. Try again shortly instead.
+        if not self.mutex.acquire(0):
+            self._servo_timer.init(mode=Timer.ONE_SHOT, period=1, callback=self._on_dispense_done)
+            return
+        try:
+            if self.servo_state != SERVO_DISPENSING:
+                return
+            elapsed_ms = time.ticks_diff(time.ticks_ms(), self._dispense_start)
+            if elapsed_ms < self.last_requested_ms:
+                # The dispense was extended while this callback waited for the mutex, and the retry
+                # above replaced the timer armed for the extension. Wait for the rest of it.
+                self._servo_timer.init(mode=Timer.ONE_SHOT, period=self.last_requested_ms-elapsed_ms,
+                                       callback=self._on_dispense_done)
+                return
+            self.pwm.duty_ns(STOPPED_DUTY_CYCLE_NS)
+            self._record_dispense(elapsed_ms)
+            self.servo_state = SERVO_BRAKING
+            self._servo_timer.init(mode=Timer.ONE_SHOT, period=BRAKE_TIME_MS, callback=self._on_brake_done)
+        finally:
+            self.mutex.release()
+            
+    def _on_brake_done(self, timer) -> None:
+        """Timer callback once the servo has had time to stop: turn off the PWM."""
+        if not self.mutex.acquire(0):
+            self._servo_timer.init(mode=Timer.ONE_SHOT, period=1, callback=self._on_brake_done)
+            return
+        try:
+            if self.servo_state != SERVO_BRAKING:
+                return
+            self.pwm.deinit()
+            self.servo_state = SERVO_IDLE
+            if self.commands.depth or self._local_commands.depth:
+                # Commands are waiting for the servo
+                self._signal()
+        finally:
+            self.mutex.release()
+            
+    def _extend_servo(self, duration_ms:int) -> bool:
+        """Add duration_ms to the current dispense. Returns False if the servo is not dispensing."""
         with self.mutex:
-            if self.is_running:
-                self.pwm.duty_ns(STOPPED_DUTY_CYCLE_NS)
-                # Wait a while to let the servo have time to stop
-                utime.sleep_ms(300)
-                self.pwm.deinit()
-                self.is_running = False
+            if self.servo_state != SERVO_DISPENSING:
+                return False
+            self.last_requested_ms += duration_ms
+            self._records[3*(self.dispense_starts % DISPENSE_RECORDS)+1] = self.last_requested_ms
+            remaining_ms = self.last_requested_ms - time.ticks_diff(time.ticks_ms(), self._dispense_start)
+            self._servo_timer.init(mode=Timer.ONE_SHOT, period=max(remaining_ms, 1), callback=self._on_dispense_done)
+            return True
+            
+    def _dispatch(self, duration_ms:int, source:int) -> bool:
+        """ Carry out a dispense command according to the dispense policy.
+            Returns False if the command has to wait until the servo is idle.
+        """
+        if self.servo_state == SERVO_IDLE:
+            self.start_servo(duration_ms, source)
+            return True
+        if self.dispense_policy == POLICY_DROP:
+            print(f"Servo running, dropping a {duration_ms} ms dispense.")
+            self.policy_drops += 1
+            metrics.count(metrics.COMMAND_DROPS)
+            return True
+        return self.dispense_policy == POLICY_EXTEND and self._extend_servo(duration_ms)
         
-    def check_servo(self) -> None:
-        if self.is_running:
-            if time.ticks_diff(time.ticks_ms(),self.turn_off)>=0:
-                self.stop_servo()
-                
-    def check_button(self):
-        """Check if the button has been pressed."""
+    def run_commands(self) -> None:
+        """Carry out the waiting dispense commands, the controller thread's own first."""
+        for commands in (self._local_commands, self.commands):
+            while commands.depth:
+                if not self._dispatch(commands.duration(), commands.source()):
+                    return
+                commands.pop()
+        
+    def _record_dispense(self, actual_ms:int) -> None:
+        error_ms = actual_ms - self.last_requested_ms
+        self.last_actual_ms = actual_ms
+        self._records[3*(self.dispense_starts % DISPENSE_RECORDS)+2] = actual_ms
+        self.dispense_count += 1
+        self.total_abs_error_ms += abs(error_ms)
+        self.max_abs_error_ms = max(self.max_abs_error_ms, abs(error_ms))
+        print(f"Dispensed for {actual_ms} ms, requested {self.last_requested_ms} ms ({error_ms:+d} ms).")
+        if self.feeding_log is not None:
+            self.feeding_log.append(self.dispense_source, self._dispense_started_at,
+                                    self.last_requested_ms//100, actual_ms)
+        
+    def dispense_record(self, number:int):
+        """ (source, requested ms, actual ms) of a dispense, numbered from 1 like dispense_starts.
+            The actual ms is 0 until it has finished. None if it is not one of the last DISPENSE_RECORDS.
+            The three are copied together under the mutex, so they always belong to the same dispense.
+        """
+        with self.mutex:
+            if not 0 <= self.dispense_starts-number < DISPENSE_RECORDS or number <= 0:
+                return None
+            record = 3*(number % DISPENSE_RECORDS)
+            return (self._records[record], self._records[record+1], self._records[record+2])
+        
+    def _on_button_edge(self, pin) -> None:
+        """Button interrupt. Every edge restarts the debounce timer."""
+        self.lastEdgeTime = time.ticks_ms()
+        self._debounce_timer.init(mode=Timer.ONE_SHOT, period=self.debounce_ms, callback=self._on_button_settled)
+        
+    def _on_button_settled(self, timer) -> None:
+        """Scheduled once the button has been stable for the debounce time."""
         reading = self.buttonPin.value()
-        if reading != self.lastButtonState:
-            self.lastDebounceTime = utime.ticks_ms()
-        last_debounce_timeout =  time.ticks_add(self.lastDebounceTime, DEBOUNCE_TIME_MS)
-        if time.ticks_diff(time.ticks_ms(),last_debounce_timeout)>=0:
-            if reading != self.buttonState:
-                self.buttonState = reading
-                if self.buttonState == 0:
-                    self.start_servo(300)
-        self.lastButtonState = reading
+        if reading == self.buttonState:
+            return
+        self.buttonState = reading
+        if reading == 0:
+            self.pressStartTime = self.lastEdgeTime
+        else:
+            pressed_ms = time.ticks_diff(self.lastEdgeTime, self.pressStartTime)
+            self._pending_dispense_ms = self.dispense_time_for_press(pressed_ms)
+            self._signal()
+            
+    def dispense_time_for_press(self, pressed_ms:int) -> int:
+        """Map the duration of a button press to a dispense time in ms."""
+        dispense_ms = 0
+        for (minimum_ms, step_ms) in self.dispense_steps:
+            if pressed_ms >= minimum_ms:
+                dispense_ms = step_ms
+        return dispense_ms
+        
+    def check_button(self) -> None:
+        """Start the servo if the button has been pressed."""
+        dispense_ms = self._pending_dispense_ms
+        if dispense_ms:
+            self._pending_dispense_ms = 0
+            print(f"Button pressed, running for {dispense_ms} ms.")
+            self._local_commands.put(dispense_ms, SOURCE_BUTTON)
+        
+    def on_schedule_changed(self) -> None:
+        """Called by the feeding time handler when the schedule has been edited."""
+        self._schedule_changed = True
+        self.wake()
         
+    def wake(self) -> None:
+        """Make the controller re-read the clock, e.g. after the RTC has been set."""
+        self._recheck = True
+        self._signal()
+        
+    def ms_until_due(self) -> int:
+        """ ms until the controller thread next has to run, 0 while the servo is running or
+            commands are waiting. Its timers need the board awake, see power.py.
+        """
+        if self.servo_state != SERVO_IDLE or self.commands.depth or self._local_commands.depth \
+                or self._pending_dispense_ms or self._recheck:
+            return 0
+        now = time.ticks_ms()
+        due_ms = time.ticks_diff(self._deadline, now)
+        # A button edge has to settle before the press is seen
+        settle_ms = self.debounce_ms - time.ticks_diff(now, self.lastEdgeTime)
+        if 0 < settle_ms < due_ms:
+            due_ms = settle_ms
+        return max(due_ms, 0)
+        
+    def _signal(self, timer=None) -> None:
+        """Wake the controller thread up. Safe to call from timer callbacks."""
+        try:
+            self._event.release()
+        except RuntimeError:
+            # Already released, the thread will wake up anyway
+            pass
     
-    def check_feeding_time(self, hour:int, minute:int):
-        """Check if it's time to start a feeding event."""
-        for i in range(18):
-            (feeding_hour, feeding_minute, feeding_deciseconds) = self.feeding_time_handler.get_feeding_time(i)
-            if hour == feeding_hour and minute == feeding_minute:
-                print(f"Starting feeding time {feeding_deciseconds*100} ms.")
-                self.start_servo(feeding_deciseconds*100)
-                # Only one feeding time per minute, so we quit the loop here
-                break
+    def check_feeding_time(self) -> None:
+        """Check if it's time to start a feeding event, and work out when to check next."""
+        if self._schedule_changed:
+            self._schedule_changed = False
+            self.scheduler.rebuild()
+        seconds = self.clock.epoch_seconds()
+        now = seconds//60
+        deciseconds = self.scheduler.due(now)
+        if deciseconds > 0:
+            print(f"Starting feeding time {deciseconds*100} ms at {now//60 % 24:02d}:{now % 60:02d}.")
+            self._local_commands.put(deciseconds*100, SOURCE_SCHEDULE)
+        next_feeding = self.scheduler.next_feeding(now)
+        self.next_feeding = None if next_feeding is None else next_feeding*60
+        self._deadline = time.ticks_add(time.ticks_ms(), self.scheduler.ms_until_next(now, seconds % 60))
+        
+    def _sleep(self) -> None:
+        """Block until the next deadline, or until something calls _signal()."""
+        sleep_ms = time.ticks_diff(self._deadline, time.ticks_ms())
+        if sleep_ms > 0:
+            self._wake_timer.init(mode=Timer.ONE_SHOT, period=sleep_ms, callback=self._signal)
+            self._event.acquire()
                 
     def run(self) -> None:
         while True:
-            self.check_servo()
+            woke_at = time.ticks_us()
             self.check_button()
-            
-            # Some functions are only called once per minute
-            (year,month,mday,weekday,hour,minute,second) = self.feeding_time_handler.rtc.datetime()
-            if (self.last_second-second) > 20:
-                print(f"Checking for {hour:02d}:{minute:02d}")
-                self.check_feeding_time(hour,minute)
-            self.last_second = second
+            if self._recheck or time.ticks_diff(time.ticks_ms(), self._deadline) >= 0:
+                self._recheck = False
+                self.check_feeding_time()
+            self.run_commands()
+            metrics.record_since(metrics.CONTROLLER_LOOP, woke_at)
+            self._sleep()
@@ -1,93 +1,191 @@
-from machine import Pin
+# Boot is staged: everything needed to feed comes up first, networking follows in the background.
+# The network modules are only imported by the tasks that need them.
+import time
+import machine
 from micropython import const
-from ds1307 import DS1307
+from ds1307 import DS1307, recover_bus
+from soft_clock import SoftClock
 from feeding_time_handler import FeedingTimeHandler
+from feeding_log import FeedingLog
 from beacon import Beacon
+from command_queue import POLICY_QUEUE
 from hardware_controller import HardwareController
-from tools import connect_wifi, sync_time, setup_server_socket
-import time
-import utime
-import ntptime
-import network
-import wifi_secrets
+from power import PowerManager
+from protocol import ClientHandler
+from time_sync import TimeSync
+from tools import connect_wifi
+import asyncio
+import metrics
 
-BEACON_INTERVAL_MS = const(1000)
+BEACON_CHECK_INTERVAL_MS = const(1000)
+LOOP_PROBE_INTERVAL_MS = const(1000)
+WIFI_CHECK_INTERVAL_MS = const(1000)
+SERVER_RETRY_INTERVAL_MS = const(5000)
+LOG_CHECK_INTERVAL_MS = const(60000)
+LOG_PATH = "feedings.log"
+SYNC_GUARD_MINUTES = const(5)
+DISPENSE_POLICY = POLICY_QUEUE # Manual runs requested while the servo is running wait for it, see command_queue.py.
+LOW_POWER = False # Light sleep between events, see power.py. Clients and the button are then served a little later.
 PORT = const(2390)
+I2C_SCL_PIN = const(17)
+I2C_SDA_PIN = const(16)
 
 network_present = False
+wlan = None
+boot_stage_ms = 0
+
+
+def boot_stage(name:str) -> None:
+    """Log the time since power-on at the end of a boot stage, and how long the stage took."""
+    global boot_stage_ms
+    now = time.ticks_ms()
+    print(f"Boot: {name} at {now} ms (+{time.ticks_diff(now, boot_stage_ms)} ms)")
+    boot_stage_ms = now
+
+
+def make_i2c():
+    return machine.I2C(0,
+                       scl=machine.Pin(I2C_SCL_PIN),
+                       sda=machine.Pin(I2C_SDA_PIN),
+                       freq=100000)
+
+
+def reset_i2c():
+    """Called by the RTC driver when the bus stops responding: free the bus and set up the controller again."""
+    recover_bus(I2C_SCL_PIN, I2C_SDA_PIN)
+    return make_i2c()
 
-i2c = machine.I2C(0,
-                  scl=machine.Pin(17),
-                  sda=machine.Pin(16),
-                  freq=100000)
-    
-rtc = DS1307(i2c)
-feeding_time_handler = FeedingTimeHandler(rtc)
-hardware_controller = HardwareController(21, 20, feeding_time_handler)
 
 print("Starting FishFeeder 3000!")
-print(f"RTC time: {rtc.get_weekday()} {rtc.get_formatted_time()}")
-
-print("Creating network object.")
-wlan = network.WLAN(network.STA_IF)
-print("activating WLAN")
-wlan.active(True)
-print("Connecting to WiFi")
-try:
-    connect_wifi(wlan, wifi_secrets.ssid, wifi_secrets.password)
-    network_present = True
-    print("Connected to network")
-except:
-    print("Could not connect to network, trying to carry on regardless.")
-    network_present = False
-    
-# Create a beacon that transmits the port we are listening on
-beacon = Beacon(str(PORT))
-beacon_deadline = time.ticks_add(time.ticks_ms(),BEACON_INTERVAL_MS)
-        
-sync_time(network_present, rtc)
-utime.sleep_ms(1000)
-serversocket = setup_server_socket(PORT)
-last_second = 0
-
-# Main loop
-while True:
-    if network_present and serversocket is not None:
+print(f"Reset cause: {machine.reset_cause()}")
+boot_stage("imports")
+rtc = DS1307(make_i2c(), recover=reset_i2c)
+feeding_time_handler = FeedingTimeHandler(rtc)
+boot_stage("schedule")
+clock = SoftClock(rtc)
+feeding_log = FeedingLog(LOG_PATH)
+boot_stage("feeding log")
+hardware_controller = HardwareController(21, 20, feeding_time_handler, clock, feeding_log=feeding_log,
+                                         guard_minutes=SYNC_GUARD_MINUTES, dispense_policy=DISPENSE_POLICY)
+boot_stage("ready to feed")
+print(f"RTC time: {clock.get_weekday_and_time()}")
+client_handler = ClientHandler(feeding_time_handler, hardware_controller, feeding_log)
+time_sync = TimeSync(clock, hardware_controller.scheduler)
+
+# Create a beacon that transmits the port we are listening on, and a summary of our state
+beacon = Beacon(PORT, machine.unique_id())
+
+power = PowerManager()
+power.add_deadline(hardware_controller.ms_until_due)
+power.add_deadline(client_handler.ms_until_due)
+power.add_deadline(time_sync.ms_until_due)
+# Keep trying to connect once a second while the network is down, and only send the beacon while it is up
+power.add_deadline(lambda: beacon.ms_until_due() if network_present else WIFI_CHECK_INTERVAL_MS)
+
+
+async def serve_client(reader, writer):
+    print(f"Got connection from {writer.get_extra_info('peername')}")
+    await client_handler.handle_client(reader, writer)
+
+
+async def server_task():
+    """Keep trying to create the server until it succeeds, the server then runs on its own."""
+    while True:
         try:
-            (clientsocket, address) = serversocket.accept()
-            clientsocket.settimeout(0.3)
-            print(f"Got connection from {address}")
-            feeding_time_handler.handle_client(clientsocket, hardware_controller)
+            print("Attempting to create server socket...")
+            await asyncio.start_server(serve_client, "0.0.0.0", PORT)
+            print("Server socket created.")
+            boot_stage("server")
+            return
         except OSError as e:
-            if e.errno == 110:
-                # This just means we timed out without getting a connection
-                pass
-            else:
-                print(f"Failure in main loop: {e}")
-
-        if time.ticks_diff(time.ticks_ms(),beacon_deadline)>=0:
-            beacon.send()
-            beacon_deadline = time.ticks_add(time.ticks_ms(),BEACON_INTERVAL_MS)
-            
-    if wlan.status() != 3 or not network_present:
-        print("Lost WiFi connection, reconnecting.")
-        try:
-            connect_wifi(wlan,wifi_secrets.ssid, wifi_secrets.password)
-            network_present = True
-        except Exception as e:
-            print(f"Could not connect to network {e}")
-            network_present = False
-    if serversocket is None:
-        print("Trying to set up server socket")
-        serversocket = setup_server_socket(PORT)
-    
-    # Some functions are only called once per minute
-    (year,month,mday,weekday,hour,minute,second) = rtc.datetime()
-    diff = last_second-second
-    if diff > 20:
-        # Time sync is carried out every hour, on the hour
-        # Time sync is NOT carried out if there's a feeding time within five minutes
-        # in either direction, to avoid double-feeding if the time is adjusted backwards.
-        if minute == 0 and feeding_time_handler.no_feeding_time_within_5_min():
-            sync_time(network_present, rtc)
-    last_second = second
\ No newline at end of file
+            print(f"Could not create server socket. Error: {e}")
+        await asyncio.sleep(SERVER_RETRY_INTERVAL_MS/1000)
+
+
+async def beacon_task():
+    """Keep the beacon up to date, and send it whenever it changes or its backoff interval has passed."""
+    while True:
+        beacon.update(feeding_time_handler.version, hardware_controller.servo_state,
+                      hardware_controller.next_feeding, time_sync.last_sync)
+        if network_present and beacon.send_if_due():
+            metrics.count(metrics.BEACON_SENDS)
+        # Check again when the beacon is due, if that is sooner, so it goes out as soon as the board wakes up for it
+        delay_ms = beacon.ms_until_due()
+        await asyncio.sleep((min(delay_ms, BEACON_CHECK_INTERVAL_MS) if delay_ms else BEACON_CHECK_INTERVAL_MS)/1000)
+
+
+async def wifi_task():
+    """Connect to WiFi, and reconnect whenever the connection is lost."""
+    global network_present, wlan
+    import network
+    import wifi_secrets
+    print("activating WLAN")
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    if LOW_POWER:
+        # Let the WiFi chip doze between beacons from the access point as well
+        wlan.config(pm=network.WLAN.PM_POWERSAVE)
+    boot_stage("wlan")
+    first_connection = True
+    while True:
+        if wlan.status() != 3 or not network_present:
+            print("Connecting to WiFi")
+            metrics.count(metrics.WIFI_RECONNECTS)
+            try:
+                await connect_wifi(wlan, wifi_secrets.ssid, wifi_secrets.password)
+                network_present = True
+                print("Connected to network")
+                if first_connection:
+                    first_connection = False
+                    boot_stage("network")
+            except Exception as e:
+                print(f"Could not connect to network {e}")
+                network_present = False
+        await asyncio.sleep(WIFI_CHECK_INTERVAL_MS/1000)
+
+
+async def sync_task():
+    """ Sync the time once the network is up, then as often as TimeSync thinks is needed.
+        Apart from the first one, syncs are NOT carried out if there's a feeding time within
+        SYNC_GUARD_MINUTES in either direction, to avoid double-feeding if the time is adjusted backwards.
+    """
+    def on_synced():
+        hardware_controller.wake()
+        if time_sync.syncs == 1:
+            boot_stage("time sync")
+    time_sync.add_listener(on_synced)
+    # The address lookup blocks the event loop, and the timer that stops the servo with it
+    await time_sync.run(lambda: network_present, lambda: not hardware_controller.is_running)
+
+
+async def log_task():
+    """Write the feeding log out to flash once enough records have built up, or they have waited long enough."""
+    while True:
+        await asyncio.sleep(LOG_CHECK_INTERVAL_MS/1000)
+        feeding_log.flush_if_due()
+
+
+async def loop_probe_task():
+    """Measure how late the event loop wakes a sleeping task, which shows when something blocks the loop."""
+    while True:
+        deadline = time.ticks_add(time.ticks_us(), LOOP_PROBE_INTERVAL_MS*1000)
+        await asyncio.sleep(LOOP_PROBE_INTERVAL_MS/1000)
+        metrics.record(metrics.MAIN_LOOP, max(0, time.ticks_diff(time.ticks_us(), deadline)))
+
+
+async def main():
+    if LOW_POWER:
+        # The probe would only measure the light sleeps
+        asyncio.create_task(power.run())
+    else:
+        asyncio.create_task(loop_probe_task())
+    asyncio.create_task(wifi_task())
+    asyncio.create_task(beacon_task())
+    asyncio.create_task(sync_task())
+    asyncio.create_task(log_task())
+    await server_task()
+    while True:
+        await asyncio.sleep(3600)
+
+
+asyncio.run(main())
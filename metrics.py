@@ -0,0 +1,136 @@
+"""Module that keeps fixed-size runtime statistics: counters, I2C traffic per register
+and latency histograms. Everything is preallocated, so recording never allocates.
+Updates from the two cores are not locked, an occasional lost count is acceptable.
+Every value is 32 bits and wraps around, the same on the board and under CPython.
+
+The statistics are encoded by encode() as a big-endian blob:
+    format version (1 byte)
+    counter count (1 byte), then each counter (4 bytes)
+    histogram count (1 byte), then for each histogram:
+        samples (4 bytes), total us (4 bytes), max us (4 bytes), bucket count (1 byte), buckets (4 bytes each)
+        Bucket i counts samples below 2**i us, the last bucket also counts everything above.
+    register count (1 byte), then for each register with traffic:
+        register (1 byte), transactions (4 bytes), retries (4 bytes)
+"""
+
+from micropython import const
+import array
+import struct
+import time
+
+FORMAT_VERSION = const(1)
+
+# Counters
+BEACON_SENDS    = const(0)
+WIFI_RECONNECTS = const(1)
+CLIENTS         = const(2)
+BUS_FAULTS      = const(3) # Times the I2C circuit breaker opened.
+LOG_DROPS       = const(4) # Feeding log records lost because too many were waiting to be written.
+TIME_SYNCS      = const(5) # Successful NTP syncs.
+COMMAND_DROPS   = const(6) # Dispense commands dropped, because the queue was full or by the dispense policy.
+COMMAND_QUEUE_PEAK = const(7) # Most dispense commands waiting at once. A high-water mark, not a count.
+NOTIFICATIONS   = const(8) # Notification frames sent to open sessions.
+SLEEPS          = const(9) # Light sleeps, see power.py.
+SLEEP_MS        = const(10) # Time spent in light sleep, in ms...
+AWAKE_MS        = const(11) # ...and awake, since the first sleep. Together they give the duty cycle.
+NUM_COUNTERS    = const(12)
+
+# Histograms
+MUTEX_WAIT      = const(0) # Time spent waiting for the I2C mutex.
+MAIN_LOOP       = const(1) # How late the main event loop runs a task that asked to wake up.
+CONTROLLER_LOOP = const(2) # Time the controller thread spends per wake-up.
+CLIENT_LATENCY  = const(3) # Time to handle a client connection.
+NTP_DELAY       = const(4) # Round-trip delay of NTP requests.
+WAKE_LATENCY    = const(5) # How late the board wakes up from light sleep for a deadline.
+NUM_HISTOGRAMS  = const(6)
+NUM_BUCKETS     = const(20)
+HISTOGRAM_SIZE  = const(23) # samples, total, max, buckets
+
+NUM_REGISTERS   = const(64)
+
+counters = array.array('L', [0]*NUM_COUNTERS)
+histograms = array.array('L', [0]*(NUM_HISTOGRAMS*HISTOGRAM_SIZE))
+i2c_transactions = array.array('L', [0]*NUM_REGISTERS)
+i2c_retries = array.array('L', [0]*NUM_REGISTERS)
+
+
+def count(counter:int) -> None:
+    counters[counter] = (counters[counter]+1) & 0xFFFFFFFF
+
+
+def add(counter:int, value:int) -> None:
+    """Add value to a counter, which wraps around at 32 bits."""
+    counters[counter] = (counters[counter]+value) & 0xFFFFFFFF
+
+
+def peak(counter:int, value:int) -> None:
+    """Raise a high-water mark kept in a counter to value."""
+    if value > counters[counter]:
+        counters[counter] = value
+
+
+def record(histogram:int, us:int) -> None:
+    """Add a sample, in microseconds, to a histogram."""
+    base = histogram*HISTOGRAM_SIZE
+    histograms[base] = (histograms[base]+1) & 0xFFFFFFFF
+    histograms[base+1] = (histograms[base+1]+us) & 0xFFFFFFFF
+    if us > histograms[base+2]:
+        histograms[base+2] = min(us, 0xFFFFFFFF)
+    bucket = 0
+    while us > 0 and bucket < NUM_BUCKETS-1:
+        us >>= 1
+        bucket += 1
+    histograms[base+3+bucket] = (histograms[base+3+bucket]+1) & 0xFFFFFFFF
+
+
+def record_since(histogram:int, start_us:int) -> None:
+    """Add the time since start_us, taken from time.ticks_us(), to a histogram."""
+    record(histogram, time.ticks_diff(time.ticks_us(), start_us))
+
+
+def count_i2c(register:int, retries:int=0) -> None:
+    register %= NUM_REGISTERS
+    i2c_transactions[register] = (i2c_transactions[register]+1) & 0xFFFFFFFF
+    if retries:
+        i2c_retries[register] = (i2c_retries[register]+retries) & 0xFFFFFFFF
+
+
+def reset() -> None:
+    for values in (counters, histograms, i2c_transactions, i2c_retries):
+        for i in range(len(values)):
+            values[i] = 0
+
+
+def encoded_size() -> int:
+    """Length of the blob encode() would return now."""
+    registers = 0
+    for register in range(NUM_REGISTERS):
+        registers += i2c_transactions[register] > 0
+    return 3 + 4*NUM_COUNTERS + 1 + NUM_HISTOGRAMS*(13+4*NUM_BUCKETS) + 1 + 9*registers
+
+
+def encode() -> bytes:
+    """Encode all statistics as a compact binary blob."""
+    registers = [register for register in range(NUM_REGISTERS) if i2c_transactions[register]]
+    blob = bytearray(encoded_size())
+    blob[0] = FORMAT_VERSION
+    blob[1] = NUM_COUNTERS
+    position = 2
+    for value in counters:
+        struct.pack_into(">L", blob, position, value)
+        position += 4
+    blob[position] = NUM_HISTOGRAMS
+    position += 1
+    for histogram in range(NUM_HISTOGRAMS):
+        base = histogram*HISTOGRAM_SIZE
+        struct.pack_into(">LLLB", blob, position, histograms[base], histograms[base+1], histograms[base+2], NUM_BUCKETS)
+        position += 13
+        for bucket in range(NUM_BUCKETS):
+            struct.pack_into(">L", blob, position, histograms[base+3+bucket])
+            position += 4
+    blob[position] = len(registers)
+    position += 1
+    for register in registers:
+        struct.pack_into(">BLL", blob, position, register, i2c_transactions[register], i2c_retries[register])
+        position += 9
+    return blob
@@ -0,0 +1,83 @@
+"""Module that puts the board in light sleep while there is nothing to do.
+
+Everything that needs the CPU at a certain time registers a deadline with add_deadline(): a function
+returning the ms until it next needs to run, 0 if it is busy right now, or None if it has nothing planned.
+Once the event loop has run the tasks that are ready, run() sleeps with machine.lightsleep() until the
+earliest deadline, and at most MAX_SLEEP_MS. Tasks that poll on a fixed interval are simply late while
+the board sleeps. The button interrupt and the WiFi chip wake the board early, so a press or a client
+is only held up by the time it takes the clocks to start again.
+
+The time spent awake and asleep, the number of sleeps and how late the board wakes up for a deadline
+are kept in the statistics, see metrics.py.
+"""
+
+from micropython import const
+import asyncio
+import machine
+import metrics
+import time
+
+MIN_SLEEP_MS   = const(20)    # Not worth going to sleep for less.
+MAX_SLEEP_MS   = const(60000) # Wake up at least this often, for the tasks that have no deadline.
+CHECK_INTERVAL_MS = const(10) # How long to let the other tasks run before looking for a chance to sleep.
+
+class PowerManager:
+    def __init__(self, max_sleep_ms:int=MAX_SLEEP_MS):
+        self.max_sleep_ms = max_sleep_ms
+        self._deadlines = []
+        self.sleeps = 0
+        self.early_wakes = 0
+        # Time spent awake and asleep since the power manager was created, in ms
+        self.awake_ms = 0
+        self.slept_ms = 0
+        self._awake_since = time.ticks_ms()
+
+    def add_deadline(self, deadline) -> None:
+        """ deadline() returns the ms until its owner next needs to run, 0 if it is busy,
+            or None if it has nothing planned.
+        """
+        self._deadlines.append(deadline)
+
+    def ms_until_due(self) -> int:
+        """ms until the earliest deadline, at most max_sleep_ms."""
+        sleep_ms = self.max_sleep_ms
+        for deadline in self._deadlines:
+            ms = deadline()
+            if ms is not None and ms < sleep_ms:
+                sleep_ms = ms
+        return sleep_ms
+
+    @property
+    def duty_cycle(self) -> float:
+        """Share of the time spent awake."""
+        awake_ms = self.awake_ms + time.ticks_diff(time.ticks_ms(), self._awake_since)
+        return awake_ms/(awake_ms+self.slept_ms)
+
+    def sleep(self, ms:int) -> None:
+        """Sleep for ms, or until an interrupt wakes the board up."""
+        started = time.ticks_ms()
+        awake_ms = time.ticks_diff(started, self._awake_since)
+        self.awake_ms += awake_ms
+        metrics.add(metrics.AWAKE_MS, awake_ms)
+        started_us = time.ticks_us()
+        machine.lightsleep(ms)
+        slept_us = time.ticks_diff(time.ticks_us(), started_us)
+        self._awake_since = time.ticks_ms()
+        slept_ms = time.ticks_diff(self._awake_since, started)
+        self.slept_ms += slept_ms
+        self.sleeps += 1
+        metrics.add(metrics.SLEEP_MS, slept_ms)
+        metrics.count(metrics.SLEEPS)
+        if slept_us < ms*1000:
+            # Woken up by an interrupt, there is no deadline to be late for
+            self.early_wakes += 1
+        else:
+            metrics.record(metrics.WAKE_LATENCY, slept_us-ms*1000)
+
+    async def run(self) -> None:
+        """Sleep whenever nothing needs doing for at least MIN_SLEEP_MS, forever."""
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL_MS/1000)
+            sleep_ms = self.ms_until_due()
+            if sleep_ms >= MIN_SLEEP_MS:
+                self.sleep(sleep_ms)
@@ -0,0 +1,431 @@
+"""Module that serves network clients.
+
+Two request formats are understood. The original one is a single command per connection:
+    'u'                              send the schedule
+    'c' slot hour minute deciseconds set a feeding time, then send the schedule
+    'd' slot                         erase a feeding time, then send the schedule
+    'm' deciseconds                  run the servo, see command_queue.py for what happens if it is running
+    's'                              send the runtime statistics, see metrics.py
+    'l' cursor                       send the feeding log records from a 32 bit sequence number onwards,
+                                     see feeding_log.py. Records that have been overwritten are skipped.
+The schedule is sent as 18 slots of hour, minute, deciseconds.
+
+Version 2 frames start with the byte 0x02, followed by a big-endian 16 bit payload length
+and a payload holding any number of the commands above, without the implicit schedule replies,
+plus 'v' followed by a big-endian 32 bit schedule version. The 'l' cursor is big-endian as well. All edits in a frame are validated
+first and then committed to NVRAM together, or not at all. A frame whose replies could add up to more than
+MAX_REPLY_SIZE is refused as invalid.
+The reply is a frame with the same header and a payload of:
+    status (1 byte), schedule version (4 bytes), then for each query command in order:
+    'u': the 54 byte schedule
+    's': the length of the statistics (2 bytes), then the statistics. At most one 's' per frame.
+    'v': a slot count, then slot, hour, minute, deciseconds for each slot changed since the version.
+         The count is 255 if the version is unknown, followed by the full schedule.
+    'l': a record count, then up to LOG_RECORDS_PER_FRAME records. Ask again from the sequence
+         number after the last record to get the rest; a count of 0 means there are no more.
+
+A frame holding 'o' opens a session: the connection then stays open for more frames, until the
+client closes it or sends nothing for SESSION_TIMEOUT_S. At most MAX_SESSIONS are open at once,
+a frame that would open one more is refused with STATUS_BUSY.
+While a session is open the device also sends notification frames, with the status
+STATUS_NOTIFICATION and the schedule version like a reply, followed by one event:
+    'v': the schedule changed, the new version is in the header. Fetch the changes with 'v'.
+    'm': a dispense started, then its source (1 byte, see feeding_log.py) and requested ms (4 bytes)
+    'x': a dispense stopped, then how long it ran, in ms (4 bytes)
+    'k': nothing happened for KEEPALIVE_S
+Every dispense gets an 'm' and then an 'x', in the order they ran, with the values of that dispense.
+Notifications are only sent between replies, never in the middle of one.
+"""
+
+from feeding_log import FeedingLog, RECORD_SIZE
+from feeding_time_handler import FeedingTimeHandler
+from hardware_controller import HardwareController
+from micropython import const
+import asyncio
+import metrics
+import struct
+import time
+
+CLIENT_TIMEOUT_S = const(1) # Give up on a client that sends nothing for this long.
+
+PROTOCOL_V2    = const(2)
+MAX_FRAME_SIZE = const(512)
+MAX_REPLY_SIZE = const(2048) # Most payload bytes in a reply, frames asking for more are refused.
+FULL_SCHEDULE  = const(255) # Slot count in a 'v' reply that means the full schedule follows.
+LOG_RECORDS_PER_FRAME = const(16) # Most feeding log records in a version 2 reply.
+LOG_CHUNK_RECORDS     = const(16) # Feeding log records read from flash at a time when streaming.
+
+MAX_SESSIONS       = const(4)   # Sessions open at once, each one holds a socket and its buffers.
+SESSION_TIMEOUT_S  = const(600) # Close a session the client has sent nothing on for this long.
+KEEPALIVE_S        = const(30)  # Send a keepalive on a session nothing has been sent on for this long.
+NOTIFY_INTERVAL_MS = const(100) # How often to check for events to notify sessions of.
+
+STATUS_OK        = const(0)
+STATUS_MALFORMED = const(1)
+STATUS_INVALID   = const(2)
+STATUS_BUSY      = const(3)
+STATUS_NOTIFICATION = const(4)
+
+NOTIFY_SCHEDULE       = const(0x76) # 'v'
+NOTIFY_DISPENSE_START = const(0x6D) # 'm'
+NOTIFY_DISPENSE_STOP  = const(0x78) # 'x'
+NOTIFY_KEEPALIVE      = const(0x6B) # 'k'
+
+# Number of argument bytes following each opcode
+ARGUMENT_LENGTHS = {
+    ord('u'): 0,
+    ord('c'): 4,
+    ord('d'): 1,
+    ord('m'): 1,
+    ord('v'): 4,
+    ord('s'): 0,
+    ord('l'): 4,
+    ord('o'): 0,
+}
+
+class ClientHandler:
+    def __init__(self, feeding_time_handler:FeedingTimeHandler, hardware_controller:HardwareController,
+                 feeding_log:FeedingLog):
+        self.feeding_time_handler = feeding_time_handler
+        self.hardware_controller = hardware_controller
+        self.feeding_log = feeding_log
+        # Open sessions, as [writer, ticks_ms of the last frame sent, lock held while sending a frame]
+        self._sessions = []
+        # Sessions that have been granted but whose reply is still being sent
+        self._opening = 0
+        self._notifier = None
+        # The schedule version and dispense counts the sessions were last told about
+        self._version = feeding_time_handler.version
+        self._starts = hardware_controller.dispense_starts
+        self._stops = hardware_controller.dispense_count
+        # Connections being served, not counting sessions waiting for their next frame
+        self._busy = 0
+
+    async def handle_client(self, reader, writer) -> None:
+        """Read the request from the client and react accordingly."""
+        started = time.ticks_us()
+        metrics.count(metrics.CLIENTS)
+        session = None
+        self._busy += 1
+        try:
+            request = await asyncio.wait_for(reader.read(1), CLIENT_TIMEOUT_S)
+            if request == bytes([PROTOCOL_V2]):
+                if await self._handle_frame(reader, writer, None):
+                    session = [writer, time.ticks_ms(), asyncio.Lock()]
+                    # Take over the slot _handle_frame reserved
+                    self._opening -= 1
+                    self._sessions.append(session)
+                    if self._notifier is None:
+                        # Only events from now on are news to the sessions
+                        self._version = self.feeding_time_handler.version
+                        self._starts = self.hardware_controller.dispense_starts
+                        self._stops = self.hardware_controller.dispense_count
+                        self._notifier = asyncio.create_task(self._notify_sessions())
+                    metrics.record_since(metrics.CLIENT_LATENCY, started)
+                    await self._run_session(reader, writer, session)
+                    return
+            else:
+                await self._handle_legacy(request, reader, writer)
+            metrics.record_since(metrics.CLIENT_LATENCY, started)
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+            print(f"Failed to handle client: {e}")
+        finally:
+            self._busy -= 1
+            if session is not None:
+                self._sessions.remove(session)
+                # Stop polling while no session is open, so the board can sleep
+                if not self._sessions and self._notifier is not None:
+                    self._notifier.cancel()
+                    self._notifier = None
+            writer.close()
+            await writer.wait_closed()
+
+    async def _run_session(self, reader, writer, session:list) -> None:
+        """Handle frames on an open session until the client closes it or goes quiet."""
+        while True:
+            self._busy -= 1
+            try:
+                request = await asyncio.wait_for(reader.read(1), SESSION_TIMEOUT_S)
+            finally:
+                self._busy += 1
+            if not request:
+                return
+            started = time.ticks_us()
+            if request != bytes([PROTOCOL_V2]):
+                await self._send_frame(writer, STATUS_MALFORMED, [], session)
+                return
+            await self._handle_frame(reader, writer, session)
+            metrics.record_since(metrics.CLIENT_LATENCY, started)
+
+    def ms_until_due(self) -> int:
+        """ ms until the notifier next has something to send, 0 while a client is being served
+            or there are events to tell the sessions about. None if no session is open.
+        """
+        if self._busy:
+            return 0
+        if not self._sessions:
+            return None
+        controller = self.hardware_controller
+        if (self.feeding_time_handler.version != self._version or controller.dispense_starts != self._starts
+                or controller.dispense_count != self._stops):
+            return 0
+        now = time.ticks_ms()
+        due_ms = KEEPALIVE_S*1000
+        for session in self._sessions:
+            due_ms = min(due_ms, KEEPALIVE_S*1000 - time.ticks_diff(now, session[1]))
+        return max(due_ms, 0)
+
+    async def _notify_sessions(self) -> None:
+        """ Send the open sessions a notification for every event, and keepalives in between.
+            Runs while any session is open.
+        """
+        handler = self.feeding_time_handler
+        while True:
+            await asyncio.sleep(NOTIFY_INTERVAL_MS/1000)
+            if handler.version != self._version:
+                self._version = handler.version
+                await self._notify(struct.pack(">B", NOTIFY_SCHEDULE))
+            await self._notify_dispenses()
+            now = time.ticks_ms()
+            for session in self._sessions:
+                if time.ticks_diff(now, session[1]) >= KEEPALIVE_S*1000:
+                    await self._send_notification(session, bytes([NOTIFY_KEEPALIVE]))
+
+    async def _notify_dispenses(self) -> None:
+        """ Send a start and a stop notification for each dispense since the last ones sent, in order,
+            even when several happened between two checks.
+        """
+        controller = self.hardware_controller
+        while True:
+            if self._stops < self._starts and self._stops < controller.dispense_count:
+                self._stops += 1
+                record = controller.dispense_record(self._stops)
+                event = None if record is None else struct.pack(">BL", NOTIFY_DISPENSE_STOP, record[2])
+            elif self._starts < controller.dispense_starts:
+                self._starts += 1
+                record = controller.dispense_record(self._starts)
+                event = None if record is None else struct.pack(">BBL", NOTIFY_DISPENSE_START, record[0], record[1])
+            else:
+                return
+            # A dispense too old to be kept is skipped, the sessions were too slow to be told of it
+            if event is not None:
+                await self._notify(event)
+
+    async def _notify(self, event:bytes) -> None:
+        # Copy the list, a session may close while this one is being written to
+        for session in list(self._sessions):
+            await self._send_notification(session, event)
+
+    async def _send_notification(self, session:list, event:bytes) -> None:
+        try:
+            await asyncio.wait_for(self._send_frame(session[0], STATUS_NOTIFICATION, [event], session), CLIENT_TIMEOUT_S)
+            metrics.count(metrics.NOTIFICATIONS)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"Closing session: {e}")
+            session[0].close()
+
+    async def _handle_legacy(self, request:bytes, reader, writer) -> None:
+        """Handle a single command in the original format."""
+        handler = self.feeding_time_handler
+        if request == b'u':
+            # Update
+            await self._send_data(writer)
+        elif request == b'c':
+            # Create
+            (time_slot, hour, minute, deciseconds) = await self._read(reader, 4)
+            handler.set_feeding_time(time_slot, hour, minute, deciseconds)
+            await self._send_data(writer)
+        elif request == b'd':
+            # Delete
+            time_slot = (await self._read(reader, 1))[0]
+            handler.erase_feeding_time(time_slot)
+            await self._send_data(writer)
+        elif request == b'm':
+            # Manual running
+            millis = (await self._read(reader, 1))[0]*100
+            print(f"Manual running for {millis} ms.")
+            if not self.hardware_controller.request_dispense(millis):
+                print("Command queue full, manual run dropped.")
+        elif request == b's':
+            # Statistics
+            writer.write(metrics.encode())
+            await writer.drain()
+        elif request == b'l':
+            # Feeding log
+            cursor = struct.unpack(">L", await self._read(reader, 4))[0]
+            await self._send_log(writer, cursor)
+
+    async def _handle_frame(self, reader, writer, session:list) -> bool:
+        """ Handle a version 2 frame. The header byte has already been read.
+            session is the open session the frame came on, if any.
+            Returns True if the frame opens a session.
+        """
+        length = struct.unpack(">H", await self._read(reader, 2))[0]
+        if length > MAX_FRAME_SIZE:
+            await self._send_frame(writer, STATUS_MALFORMED, [], session)
+            return False
+        payload = await self._read(reader, length) if length else b''
+        commands = self._parse(payload)
+        if commands is None:
+            await self._send_frame(writer, STATUS_MALFORMED, [], session)
+            return False
+        if not self._validate(commands):
+            await self._send_frame(writer, STATUS_INVALID, [], session)
+            return False
+        opens_session = False
+        if session is None:
+            for (opcode, arguments) in commands:
+                opens_session |= opcode == ord('o')
+            if opens_session and len(self._sessions)+self._opening >= MAX_SESSIONS:
+                await self._send_frame(writer, STATUS_BUSY, [])
+                return False
+        if opens_session:
+            # Reserve the slot before anything yields, or concurrent frames could all pass the check
+            self._opening += 1
+        try:
+            await self._run_frame(writer, session, commands)
+        except:
+            # Release the slot if the reply could not be sent
+            if opens_session:
+                self._opening -= 1
+            raise
+        return opens_session
+
+    async def _run_frame(self, writer, session:list, commands:list) -> None:
+        """Carry out the commands of a valid frame and send the reply."""
+        handler = self.feeding_time_handler
+        handler.begin_batch()
+        try:
+            for (opcode, arguments) in commands:
+                if opcode == ord('c'):
+                    handler.set_feeding_time(arguments[0], arguments[1], arguments[2], arguments[3])
+                elif opcode == ord('d'):
+                    handler.erase_feeding_time(arguments[0])
+        finally:
+            handler.commit()
+        replies = []
+        for (opcode, arguments) in commands:
+            if opcode == ord('u'):
+                replies.append(handler.schedule)
+            elif opcode == ord('v'):
+                replies.append(self._encode_changes(struct.unpack(">L", arguments)[0]))
+            elif opcode == ord('s'):
+                stats = metrics.encode()
+                replies.append(struct.pack(">H", len(stats)) + stats)
+            elif opcode == ord('l'):
+                replies.append(self._encode_log(struct.unpack(">L", arguments)[0]))
+            elif opcode == ord('m'):
+                millis = arguments[0]*100
+                print(f"Manual running for {millis} ms.")
+                if not self.hardware_controller.request_dispense(millis):
+                    print("Command queue full, manual run dropped.")
+        await self._send_frame(writer, STATUS_OK, replies, session)
+
+    def _parse(self, payload:bytes) -> list:
+        """Split a payload into (opcode, arguments) pairs, or return None if it is malformed."""
+        commands = []
+        position = 0
+        view = memoryview(payload)
+        while position < len(payload):
+            opcode = payload[position]
+            arguments = ARGUMENT_LENGTHS.get(opcode)
+            if arguments is None or position+1+arguments > len(payload):
+                return None
+            commands.append((opcode, view[position+1:position+1+arguments]))
+            position += 1+arguments
+        return commands
+
+    def _validate(self, commands:list) -> bool:
+        """ Check every edit in a frame before any is made. A feeding time must be one that
+            FeedingTimeHandler accepts on boot, or the whole schedule would be wiped then.
+        """
+        num_slots = self.feeding_time_handler.num_slots
+        schedule_size = len(self.feeding_time_handler.schedule)
+        # The longest the reply can get, it is built in RAM before it is sent
+        reply_size = 5
+        statistics = False
+        for (opcode, arguments) in commands:
+            if opcode == ord('u'):
+                reply_size += schedule_size
+            elif opcode == ord('v'):
+                reply_size += 1+max(schedule_size, 4*num_slots)
+            elif opcode == ord('l'):
+                reply_size += 1+LOG_RECORDS_PER_FRAME*RECORD_SIZE
+            elif opcode == ord('s'):
+                if statistics:
+                    return False
+                statistics = True
+                reply_size += 2+metrics.encoded_size()
+            if reply_size > MAX_REPLY_SIZE:
+                return False
+            if (opcode == ord('c') or opcode == ord('d')) and arguments[0] >= num_slots:
+                return False
+            if opcode == ord('c'):
+                (hour, minute, deciseconds) = (arguments[1], arguments[2], arguments[3])
+                unused = hour == 255 and minute == 255 and deciseconds == 255
+                if not unused and not (hour < 24 and minute < 60 and deciseconds > 0):
+                    return False
+        return True
+
+    def _encode_changes(self, version:int) -> bytes:
+        handler = self.feeding_time_handler
+        slots = handler.changes_since(version)
+        if slots is None:
+            return bytes([FULL_SCHEDULE]) + bytes(handler.schedule)
+        reply = bytearray(1+4*len(slots))
+        reply[0] = len(slots)
+        position = 1
+        for slot in slots:
+            reply[position] = slot
+            reply[position+1:position+4] = bytes(handler.get_feeding_time(slot))
+            position += 4
+        return reply
+
+    def _encode_log(self, cursor:int) -> bytes:
+        log = self.feeding_log
+        log.flush()
+        reply = bytearray(1+LOG_RECORDS_PER_FRAME*RECORD_SIZE)
+        count = log.read_into(cursor, memoryview(reply)[1:])
+        reply[0] = count
+        return memoryview(reply)[:1+count*RECORD_SIZE]
+
+    async def _send_log(self, writer, cursor:int) -> None:
+        """Stream the feeding log from cursor to the end, a chunk at a time."""
+        log = self.feeding_log
+        log.flush()
+        chunk = bytearray(LOG_CHUNK_RECORDS*RECORD_SIZE)
+        while True:
+            count = log.read_into(cursor, chunk)
+            if count == 0:
+                break
+            writer.write(memoryview(chunk)[:count*RECORD_SIZE])
+            await writer.drain()
+            # Carry on after the last record sent
+            cursor = struct.unpack_from(">L", chunk, (count-1)*RECORD_SIZE)[0]+1
+
+    async def _read(self, reader, length:int) -> bytes:
+        return await asyncio.wait_for(reader.readexactly(length), CLIENT_TIMEOUT_S)
+
+    async def _send_data(self, writer) -> None:
+        writer.write(self.feeding_time_handler.schedule)
+        await writer.drain()
+
+    async def _send_frame(self, writer, status:int, replies:list, session:list=None) -> None:
+        """ Send a version 2 frame. session is the open session it is sent on, if any,
+            replies and notifications on a session take turns so they are never interleaved.
+        """
+        if session is None:
+            await self._write_frame(writer, status, replies)
+            return
+        async with session[2]:
+            session[1] = time.ticks_ms()
+            await self._write_frame(writer, status, replies)
+
+    async def _write_frame(self, writer, status:int, replies:list) -> None:
+        payload_length = 5
+        for reply in replies:
+            payload_length += len(reply)
+        writer.write(struct.pack(">BHBL", PROTOCOL_V2, payload_length, status, self.feeding_time_handler.version))
+        for reply in replies:
+            writer.write(reply)
+        await writer.drain()
@@ -0,0 +1,97 @@
+"""Host-side simulator that runs the firmware unmodified under CPython.
+
+The packages under sim/modules stand in for the MicroPython-only modules
+(machine, network, micropython, utime, wifi_secrets), and a replacement
+_thread lets the simulator see when firmware threads are blocked.
+All of them run off a SimClock, which either follows real time or is
+stepped explicitly, event by event, for fast and deterministic runs.
+asyncio event loops run off the SimClock as well, and NTP requests for
+NTP_HOSTS go to a local stand-in server, sim.sntp_server.
+
+    import sim
+    sim.install(speed=0)      # before importing any firmware module
+    from ds1307 import DS1307
+    ...
+    sim.clock.run_for(86400*1000)
+
+The board's flash file system is a directory, which install() makes the current directory.
+
+Use python -m sim to run main.py, and python -m sim.bench for the benchmarks.
+"""
+
+import os
+import sys
+import tempfile
+
+from sim.simclock import SimClock
+
+MODULES_PATH = os.path.join(os.path.dirname(__file__), "modules")
+FIRMWARE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+clock = None # The active SimClock, set by install()
+rtc = None   # The active DS1307 model, set by install()
+flash_path = None # The directory standing in for the flash file system, set by install()
+ntp_server = None # The stand-in NTP server, set by install()
+NTP_HOSTS = ("pool.ntp.org",)
+
+
+def install(speed:float=1.0, start:tuple=(2026, 1, 1, 0, 0, 0), rtc_start:tuple=None,
+            rtc_drift_ppm:float=0.0, nvram:bytes=None, flash:str=None) -> SimClock:
+    """ Put the stand-in modules in place. Must be called before any firmware module is imported.
+        speed is the rate of the simulated clock relative to real time; 0 means it only moves
+        when stepped with SimClock.advance() or SimClock.run_for().
+        start is the true wall time at the start, rtc_start the time the DS1307 shows (default start).
+        nvram is the initial DS1307 RAM content, None leaves it scrambled as after first power-on.
+        flash is the directory to use as the flash file system, a new empty one if not given.
+    """
+    global clock, rtc, flash_path, ntp_server
+    # Make sure the host's own users of _thread have the real one before it is replaced
+    import threading
+    import asyncio
+    from sim import thread
+    from sim.ds1307_model import DS1307Model
+    from sim.simloop import SimEventLoopPolicy
+    from sim.sntp_server import SntpServer
+    clock = SimClock(speed, start)
+    rtc = DS1307Model(clock, rtc_start or start, rtc_drift_ppm, nvram)
+    for path in (FIRMWARE_PATH, MODULES_PATH):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    sys.modules["_thread"] = thread
+    import machine
+    machine.I2C.devices[0x68] = rtc
+    flash_path = flash or tempfile.mkdtemp(prefix="fishfeeder-flash-")
+    os.chdir(flash_path)
+    _patch_time()
+    asyncio.set_event_loop_policy(SimEventLoopPolicy())
+    ntp_server = SntpServer(clock)
+    _patch_getaddrinfo()
+    return clock
+
+
+def _patch_time() -> None:
+    """Add the MicroPython time functions to the host's time module."""
+    import time
+    import utime
+    for name in ("ticks_ms", "ticks_us", "ticks_add", "ticks_diff", "sleep_ms", "sleep_us"):
+        setattr(time, name, getattr(utime, name))
+    host_gmtime = time.gmtime
+
+    def gmtime(secs=None):
+        # MicroPython returns an 8-tuple of the board's own wall time
+        if secs is None:
+            return utime.gmtime()
+        return host_gmtime(secs)
+    time.gmtime = gmtime
+
+
+def _patch_getaddrinfo() -> None:
+    """Resolve the NTP server names to the stand-in server."""
+    import socket
+    host_getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host in NTP_HOSTS:
+            (host, port) = ntp_server.address
+        return host_getaddrinfo(host, port, *args, **kwargs)
+    socket.getaddrinfo = getaddrinfo
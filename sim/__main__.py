@@ -0,0 +1,74 @@
+"""Run a firmware script, main.py by default, in the simulator.
+
+    python -m sim [--speed S] [--duration SECONDS] [--stats] [--nvram HEX] [--flash DIR] [script]
+
+With --duration the run stops after that many real seconds. With --stats a line starting
+with SIM-STATS and holding a JSON object is printed at the end.
+"""
+
+import argparse
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+
+import sim
+
+STATS_PREFIX = "SIM-STATS "
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m sim", description=__doc__.splitlines()[0])
+    parser.add_argument("script", nargs="?", default=os.path.join(sim.FIRMWARE_PATH, "main.py"))
+    parser.add_argument("--speed", type=float, default=1.0, help="simulated clock rate relative to real time")
+    parser.add_argument("--duration", type=float, help="stop after this many real seconds")
+    parser.add_argument("--stats", action="store_true", help="print run statistics at the end")
+    parser.add_argument("--nvram", help="initial DS1307 RAM as hex, scrambled if not given")
+    parser.add_argument("--flash", help="directory holding the flash file system, a new one if not given")
+    args = parser.parse_args()
+
+    nvram = bytes.fromhex(args.nvram) if args.nvram else None
+    # The simulator changes into the flash directory
+    args.script = os.path.abspath(args.script)
+    clock = sim.install(speed=args.speed, nvram=nvram, flash=args.flash and os.path.abspath(args.flash))
+    started = time.monotonic()
+    loop_iterations = _count_event_loop_iterations() if args.stats else None
+
+    def finish():
+        if args.stats:
+            import machine
+            elapsed = time.monotonic()-started
+            stats = {
+                "real_seconds": elapsed,
+                "simulated_seconds": clock.now_ms()/1000,
+                "i2c_transactions": machine.I2C.stats["transactions"],
+                "event_loop_iterations": loop_iterations[0],
+            }
+            print(STATS_PREFIX + json.dumps(stats), flush=True)
+        sys.stdout.flush()
+        os._exit(0)
+
+    if args.duration is not None:
+        threading.Timer(args.duration, finish).start()
+    sys.argv = [args.script]
+    runpy.run_path(args.script, run_name="__main__")
+    finish()
+
+
+def _count_event_loop_iterations() -> list:
+    """Count the iterations of the host's asyncio event loop, the firmware's main loop."""
+    import asyncio.base_events
+    counter = [0]
+    run_once = asyncio.base_events.BaseEventLoop._run_once
+
+    def counting_run_once(self):
+        counter[0] += 1
+        run_once(self)
+    asyncio.base_events.BaseEventLoop._run_once = counting_run_once
+    return counter
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,879 @@
+"""Benchmarks for the firmware, run in the simulator.
+
+    python -m sim.bench [--json FILE]
+
+Reports, on a stepped simulated clock:
+    I2C traffic and controller wake-ups per simulated minute, and feeding time accuracy over a day
+    the cost and correctness of the minute-of-day index
+    memory allocated by each way of reading the time, and that they agree
+    request latency and I2C cost for each client opcode
+    how the RTC driver copes with a wedged bus
+    beacon traffic and freshness
+    feeding log completeness and flash writes
+    how manual runs sent while the servo is running are handled under each dispense policy
+    request latency on an open session, and how soon sessions are notified of events
+    NTP sync frequency and the RTC drift estimate, against a drifting DS1307
+    the duty cycle in light sleep, and how quickly a timer, the button and a client wake the board up
+and, from real-time runs in separate processes, the boot time and main loop iterations per second
+of main.py, and how long the fleet tool takes to find a set of stand-in feeders and deploy a schedule.
+Every metric is checked against the limits in bench_baseline.json, and the exit status
+is 1 if any of them is exceeded.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import sim
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+
+START = (2026, 3, 1, 6, 0, 0)
+SERVO_PIN = 21
+BUTTON_PIN = 20
+DISPENSE_DUTY_NS = 700000
+STOPPED_DUTY_NS = 1500000
+# (hour, minute, deciseconds), crossing midnight on purpose
+SCHEDULE = ((7, 0, 30), (12, 30, 10), (18, 45, 25), (23, 59, 5), (0, 0, 5), (5, 15, 20))
+REQUESTS_PER_OPCODE = 50
+BUS_FAULT_POLL_MS = 100
+BEACON_CHECK_MS = 1000
+LOG_CHECK_MS = 60000
+BUTTON_BURST = 8
+COMMAND_BURST = 5
+COMMAND_MS = 500
+COMMAND_GAP_MS = 100
+BOOT_READY_PREFIX = "Boot: ready to feed at "
+ALLOCATION_CALLS = 20
+RTC_DRIFT_PPM = 25
+TIME_SYNC_DAYS = 3
+CLOCK_SAMPLE_S = 600
+FLEET_SIZE = 8
+FLEET_DELAY_MS = 20
+FLEET_FAIL_RATE = 0.2
+FLEET_SCHEDULE = ((6, 30, 20), (12, 0, 10), (19, 15, 255))  # The longest run a slot can hold.
+NOTIFICATION_TIMEOUT_S = 5
+POWER_HOURS = 2
+POWER_FEEDING_MINUTES = 90 # Into the low-power run, when a feeding is added...
+POWER_BUTTON_MINUTES = 30  # ...the button is pressed...
+POWER_CLIENT_MINUTES = 60  # ...and a client asks for the schedule.
+
+
+def schedule_image(schedule:tuple) -> bytes:
+    image = bytearray([255]*56)
+    for (slot, entry) in enumerate(schedule):
+        image[slot*3:slot*3+3] = bytes(entry)
+    return bytes(image)
+
+
+class Rig:
+    """The firmware objects wired up like main.py does, on a stepped simulated clock."""
+    def __init__(self):
+        self.clock = sim.install(speed=0, start=START, nvram=schedule_image(SCHEDULE))
+        import machine
+        import metrics
+        from ds1307 import DS1307, recover_bus
+        from feeding_log import FeedingLog
+        from feeding_time_handler import FeedingTimeHandler
+        from hardware_controller import HardwareController
+        from protocol import ClientHandler
+        from soft_clock import SoftClock
+        self.machine = machine
+        self.metrics = metrics
+
+        def make_i2c():
+            return machine.I2C(0, scl=machine.Pin(17), sda=machine.Pin(16), freq=100000)
+
+        def reset_i2c():
+            recover_bus(17, 16)
+            return make_i2c()
+        self.rtc = DS1307(make_i2c(), recover=reset_i2c)
+        self.feeding_time_handler = FeedingTimeHandler(self.rtc)
+        self.soft_clock = SoftClock(self.rtc)
+        self.feeding_log = FeedingLog("feedings.log")
+        self.hardware_controller = HardwareController(SERVO_PIN, BUTTON_PIN, self.feeding_time_handler, self.soft_clock,
+                                                      feeding_log=self.feeding_log)
+        self.client_handler = ClientHandler(self.feeding_time_handler, self.hardware_controller, self.feeding_log)
+        self.controller_wakeups = 0
+        event = self.hardware_controller._event
+        acquire = event.acquire
+
+        def counting_acquire(*args):
+            self.controller_wakeups += 1
+            return acquire(*args)
+        event.acquire = counting_acquire
+        self.log_flushes = 0
+        flush = self.feeding_log.flush
+
+        def counting_flush():
+            written = flush()
+            self.log_flushes += written > 0
+            return written
+        self.feeding_log.flush = counting_flush
+        self.clock.settle()
+
+    def i2c_transactions(self) -> int:
+        return self.machine.I2C.stats["transactions"]
+
+
+def bench_day(rig:Rig) -> dict:
+    """Run a simulated day and check that every feeding happened once, on time."""
+    machine = rig.machine
+    clock = rig.clock
+    machine.PWM.log.clear()
+    transactions = rig.i2c_transactions()
+    wakeups = rig.controller_wakeups
+    day_ms = 24*3600*1000
+    clock.run_for(day_ms)
+    minutes = day_ms/60000
+
+    starts = []
+    dispense_errors = []
+    running_since = None
+    for (ms, pin, duty) in machine.PWM.log:
+        if pin != SERVO_PIN:
+            continue
+        if duty == DISPENSE_DUTY_NS:
+            running_since = ms
+            starts.append(ms)
+        elif duty == STOPPED_DUTY_NS and running_since is not None:
+            dispense_errors.append((ms-running_since, running_since))
+            running_since = None
+
+    start_seconds = clock.start_seconds
+    expected = {}
+    for (hour, minute, deciseconds) in SCHEDULE:
+        # Feedings at or before the start time happen on the next day
+        offset = ((hour*60+minute)*60 - (START[3]*3600+START[4]*60+START[5])) % 86400
+        expected[offset*1000] = deciseconds*100
+    fired = {}
+    for ms in starts:
+        scheduled = min(expected, key=lambda due: abs(due-ms))
+        fired.setdefault(scheduled, []).append(ms)
+    start_errors = [abs(ms-scheduled) for (scheduled, times) in fired.items() for ms in times]
+    duration_errors = []
+    for (actual, started) in dispense_errors:
+        scheduled = min(expected, key=lambda due: abs(due-started))
+        duration_errors.append(abs(actual-expected[scheduled]))
+    return {
+        "i2c_transactions_per_minute": (rig.i2c_transactions()-transactions)/minutes,
+        "controller_wakeups_per_minute": (rig.controller_wakeups-wakeups)/minutes,
+        "feedings_missed": len([due for due in expected if due not in fired]),
+        "feedings_repeated": sum(len(times)-1 for times in fired.values()),
+        "feeding_start_error_ms": max(start_errors, default=0),
+        "dispense_error_ms": max(duration_errors, default=0),
+    }
+
+
+def bench_index(rig:Rig) -> dict:
+    """Check the feeding and guard window bitmaps against the schedule for every minute of the day, and time the lookups."""
+    scheduler = rig.hardware_controller.scheduler
+    guard = scheduler.guard_minutes
+    feedings = [hour*60+minute for (hour, minute, deciseconds) in SCHEDULE]
+    errors = 0
+    for minute in range(1440):
+        distance = min(min((minute-feeding) % 1440, (feeding-minute) % 1440) for feeding in feedings)
+        errors += scheduler.is_due(minute) != (distance == 0)
+        errors += scheduler.in_guard(minute) != (distance < guard)
+    started = time.perf_counter()
+    for minute in range(1440):
+        scheduler.in_guard(minute)
+    guard_us = (time.perf_counter()-started)/1440*1e6
+    started = time.perf_counter()
+    for minute in range(1440):
+        scheduler.is_due(minute)
+    due_us = (time.perf_counter()-started)/1440*1e6
+    return {
+        "index_errors": errors,
+        "guard_check_us": guard_us,
+        "due_check_us": due_us,
+    }
+
+
+def allocated_bytes(call) -> int:
+    """ Bytes that call() allocates in firmware code, the least over ALLOCATION_CALLS calls.
+        tracemalloc is sampled on every line of firmware code, so memory that the simulator allocates
+        and frees again is not counted. CPython also allocates for ints above 256, which MicroPython
+        stores in place, and for some bookkeeping of its own, so the figures are upper bounds.
+    """
+    simulator_path = os.path.dirname(os.path.abspath(__file__))
+    state = [0, 0] # traced memory at the last event, bytes allocated
+
+    def trace(frame, event, arg):
+        path = frame.f_code.co_filename
+        if not path.startswith(sim.FIRMWARE_PATH) or path.startswith(simulator_path):
+            return None
+        current = tracemalloc.get_traced_memory()[0]
+        # The frame itself is allocated before its call event, and freed again when it returns
+        if event != "call" and current > state[0]:
+            state[1] += current-state[0]
+        state[0] = current
+        return trace
+    least = None
+    call()
+    for i in range(ALLOCATION_CALLS):
+        state[0] = tracemalloc.get_traced_memory()[0]
+        state[1] = 0
+        sys.settrace(trace)
+        try:
+            call()
+        finally:
+            sys.settrace(None)
+        least = state[1] if least is None else min(least, state[1])
+    return least
+
+
+def bench_allocations(rig:Rig) -> dict:
+    """ Measure the memory allocated per call by each way of reading the time, beyond what the I2C
+        transaction itself costs, and check that they all read the same time.
+    """
+    import array
+    from ds1307 import DATETIME_REG, DATETIME_SIZE, FORMATTED_SIZE
+    rtc = rig.rtc
+    values = array.array('H', [0]*DATETIME_SIZE)
+    text = bytearray(FORMATTED_SIZE)
+    buffer = bytearray(DATETIME_SIZE)
+    reads = {
+        "rtc_datetime": rtc.datetime,
+        "rtc_datetime_into": lambda: rtc.datetime_into(values),
+        "rtc_epoch_seconds": rtc.epoch_seconds,
+        "rtc_format_into": lambda: rtc.format_into(text),
+        "soft_clock_anchor": rig.soft_clock.anchor,
+    }
+    tracemalloc.start()
+    try:
+        transaction = allocated_bytes(lambda: rtc._read_into(DATETIME_REG, buffer))
+        results = {f"alloc_bytes_{name}": max(allocated_bytes(read)-transaction, 0) for (name, read) in reads.items()}
+        results["alloc_bytes_soft_clock_epoch_seconds"] = allocated_bytes(rig.soft_clock.epoch_seconds)
+    finally:
+        tracemalloc.stop()
+    # The clock is stepped, so every read sees the same time
+    (year, month, mday, weekday, hour, minute, second) = rtc.datetime()
+    weekday_name = rtc.weekdays[rtc.format_into(text)]
+    errors = tuple(rtc.datetime_into(values)) != rtc.datetime()
+    errors += rtc.epoch_seconds() != int(sim.rtc.seconds())
+    errors += text.decode() != f"{year:04d}-{month:02d}-{mday:02d} {hour:02d}:{minute:02d}:{second:02d}"
+    errors += weekday_name != rtc.get_weekday()
+    errors += rtc.get_weekday_and_time() != f"{weekday_name} {text.decode()}"
+    results["rtc_decode_errors"] = errors
+    return results
+
+
+def bench_clients(rig:Rig) -> dict:
+    """Serve requests of each kind and measure latency and I2C transactions per request."""
+    v2_upload = b"".join(b"c" + bytes([slot, 8, slot, 5]) for slot in range(18))
+    requests = {
+        "u": b"u",
+        "c": b"c\x00\x07\x00\x1e",
+        "d": b"d\x11",
+        "m": b"m\x01",
+        "s": b"s",
+        "v2_upload": struct.pack(">BH", 2, len(v2_upload)) + v2_upload,
+        "v2_changes": struct.pack(">BHBL", 2, 5, ord("v"), 0),
+        "l": b"l\x00\x00\x00\x00",
+        "v2_log": struct.pack(">BHBL", 2, 5, ord("l"), 0),
+    }
+    results = {}
+
+    async def run():
+        server = await asyncio.start_server(rig.client_handler.handle_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        for (name, request) in requests.items():
+            latencies = []
+            transactions = rig.i2c_transactions()
+            for i in range(REQUESTS_PER_OPCODE):
+                started = time.perf_counter()
+                (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(request)
+                await writer.drain()
+                await reader.read()
+                latencies.append(time.perf_counter()-started)
+                writer.close()
+                await writer.wait_closed()
+            latencies.sort()
+            results[f"latency_{name}_us"] = latencies[len(latencies)//2]*1e6
+            results[f"i2c_per_request_{name}"] = (rig.i2c_transactions()-transactions)/REQUESTS_PER_OPCODE
+        server.close()
+        await server.wait_closed()
+    asyncio.run(run())
+    rig.clock.settle()
+    return results
+
+
+def bench_bus_fault(rig:Rig) -> dict:
+    """ Wedge the I2C bus and poll the RTC until it answers again. Checks that every call is
+        bounded by the deadline, that calls fail fast while the breaker is open, and how long
+        it takes from the fault until the bus works again. Times are simulated.
+    """
+    from ds1307 import BusError
+    metrics = rig.metrics
+    clock = rig.clock
+    faults = metrics.counters[metrics.BUS_FAULTS]
+    rig.machine.I2C.stuck = True
+    fault_ms = clock.now_ms()
+    slowest_ms = 0
+    fast_fails = []
+    while True:
+        started = clock.now_ms()
+        transactions = rig.i2c_transactions()
+        try:
+            rig.rtc.datetime()
+            break
+        except BusError:
+            elapsed = clock.now_ms()-started
+            slowest_ms = max(slowest_ms, elapsed)
+            if rig.i2c_transactions() == transactions:
+                fast_fails.append(elapsed)
+        clock.run_for(BUS_FAULT_POLL_MS)
+    return {
+        "bus_fault_slowest_call_ms": slowest_ms,
+        "bus_fault_fast_fail_ms": max(fast_fails, default=0),
+        "bus_fault_recovery_ms": clock.now_ms()-fault_ms,
+        "bus_fault_breaker_trips": metrics.counters[metrics.BUS_FAULTS]-faults,
+    }
+
+
+def bench_beacon(rig:Rig) -> dict:
+    """ Drive the beacon like main.py does for an hour, with a feeding added half way through.
+        Reports how often it is sent, how often it is rebuilt, and how long it takes to show the
+        servo running.
+    """
+    from beacon import Beacon
+    from hardware_controller import SERVO_DISPENSING
+    machine = rig.machine
+    clock = rig.clock
+    controller = rig.hardware_controller
+    beacon = Beacon(2390, machine.unique_id())
+    machine.PWM.log.clear()
+    sends = []
+    rebuilds = 0
+    hour_ms = 3600*1000
+    started = clock.now_ms()
+    feeding = (rig.soft_clock.epoch_seconds()//60 + 30) % 1440
+    rig.feeding_time_handler.set_feeding_time(0, feeding//60, feeding % 60, 10)
+    while clock.now_ms()-started < hour_ms:
+        rebuilds += beacon.update(rig.feeding_time_handler.version, controller.servo_state,
+                                  controller.next_feeding, None)
+        if beacon.send_if_due():
+            sends.append((clock.now_ms(), controller.servo_state))
+        clock.run_for(BEACON_CHECK_MS)
+    dispense_starts = [ms for (ms, pin, duty) in machine.PWM.log if pin == SERVO_PIN and duty == DISPENSE_DUTY_NS]
+    if not dispense_starts:
+        raise RuntimeError("No feeding in the beacon benchmark hour")
+    shown = min(ms for (ms, state) in sends if state == SERVO_DISPENSING and ms >= dispense_starts[0])
+    return {
+        "beacon_sends_per_minute": len(sends)/(hour_ms/60000),
+        "beacon_rebuilds_per_hour": rebuilds,
+        "beacon_servo_latency_ms": shown-dispense_starts[0],
+    }
+
+
+def bench_log(rig:Rig) -> dict:
+    """ Press the button in a quick burst, then run a day checking the log once a minute like main.py
+        does. Checks that every dispense was logged with its actual duration, and counts flash writes.
+    """
+    from feeding_log import RECORD_FORMAT, RECORD_SIZE
+    machine = rig.machine
+    clock = rig.clock
+    log = rig.feeding_log
+    machine.PWM.log.clear()
+    first = log.next_sequence
+    flushes = rig.log_flushes
+    for i in range(BUTTON_BURST):
+        machine.Pin.set_input(BUTTON_PIN, 0)
+        clock.run_for(100)
+        machine.Pin.set_input(BUTTON_PIN, 1)
+        clock.run_for(1000)
+        log.flush_if_due()
+    for minute in range(24*60):
+        clock.run_for(LOG_CHECK_MS)
+        log.flush_if_due()
+    log.flush()
+
+    dispensed = servo_runs(machine.PWM.log)
+    buffer = bytearray(RECORD_SIZE*(log.next_sequence-first))
+    count = log.read_into(first, buffer)
+    logged = [struct.unpack_from(RECORD_FORMAT, buffer, i*RECORD_SIZE)[4] for i in range(count)]
+    return {
+        "log_records_missing": len(dispensed)-sum(1 for (actual, logged_ms) in zip(dispensed, logged) if actual == logged_ms),
+        "log_flash_writes_per_record": (rig.log_flushes-flushes)/max(count, 1),
+    }
+
+
+def bench_time_sync(rig:Rig) -> dict:
+    """ Run the NTP sync for a few days against a DS1307 that runs fast.
+        Checks the drift estimate, how often the time is synced once it is known, that no sync
+        moves the clock near a feeding, and how far the time is off between syncs, with and
+        without the drift correction.
+    """
+    from time_sync import TimeSync
+    clock = rig.clock
+    soft_clock = rig.soft_clock
+    scheduler = rig.hardware_controller.scheduler
+    sim.rtc.set_drift(RTC_DRIFT_PPM)
+    time_sync = TimeSync(soft_clock, scheduler)
+    syncs = []
+    guard_violations = 0
+
+    def on_synced():
+        nonlocal guard_violations
+        syncs.append(clock.now_ms())
+        if len(syncs) > 1 and scheduler.in_guard(soft_clock.minute_of_day()):
+            guard_violations += 1
+    time_sync.add_listener(on_synced)
+    soft_errors = []
+    rtc_errors = []
+
+    async def sample():
+        while True:
+            await asyncio.sleep(CLOCK_SAMPLE_S)
+            soft_errors.append((clock.now_ms(), abs(soft_clock.epoch_seconds()-clock.wall_seconds())))
+            rtc_errors.append((clock.now_ms(), abs(sim.rtc.error_seconds())))
+
+    async def run():
+        asyncio.create_task(sample())
+        try:
+            await asyncio.wait_for(time_sync.run(lambda: True), TIME_SYNC_DAYS*86400)
+        except asyncio.TimeoutError:
+            pass
+    started = clock.now_ms()
+    asyncio.run(run())
+    sim.rtc.set_drift(0)
+    rig.clock.settle()
+    last_day = started + (TIME_SYNC_DAYS-1)*86400*1000
+    return {
+        "time_sync_drift_error_ppm": abs(time_sync.drift_ppm-RTC_DRIFT_PPM),
+        "time_syncs_last_day": sum(1 for ms in syncs if ms >= last_day),
+        "time_sync_guard_violations": guard_violations,
+        "time_soft_clock_error_s": max(error for (ms, error) in soft_errors if ms >= last_day),
+        "time_rtc_error_s": max(error for (ms, error) in rtc_errors if ms >= last_day),
+    }
+
+
+def bench_commands(rig:Rig) -> dict:
+    """ Send bursts of manual runs while the servo is running, under each dispense policy, and a burst
+        bigger than the command queue while the controller holds the servo lock.
+        Reports the servo time dispensed, the commands dropped, the deepest the queue got, and how long
+        queueing a command takes, which must not depend on the servo lock.
+    """
+    from command_queue import POLICY_QUEUE, POLICY_EXTEND, POLICY_DROP
+    machine = rig.machine
+    clock = rig.clock
+    controller = rig.hardware_controller
+    metrics = rig.metrics
+    results = {}
+    for (name, policy) in (("queue", POLICY_QUEUE), ("extend", POLICY_EXTEND), ("drop", POLICY_DROP)):
+        controller.dispense_policy = policy
+        machine.PWM.log.clear()
+        drops = metrics.counters[metrics.COMMAND_DROPS]
+        for i in range(COMMAND_BURST):
+            controller.request_dispense(COMMAND_MS)
+            clock.run_for(COMMAND_GAP_MS)
+        clock.run_for(COMMAND_BURST*(COMMAND_MS+1000))
+        results[f"commands_{name}_dispensed_ms"] = sum(servo_runs(machine.PWM.log))
+        results[f"commands_{name}_drops"] = metrics.counters[metrics.COMMAND_DROPS]-drops
+    controller.dispense_policy = POLICY_QUEUE
+
+    queue = controller.commands
+    overflow = queue.size+COMMAND_BURST
+    drops = queue.drops
+    with controller.mutex:
+        started = time.perf_counter()
+        for i in range(overflow):
+            controller.request_dispense(COMMAND_MS)
+        put_us = (time.perf_counter()-started)/overflow*1e6
+    results["command_put_us"] = put_us
+    results["command_queue_peak"] = queue.peak
+    results["command_overflow_drops"] = queue.drops-drops
+    clock.run_for(overflow*(COMMAND_MS+1000))
+    return results
+
+
+def bench_sessions(rig:Rig) -> dict:
+    """ Open sessions and compare the latency of 'u' on a session with a new connection for each.
+        Then change the schedule from another connection and press the button, and check that every
+        session is told, and how long it took in simulated time. Also opens one session too many,
+        and idles for longer than the keepalive interval.
+    """
+    from protocol import (MAX_SESSIONS, KEEPALIVE_S, STATUS_OK, STATUS_BUSY, STATUS_NOTIFICATION,
+                          NOTIFY_SCHEDULE, NOTIFY_DISPENSE_START, NOTIFY_DISPENSE_STOP, NOTIFY_KEEPALIVE)
+    machine = rig.machine
+    clock = rig.clock
+    handler = rig.client_handler
+    results = {}
+
+    def frame(payload:bytes) -> bytes:
+        return struct.pack(">BH", 2, len(payload)) + payload
+
+    async def read_frame(reader) -> tuple:
+        """(status, payload after the schedule version) of the next frame."""
+        length = struct.unpack(">xH", await reader.readexactly(3))[0]
+        payload = await reader.readexactly(length)
+        return (payload[0], payload[5:])
+
+    async def next_notification(reader) -> tuple:
+        while True:
+            (status, payload) = await asyncio.wait_for(read_frame(reader), NOTIFICATION_TIMEOUT_S)
+            if status == STATUS_NOTIFICATION:
+                return (payload[0], clock.now_ms())
+
+    async def run():
+        server = await asyncio.start_server(handler.handle_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async def open_session() -> tuple:
+            (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(frame(b"o"))
+            await writer.drain()
+            return (reader, writer, (await read_frame(reader))[0])
+
+        (reader, writer, status) = await open_session()
+        sessions = [(reader, writer)] if status == STATUS_OK else []
+        session_latencies = []
+        connection_latencies = []
+        for i in range(REQUESTS_PER_OPCODE):
+            started = time.perf_counter()
+            writer.write(frame(b"u"))
+            await writer.drain()
+            await read_frame(reader)
+            session_latencies.append(time.perf_counter()-started)
+            started = time.perf_counter()
+            (other_reader, other_writer) = await asyncio.open_connection("127.0.0.1", port)
+            other_writer.write(frame(b"u"))
+            await other_writer.drain()
+            await other_reader.read()
+            connection_latencies.append(time.perf_counter()-started)
+            other_writer.close()
+            await other_writer.wait_closed()
+        session_latencies.sort()
+        connection_latencies.sort()
+        results["session_latency_u_us"] = session_latencies[len(session_latencies)//2]*1e6
+        results["session_latency_ratio"] = session_latencies[len(session_latencies)//2]/connection_latencies[len(connection_latencies)//2]
+
+        refusals = 0
+        for i in range(MAX_SESSIONS):
+            (other_reader, other_writer, status) = await open_session()
+            if status == STATUS_OK:
+                sessions.append((other_reader, other_writer))
+            else:
+                refusals += status == STATUS_BUSY
+                other_writer.close()
+        results["session_refusals"] = refusals
+        results["session_count"] = len(sessions)
+
+        # Events, each with the sessions still to be told of it and when it happened
+        (other_reader, other_writer) = await asyncio.open_connection("127.0.0.1", port)
+        changed_ms = clock.now_ms()
+        other_writer.write(b"c\x05\x09\x00\x0a")
+        await other_writer.drain()
+        await other_reader.read()
+        other_writer.close()
+        expected = [(NOTIFY_SCHEDULE, changed_ms)]
+        machine.Pin.set_input(BUTTON_PIN, 0)
+        await asyncio.sleep(0.1)
+        # The dispense starts once the button is let go
+        released_ms = clock.now_ms()
+        machine.Pin.set_input(BUTTON_PIN, 1)
+        expected.append((NOTIFY_DISPENSE_START, released_ms))
+        expected.append((NOTIFY_DISPENSE_STOP, None))
+        missing = 0
+        delays = []
+
+        async def check_session(session_reader):
+            nonlocal missing
+            for (event, happened_ms) in expected:
+                try:
+                    (received, received_ms) = await next_notification(session_reader)
+                except asyncio.TimeoutError:
+                    missing += 1
+                    continue
+                missing += received != event
+                if happened_ms is not None:
+                    delays.append(received_ms-happened_ms)
+        # Read all sessions at once, so each notification is timed as it arrives
+        await asyncio.gather(*(check_session(session_reader) for (session_reader, session_writer) in sessions))
+        results["session_notifications_missing"] = missing
+        results["session_notify_delay_ms"] = max(delays, default=0)
+
+        await asyncio.sleep(KEEPALIVE_S+1)
+        keepalives = 0
+        for (session_reader, session_writer) in sessions:
+            try:
+                keepalives += (await next_notification(session_reader))[0] == NOTIFY_KEEPALIVE
+            except asyncio.TimeoutError:
+                pass
+        results["session_keepalives_missing"] = len(sessions)-keepalives
+
+        for (session_reader, session_writer) in sessions:
+            session_writer.close()
+            await session_writer.wait_closed()
+        await asyncio.sleep(0.1)
+        # Sessions left open, and the notifier if it outlived them
+        results["session_leaks"] = len(handler._sessions) + (handler._notifier is not None)
+        server.close()
+        await server.wait_closed()
+    asyncio.run(run())
+    clock.settle()
+    return results
+
+
+def bench_power(rig:Rig) -> dict:
+    """ Run the firmware in low-power mode, wired up like main.py does, for a few hours, with a feeding,
+        a button press and a client request while it sleeps. Reports the share of the time awake, measured
+        by the simulated machine.lightsleep() and as reported by the firmware, and wake-up latencies:
+        for a deadline, from the button being let go until the servo starts, and from a client sending
+        a request until the reply arrives. Also checks that the beacon keeps to its interval and the
+        feeding starts on time.
+    """
+    import socket
+    from beacon import Beacon
+    from power import PowerManager
+    from time_sync import TimeSync
+    machine = rig.machine
+    clock = rig.clock
+    metrics = rig.metrics
+    controller = rig.hardware_controller
+    handler = rig.client_handler
+    beacon = Beacon(2390, machine.unique_id())
+    time_sync = TimeSync(rig.soft_clock, controller.scheduler)
+    power = PowerManager()
+    for owner in (controller, handler, time_sync, beacon):
+        power.add_deadline(owner.ms_until_due)
+    machine.PWM.log.clear()
+    machine.sleep_log.clear()
+    metrics.reset()
+    beacon_sends = []
+    request = struct.pack(">BHB", 2, 1, ord("u"))
+    client = {}
+    timers = []
+
+    def at_minute(minutes:float, callback) -> None:
+        timer = machine.Timer()
+        timer.init(mode=machine.Timer.ONE_SHOT, period=int(minutes*60000), callback=lambda t: callback())
+        timers.append(timer)
+
+    def press() -> None:
+        machine.Pin.set_input(BUTTON_PIN, 0)
+        at_minute(0.1/60, release)
+
+    def release() -> None:
+        client["released_ms"] = clock.now_ms()
+        machine.Pin.set_input(BUTTON_PIN, 1)
+
+    def send_request() -> None:
+        # Connecting does not need the server to run, the kernel queues the connection
+        client["socket"].connect(client["address"])
+        client["socket"].sendall(request)
+        client["sent_ms"] = clock.now_ms()
+
+    async def beacon_task():
+        while True:
+            beacon.update(rig.feeding_time_handler.version, controller.servo_state, controller.next_feeding,
+                          time_sync.last_sync)
+            if beacon.send_if_due():
+                beacon_sends.append(clock.now_ms())
+            delay_ms = beacon.ms_until_due()
+            await asyncio.sleep((min(delay_ms, BEACON_CHECK_MS) if delay_ms else BEACON_CHECK_MS)/1000)
+
+    async def client_task():
+        while "sent_ms" not in client:
+            await asyncio.sleep(1)
+        sock = client["socket"]
+        sock.setblocking(False)
+        reply = b""
+        while len(reply) < 3+5+54:
+            reply += await asyncio.get_running_loop().sock_recv(sock, 256)
+        client["received_ms"] = clock.now_ms()
+        sock.close()
+
+    async def run():
+        server = await asyncio.start_server(handler.handle_client, "127.0.0.1", 0)
+        client["address"] = server.sockets[0].getsockname()
+        client["socket"] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        asyncio.create_task(beacon_task())
+        asyncio.create_task(time_sync.run(lambda: True))
+        asyncio.create_task(client_task())
+        asyncio.create_task(power.run())
+        await asyncio.sleep(0)
+        at_minute(POWER_BUTTON_MINUTES, press)
+        at_minute(POWER_CLIENT_MINUTES, send_request)
+        feeding = (rig.soft_clock.epoch_seconds()//60 + POWER_FEEDING_MINUTES) % 1440
+        rig.feeding_time_handler.set_feeding_time(0, feeding//60, feeding % 60, 10)
+        client["feeding_ms"] = clock.now_ms() + ((feeding - rig.soft_clock.epoch_seconds()//60) % 1440)*60000 \
+            - rig.soft_clock.epoch_seconds() % 60*1000
+        try:
+            await asyncio.wait_for(asyncio.sleep(POWER_HOURS*3600), POWER_HOURS*3600+60)
+        finally:
+            server.close()
+    started = clock.now_ms()
+    asyncio.run(run())
+    elapsed = clock.now_ms()-started
+    clock.settle()
+
+    slept = sum(slept_ms for (started_ms, asked_ms, slept_ms, early) in machine.sleep_log)
+    dispense_starts = [ms for (ms, pin, duty) in machine.PWM.log if pin == SERVO_PIN and duty == DISPENSE_DUTY_NS]
+    button_starts = [ms for ms in dispense_starts if ms >= client.get("released_ms", float("inf"))]
+    feeding_starts = [ms for ms in dispense_starts if ms >= client["feeding_ms"]-60000]
+    gaps = [later-earlier for (earlier, later) in zip(beacon_sends, beacon_sends[1:])]
+    wake_latency = metrics.histograms[metrics.WAKE_LATENCY*metrics.HISTOGRAM_SIZE+2]
+    return {
+        "power_duty_cycle": 1-slept/elapsed,
+        "power_duty_cycle_error": abs(power.duty_cycle-(1-slept/elapsed)),
+        "power_sleeps_per_hour": len(machine.sleep_log)/POWER_HOURS,
+        "power_wake_latency_ms": wake_latency/1000,
+        "power_button_latency_ms": button_starts[0]-client["released_ms"] if button_starts else float("inf"),
+        "power_client_latency_ms": client.get("received_ms", float("inf"))-client["sent_ms"],
+        "power_feeding_start_error_ms": abs(feeding_starts[0]-client["feeding_ms"]) if feeding_starts else float("inf"),
+        "power_beacon_gap_ms": max(gaps, default=float("inf")),
+    }
+
+
+def bench_main_loop(seconds:float=3.0) -> dict:
+    """Run main.py in real time in a separate simulator process."""
+    command = [sys.executable, "-m", "sim", "--duration", str(seconds), "--stats",
+               "--nvram", schedule_image(SCHEDULE).hex()]
+    output = subprocess.run(command, cwd=sim.FIRMWARE_PATH, capture_output=True, text=True, timeout=seconds+30).stdout
+    from sim.__main__ import STATS_PREFIX
+    stats = None
+    ready_ms = None
+    for line in output.splitlines():
+        if line.startswith(STATS_PREFIX):
+            stats = json.loads(line[len(STATS_PREFIX):])
+        elif line.startswith(BOOT_READY_PREFIX):
+            ready_ms = int(line[len(BOOT_READY_PREFIX):].split()[0])
+    if stats is None or ready_ms is None:
+        raise RuntimeError(f"main.py did not run in the simulator:\n{output}")
+    return {
+        "boot_ready_to_feed_ms": ready_ms,
+        "event_loop_iterations_per_second": stats["event_loop_iterations"]/stats["real_seconds"],
+        "main_i2c_transactions_per_second": stats["i2c_transactions"]/stats["real_seconds"],
+    }
+
+
+def servo_runs(log:list) -> list:
+    """Durations, in ms, of the servo runs in a PWM log."""
+    runs = []
+    running_since = None
+    for (ms, pin, duty) in log:
+        if pin == SERVO_PIN and duty == DISPENSE_DUTY_NS:
+            running_since = ms
+        elif pin == SERVO_PIN and duty == STOPPED_DUTY_NS and running_since is not None:
+            runs.append(round(ms-running_since))
+            running_since = None
+    return runs
+
+
+def bench_fleet() -> dict:
+    """ Start stand-in feeders in a separate simulator process, find them from their beacons, push a schedule
+        to all of them and read it back. The stand-ins hold every connection back and fail some of them.
+    """
+    import socket
+    from fleet import FleetClient, Inventory
+    from sim.feeders import READY_PREFIX
+    # Two free ports, held open together so they differ
+    probes = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(2)]
+    for probe in probes:
+        probe.bind(("127.0.0.1", 0))
+    (beacon_port, header_port) = [probe.getsockname()[1] for probe in probes]
+    for probe in probes:
+        probe.close()
+    command = [sys.executable, "-m", "sim.feeders", "--count", str(FLEET_SIZE), "--beacon-host", "127.0.0.1",
+               "--beacon-port", str(beacon_port), "--header-port", str(header_port),
+               "--delay-ms", str(FLEET_DELAY_MS), "--fail-rate", str(FLEET_FAIL_RATE), "--duration", "60"]
+
+    async def run():
+        inventory = Inventory(port=beacon_port, header_port=header_port)
+        await inventory.start()
+        feeders = subprocess.Popen(command, cwd=sim.FIRMWARE_PATH, stdout=subprocess.PIPE, text=True)
+        try:
+            started = time.perf_counter()
+            found = await inventory.wait_for(FLEET_SIZE, 20)
+            discovery_s = time.perf_counter()-started
+            client = FleetClient()
+            started = time.perf_counter()
+            pushed = await client.run(found, "push_schedule", FLEET_SCHEDULE)
+            push_ms = (time.perf_counter()-started)*1000
+            read = await client.run(found, "read_schedule")
+        finally:
+            inventory.close()
+            feeders.kill()
+            output = feeders.communicate()[0]
+        if READY_PREFIX not in output:
+            raise RuntimeError(f"The stand-in feeders did not start:\n{output}")
+        return (found, discovery_s, pushed, push_ms, read)
+    # The fleet tool runs on real time, not on the SimClock
+    loop = asyncio.SelectorEventLoop()
+    try:
+        (found, discovery_s, pushed, push_ms, read) = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    results = pushed+read
+    return {
+        "fleet_feeders_found": len(found),
+        "fleet_discovery_s": discovery_s,
+        "fleet_push_failures": sum(1 for result in pushed if not result.ok),
+        "fleet_read_mismatches": sum(1 for result in read if not result.ok or result.value != list(FLEET_SCHEDULE)),
+        "fleet_retries": sum(result.attempts-1 for result in results),
+        "fleet_push_ms": push_ms,
+        "fleet_latency_max_ms": max((result.latency_ms for result in results if result.latency_ms is not None), default=0),
+    }
+
+
+def check(results:dict, baseline:dict) -> list:
+    """Return the names of the metrics that are outside their limits."""
+    failures = []
+    for (name, limits) in baseline.items():
+        value = results.get(name)
+        if value is None:
+            failures.append(name)
+        elif ("max" in limits and value > limits["max"]) or ("min" in limits and value < limits["min"]):
+            failures.append(name)
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m sim.bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    rig = Rig()
+    results = {}
+    results.update(bench_day(rig))
+    results.update(bench_index(rig))
+    results.update(bench_allocations(rig))
+    results.update(bench_clients(rig))
+    results.update(bench_bus_fault(rig))
+    results.update(bench_beacon(rig))
+    results.update(bench_log(rig))
+    results.update(bench_commands(rig))
+    results.update(bench_sessions(rig))
+    results.update(bench_power(rig))
+    results.update(bench_time_sync(rig))
+    results.update(bench_main_loop())
+    results.update(bench_fleet())
+
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    failures = check(results, baseline)
+    for (name, value) in results.items():
+        limits = baseline.get(name, {})
+        limit = ", ".join(f"{kind} {bound}" for (kind, bound) in limits.items())
+        status = "FAIL" if name in failures else "ok"
+        print(f"{name:40s} {value:14.3f}   {limit:18s} {status}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if failures:
+        print(f"Regressions: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Byte-accurate model of the DS1307 register file: BCD time keeping, clock halt and 56 bytes of NVRAM."""
+
+import os
+
+from sim.simclock import from_seconds, to_seconds
+
+REGISTER_COUNT = 64
+TIME_REGISTERS = 7
+CHIP_HALT = 0x80
+
+
+def _bcd(value:int) -> int:
+    return (value // 10) << 4 | (value % 10)
+
+
+def _from_bcd(value:int) -> int:
+    return (value >> 4)*10 + (value & 0x0F)
+
+
+class DS1307Model:
+    """ The time is kept as seconds since 2000-01-01 at a point on the simulated clock.
+        The oscillator can be given a drift, in ppm, against the true time of the SimClock.
+    """
+    def __init__(self, clock, start:tuple, drift_ppm:float=0.0, nvram:bytes=None):
+        self.clock = clock
+        self.drift_ppm = drift_ppm
+        self.registers = bytearray(REGISTER_COUNT)
+        self.registers[8:] = nvram if nvram is not None else os.urandom(REGISTER_COUNT-8)
+        self.halted = False
+        self._weekday_offset = 0
+        self._set_time(to_seconds(start))
+
+    # Time keeping
+
+    def _set_time(self, seconds:float) -> None:
+        self._base_seconds = seconds
+        self._base_ms = self.clock.now_ms()
+
+    def set_drift(self, drift_ppm:float) -> None:
+        """Change the drift from now on."""
+        self._set_time(self.seconds())
+        self.drift_ppm = drift_ppm
+
+    def seconds(self) -> float:
+        """Current time of the chip, in seconds since 2000-01-01."""
+        if self.halted:
+            return self._base_seconds
+        elapsed_ms = (self.clock.now_ms()-self._base_ms)*(1+self.drift_ppm/1e6)
+        return self._base_seconds + elapsed_ms/1000
+
+    def error_seconds(self) -> float:
+        """How far the chip is ahead of the true time."""
+        return self.seconds() - self.clock.wall_seconds()
+
+    def _render_time(self) -> None:
+        now = from_seconds(int(self.seconds()))
+        registers = self.registers
+        registers[0] = _bcd(now.second) | (CHIP_HALT if self.halted else 0)
+        registers[1] = _bcd(now.minute)
+        registers[2] = _bcd(now.hour)
+        # The weekday register counts 1-7 independently of the date, it only has to roll over at midnight
+        registers[3] = (now.weekday()+self._weekday_offset) % 7 + 1
+        registers[4] = _bcd(now.day)
+        registers[5] = _bcd(now.month)
+        registers[6] = _bcd(now.year-2000)
+
+    def _parse_time(self) -> None:
+        registers = self.registers
+        halted = bool(registers[0] & CHIP_HALT)
+        seconds = to_seconds((_from_bcd(registers[6])+2000, _from_bcd(registers[5]), _from_bcd(registers[4]),
+                              _from_bcd(registers[2] & 0x3F), _from_bcd(registers[1]), _from_bcd(registers[0] & 0x7F)))
+        self.halted = halted
+        self._set_time(seconds)
+        self._weekday_offset = (registers[3]-1 - from_seconds(seconds).weekday()) % 7
+
+    # Bus access, the register pointer auto-increments and wraps at the end of RAM
+
+    def read(self, register:int, length:int) -> bytes:
+        self._render_time()
+        return bytes(self.registers[(register+i) % REGISTER_COUNT] for i in range(length))
+
+    def write(self, register:int, data:bytes) -> None:
+        self._render_time()
+        touched_time = False
+        for (i, value) in enumerate(data):
+            address = (register+i) % REGISTER_COUNT
+            self.registers[address] = value
+            touched_time |= address < TIME_REGISTERS
+        if touched_time:
+            self._parse_time()
+
+    @property
+    def nvram(self) -> bytes:
+        return bytes(self.registers[8:])
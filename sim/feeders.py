@@ -0,0 +1,115 @@
+"""Stand-in for a fleet of feeders, for trying out host tools such as python -m fleet.
+
+    python -m sim.feeders [--count N] [--beacon-host HOST] [--beacon-port PORT] [--header-port PORT]
+                          [--delay-ms MS] [--fail-rate P] [--duration SECONDS]
+
+Every feeder runs the firmware's own ClientHandler, FeedingTimeHandler, HardwareController
+and Beacon on its own simulated DS1307, on a port of its own on 127.0.0.1, all on one
+real-time SimClock. Their beacons go to the beacon multicast group, or to --beacon-host
+where multicast is not routed. --delay-ms holds every connection back that long before it
+is served, and --fail-rate closes that fraction of connections unanswered.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+
+import sim
+
+FIRST_I2C_ADDRESS = 0x08 # Each feeder's DS1307 gets an I2C address of its own from here on...
+MAX_FEEDERS = 0x70       # ...up to the last 7 bit address, 0x77.
+FIRST_PIN = 100          # Servo and button pins, two per feeder, clear of the board's own.
+BEACON_INTERVAL_S = 1
+READY_PREFIX = "SIM-FEEDERS "
+
+
+class SimFeeder:
+    def __init__(self, index:int, beacon_host:str, beacon_port:int, header_port:int, delay_ms:float, fail_rate:float, seed:int):
+        import machine
+        from ds1307 import DS1307
+        from feeding_log import FeedingLog
+        from feeding_time_handler import FeedingTimeHandler
+        from hardware_controller import HardwareController
+        from protocol import ClientHandler
+        from sim.ds1307_model import DS1307Model
+        from soft_clock import SoftClock
+        address = FIRST_I2C_ADDRESS+index
+        # An empty schedule
+        machine.I2C.devices[address] = DS1307Model(sim.clock, sim.clock.wall_datetime().timetuple()[:6], nvram=bytes([255]*56))
+        rtc = DS1307(machine.I2C(0, scl=machine.Pin(17), sda=machine.Pin(16)), addr=address)
+        self.feeding_time_handler = FeedingTimeHandler(rtc)
+        self.feeding_log = FeedingLog(f"feedings{index}.log")
+        self.hardware_controller = HardwareController(FIRST_PIN+2*index, FIRST_PIN+2*index+1, self.feeding_time_handler,
+                                                      SoftClock(rtc), feeding_log=self.feeding_log)
+        self.client_handler = ClientHandler(self.feeding_time_handler, self.hardware_controller, self.feeding_log)
+        self.device_id = b"SIM" + index.to_bytes(5, "big")
+        self.beacon_host = beacon_host
+        self.beacon_port = beacon_port
+        self.header_port = header_port
+        self.delay_ms = delay_ms
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed+index)
+        self.port = None
+        self.beacon = None
+
+    async def start(self) -> None:
+        from beacon import Beacon
+        server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self.beacon = Beacon(self.port, self.device_id)
+        if self.beacon_host:
+            self.beacon.group = self.beacon_host
+        self.beacon.port = self.beacon_port
+        self.beacon.header_port = self.header_port
+
+    async def serve(self, reader, writer) -> None:
+        if self.delay_ms:
+            await asyncio.sleep(self.delay_ms/1000)
+        if self.random.random() < self.fail_rate:
+            writer.close()
+            return
+        await self.client_handler.handle_client(reader, writer)
+
+    def send_beacon(self) -> None:
+        controller = self.hardware_controller
+        self.beacon.update(self.feeding_time_handler.version, controller.servo_state, controller.next_feeding, None)
+        self.beacon.send_if_due()
+
+
+async def run(args) -> None:
+    feeders = [SimFeeder(index, args.beacon_host, args.beacon_port, args.header_port, args.delay_ms, args.fail_rate, args.seed)
+               for index in range(args.count)]
+    for feeder in feeders:
+        await feeder.start()
+        print(f"Feeder {feeder.device_id.hex()} on port {feeder.port}")
+    print(f"{READY_PREFIX}{len(feeders)}", flush=True)
+    while True:
+        for feeder in feeders:
+            feeder.send_beacon()
+        await asyncio.sleep(BEACON_INTERVAL_S)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m sim.feeders", description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=4, help="number of feeders")
+    parser.add_argument("--beacon-host", help="send the beacons here instead of to the multicast group")
+    parser.add_argument("--beacon-port", type=int, default=5050)
+    parser.add_argument("--header-port", type=int, default=5051, help="port of the beacons with a header")
+    parser.add_argument("--delay-ms", type=float, default=0, help="hold every connection back this long")
+    parser.add_argument("--fail-rate", type=float, default=0, help="fraction of connections to close unanswered")
+    parser.add_argument("--seed", type=int, default=0, help="seed for choosing the connections that fail")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    args = parser.parse_args()
+    if not 0 < args.count <= MAX_FEEDERS:
+        parser.error(f"--count must be between 1 and {MAX_FEEDERS}")
+    sim.install(speed=1)
+    if args.duration is not None:
+        threading.Timer(args.duration, lambda: (sys.stdout.flush(), os._exit(0))).start()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Stand-in for the machine module: I2C with attached device models, Pin, PWM, Timer and light sleep."""
+
+import time
+
+import sim
+
+# Time for the clocks to start again after a light sleep. The RP2040 waits for its crystal oscillator
+# and PLLs to be stable, about a millisecond.
+WAKE_TIME_MS = 1.5
+# Real time between checks for a wake-up while sleeping on a running clock, in seconds
+WAKE_POLL_S = 0.005
+# Every light sleep, as (ms when it started, ms asked for, ms slept, True if an interrupt cut it short)
+sleep_log = []
+_wake_pending = False
+
+
+def unique_id() -> bytes:
+    return b"\xe6\x61\x38\x52\x13\x4f\x2a\x30"
+
+
+def freq(hz:int=None) -> int:
+    return 125000000
+
+
+PWRON_RESET = 1
+WDT_RESET = 3
+
+
+def reset_cause() -> int:
+    return PWRON_RESET
+
+
+def reset() -> None:
+    raise SystemExit("machine.reset()")
+
+
+def lightsleep(time_ms:int=None) -> None:
+    """ Stop the caller until time_ms has passed, or a pin interrupt or network traffic wakes the board up,
+        then take WAKE_TIME_MS to wake up. Timers and the other firmware threads carry on meanwhile.
+        The network is the sockets of the running event loop. Without a time_ms, only a wake-up ends the sleep,
+        which a stepped clock cannot wait for.
+    """
+    global _wake_pending
+    from sim.simloop import IO_GRACE_S, SimSelector
+    clock = sim.clock
+    selector = SimSelector.current
+    _wake_pending = False
+    started = clock.now_ms()
+    deadline = float("inf") if time_ms is None else started+time_ms
+
+    def woken() -> bool:
+        if _wake_pending:
+            return True
+        if selector is None or selector.get_map() is None:
+            return False
+        # On a stepped clock, give the other end of a local connection a moment, like the event loop does
+        return selector.io_ready(WAKE_POLL_S if clock.speed > 0 else IO_GRACE_S)
+    if clock.speed == 0:
+        if time_ms is None:
+            raise ValueError("lightsleep() needs a time on a stepped clock")
+        clock.run_for(deadline-started, woken=woken)
+    else:
+        while clock.now_ms() < deadline and not woken():
+            if selector is None:
+                time.sleep(WAKE_POLL_S)
+    slept_ms = clock.now_ms()-started
+    sleep_log.append((started, time_ms, slept_ms, clock.now_ms() < deadline))
+    clock.sleep_ms(WAKE_TIME_MS)
+
+
+class I2C:
+    """ I2C controller. Devices are models with read(register, length) and write(register, data),
+        registered by address in I2C.devices. Every transaction is counted in I2C.stats.
+    """
+    devices = {}
+    stats = {"transactions": 0, "bytes": 0, "failures": 0}
+    # Number of upcoming transactions that fail with ETIMEDOUT, to simulate a flaky bus
+    fail_next = 0
+    # While set, a slave holds SDA low and every transaction fails, until the controller is set up again
+    stuck = False
+
+    def __init__(self, id:int, scl=None, sda=None, freq:int=400000, timeout:int=50000):
+        I2C.stuck = False
+        self.id = id
+        self.scl = scl
+        self.sda = sda
+        self.freq = freq
+
+    def _device(self, addr:int):
+        I2C.stats["transactions"] += 1
+        if I2C.stuck or I2C.fail_next > 0:
+            I2C.fail_next = max(I2C.fail_next-1, 0)
+            I2C.stats["failures"] += 1
+            raise OSError(110, "ETIMEDOUT")
+        device = I2C.devices.get(addr)
+        if device is None:
+            I2C.stats["failures"] += 1
+            raise OSError(5, "EIO")
+        return device
+
+    def readfrom_mem(self, addr:int, memaddr:int, nbytes:int, addrsize:int=8) -> bytes:
+        data = self._device(addr).read(memaddr, nbytes)
+        I2C.stats["bytes"] += nbytes
+        return data
+
+    def readfrom_mem_into(self, addr:int, memaddr:int, buf, addrsize:int=8) -> None:
+        buf[:] = self._device(addr).read(memaddr, len(buf))
+        I2C.stats["bytes"] += len(buf)
+
+    def writeto_mem(self, addr:int, memaddr:int, buf, addrsize:int=8) -> None:
+        self._device(addr).write(memaddr, bytes(buf))
+        I2C.stats["bytes"] += len(buf)
+
+    def scan(self) -> list:
+        return sorted(I2C.devices)
+
+
+class Pin:
+    """ GPIO pin. The level of each pin number is shared between Pin objects, and tests
+        drive inputs with Pin.set_input(id, value), which triggers any registered irq.
+    """
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    _levels = {}
+    _irqs = {}
+
+    def __init__(self, id:int, mode:int=-1, pull:int=-1, value:int=None):
+        self.id = id
+        if id not in Pin._levels:
+            Pin._levels[id] = 0 if pull == Pin.PULL_DOWN else 1
+        if value is not None:
+            Pin._levels[id] = value
+
+    def value(self, value:int=None):
+        if value is None:
+            return Pin._levels[self.id]
+        Pin._levels[self.id] = 1 if value else 0
+
+    def init(self, mode:int=-1, pull:int=-1, value:int=None) -> None:
+        if value is not None:
+            Pin._levels[self.id] = value
+
+    def on(self) -> None:
+        self.value(1)
+
+    def off(self) -> None:
+        self.value(0)
+
+    def irq(self, handler=None, trigger:int=IRQ_FALLING | IRQ_RISING, hard:bool=False, wake=None):
+        Pin._irqs[self.id] = (handler, trigger, self)
+
+    @classmethod
+    def set_input(cls, id:int, value:int) -> None:
+        """Drive an input pin from outside, calling its irq handler on a matching edge, which also ends a light sleep."""
+        global _wake_pending
+        old = cls._levels.get(id, 1)
+        cls._levels[id] = value
+        (handler, trigger, pin) = cls._irqs.get(id, (None, 0, None))
+        if handler is None or old == value:
+            return
+        if (value == 0 and trigger & cls.IRQ_FALLING) or (value == 1 and trigger & cls.IRQ_RISING):
+            _wake_pending = True
+            handler(pin)
+
+
+class PWM:
+    """PWM output. Every duty cycle change is logged in PWM.log as (ms, pin, duty_ns), deinit as duty None."""
+    log = []
+
+    def __init__(self, pin:Pin, freq:int=None, duty_ns:int=None):
+        self.pin = pin
+        self._freq = freq or 0
+        self._duty_ns = 0
+        if duty_ns is not None:
+            self.duty_ns(duty_ns)
+
+    def freq(self, value:int=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_ns(self, value:int=None):
+        if value is None:
+            return self._duty_ns
+        self._duty_ns = value
+        PWM.log.append((sim.clock.now_ms(), self.pin.id, value))
+
+    def deinit(self) -> None:
+        PWM.log.append((sim.clock.now_ms(), self.pin.id, None))
+
+
+class Timer:
+    """Virtual timer on the SimClock. Callbacks run on the thread that steps the clock."""
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id:int=-1, **kwargs):
+        self._sequence = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode:int=PERIODIC, freq:float=None, period:int=None, callback=None, tick_hz:int=1000) -> None:
+        if freq is not None:
+            period = 1000/freq
+        else:
+            period = period*1000/tick_hz
+        self._mode = mode
+        self._period = period
+        self._callback = callback
+        self._deadline = sim.clock.now_ms()+period
+        sim.clock.schedule_timer(self, self._deadline)
+
+    def deinit(self) -> None:
+        self._sequence = None
+
+    def _is_current(self, sequence:int) -> bool:
+        return sequence == self._sequence
+
+    def _fire(self) -> None:
+        callback = self._callback
+        if self._mode == Timer.PERIODIC:
+            self._deadline += max(self._period, 1)
+            sim.clock.schedule_timer(self, self._deadline)
+        else:
+            self._sequence = None
+        if callback is not None:
+            callback(self)
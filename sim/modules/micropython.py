@@ -0,0 +1,14 @@
+"""Stand-in for the micropython module."""
+
+
+def const(value):
+    return value
+
+
+def schedule(function, argument) -> None:
+    """Scheduled callbacks run straight away in the simulator."""
+    function(argument)
+
+
+def mem_info(*args) -> None:
+    pass
@@ -0,0 +1,63 @@
+"""Stand-in for the network module. The WLAN connects immediately, unless told otherwise."""
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+# Status that the next connect() results in, tests can set it to simulate failures
+connect_result = STAT_GOT_IP
+reconnects = 0
+
+
+class WLAN:
+    PM_NONE = 0x10
+    PM_PERFORMANCE = 0xA11142
+    PM_POWERSAVE = 0x11
+
+    _instances = {}
+
+    def __new__(cls, interface:int=STA_IF):
+        # Like on the board, there is one object per interface
+        if interface not in cls._instances:
+            wlan = super().__new__(cls)
+            wlan._active = False
+            wlan._status = STAT_IDLE
+            cls._instances[interface] = wlan
+        return cls._instances[interface]
+
+    def active(self, is_active:bool=None):
+        if is_active is None:
+            return self._active
+        self._active = is_active
+
+    def connect(self, ssid:str=None, password:str=None) -> None:
+        global reconnects
+        reconnects += 1
+        self._status = connect_result if self._active else STAT_CONNECT_FAIL
+
+    def disconnect(self) -> None:
+        self._status = STAT_IDLE
+
+    def status(self, param:str=None):
+        return self._status
+
+    def isconnected(self) -> bool:
+        return self._status == STAT_GOT_IP
+
+    def ifconfig(self) -> tuple:
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+    def config(self, *args, **kwargs):
+        if args == ("mac",):
+            return b"\x28\xcd\xc1\x00\x00\x01"
+        if args == ("pm",):
+            return getattr(self, "_pm", WLAN.PM_PERFORMANCE)
+        if "pm" in kwargs:
+            self._pm = kwargs["pm"]
+        return None
@@ -0,0 +1,55 @@
+"""Stand-in for MicroPython's utime, driven by the SimClock."""
+
+import sim
+from sim.simclock import to_seconds
+
+TICKS_PERIOD = 1 << 30
+TICKS_HALF = TICKS_PERIOD // 2
+
+# The board's own wall clock, in seconds since 2000-01-01 at tick 0. It starts out
+# at the MicroPython default; the firmware keeps its time in the DS1307 instead.
+board_start_seconds = to_seconds((2021, 1, 1, 0, 0, 0))
+
+
+def ticks_ms() -> int:
+    return int(sim.clock.now_ms()) % TICKS_PERIOD
+
+
+def ticks_us() -> int:
+    return int(sim.clock.now_ms()*1000) % TICKS_PERIOD
+
+
+def ticks_add(ticks:int, delta:int) -> int:
+    return (ticks+delta) % TICKS_PERIOD
+
+
+def ticks_diff(ticks1:int, ticks2:int) -> int:
+    return ((ticks1-ticks2+TICKS_HALF) % TICKS_PERIOD) - TICKS_HALF
+
+
+def sleep_ms(ms:int) -> None:
+    sim.clock.sleep_ms(ms)
+
+
+def sleep_us(us:int) -> None:
+    sim.clock.sleep_ms(us/1000)
+
+
+def sleep(seconds:float) -> None:
+    sim.clock.sleep_ms(seconds*1000)
+
+
+def time() -> int:
+    """Board wall time, in seconds since 2000-01-01."""
+    return int(board_start_seconds + sim.clock.now_ms()/1000)
+
+
+def gmtime(secs:int=None) -> tuple:
+    """(year, month, mday, hour, minute, second, weekday, yearday), weekday 0 is Monday."""
+    from sim.simclock import from_seconds
+    now = from_seconds(time() if secs is None else secs)
+    return (now.year, now.month, now.day, now.hour, now.minute, now.second,
+            now.weekday(), now.timetuple().tm_yday)
+
+
+localtime = gmtime
@@ -0,0 +1,3 @@
+"""Credentials for the simulated WiFi network."""
+ssid = "simulated"
+password = "simulated"
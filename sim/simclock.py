@@ -0,0 +1,183 @@
+"""Simulated clock, timers and blocking primitives shared by all stand-in modules."""
+
+import datetime
+import heapq
+import select
+import threading
+import time
+
+EPOCH_2000 = datetime.datetime(2000, 1, 1)
+SETTLE_TIMEOUT_S = 5.0
+
+
+def to_seconds(wall:tuple) -> float:
+    """(year, month, day, hour, minute, second) to seconds since 2000-01-01."""
+    return (datetime.datetime(*wall) - EPOCH_2000).total_seconds()
+
+
+def from_seconds(seconds:float) -> datetime.datetime:
+    return EPOCH_2000 + datetime.timedelta(seconds=seconds)
+
+
+class SimClock:
+    """ A millisecond clock that either runs at speed times real time, or, with speed 0,
+        only moves when stepped. Timers and sleeps of the firmware are scheduled on it.
+        Firmware threads report when they block, so a stepped run can wait for them to
+        finish reacting to one event before moving on to the next.
+    """
+    def __init__(self, speed:float=1.0, start:tuple=(2026, 1, 1, 0, 0, 0)):
+        self.speed = speed
+        self.start_seconds = to_seconds(start)
+        self.cond = threading.Condition()
+        self._offset_ms = 0.0
+        self._real_start = time.monotonic()
+        self._timers = []
+        self._sequence = 0
+        self._waits = {}
+        if speed > 0:
+            threading.Thread(target=self._dispatch, daemon=True, name="sim-timers").start()
+
+    # Time
+
+    def now_ms(self) -> float:
+        return self._offset_ms + (time.monotonic()-self._real_start)*1000*self.speed
+
+    def wall_seconds(self) -> float:
+        """True wall time, in seconds since 2000-01-01."""
+        return self.start_seconds + self.now_ms()/1000
+
+    def wall_datetime(self) -> datetime.datetime:
+        return from_seconds(self.wall_seconds())
+
+    def advance(self, ms:float) -> None:
+        """Jump the clock forward, firing timers on the way. Does not wait for threads."""
+        self.run_for(ms, settle=False)
+
+    def run_for(self, ms:float, settle:bool=True, woken=None) -> None:
+        """ Step the clock forward by ms, one event at a time. Before every step, wait until all
+            firmware threads are blocked, so each event is handled at its exact simulated time.
+            If woken is given, stop early at the first step after which woken() is true.
+        """
+        target = self.now_ms() + ms
+        while True:
+            if settle:
+                self.settle()
+            if woken is not None and woken():
+                return
+            with self.cond:
+                now = self.now_ms()
+                step_to = min(target, self._next_event_ms())
+                if step_to > now:
+                    self._offset_ms += step_to-now
+                due = self._pop_due_timers()
+                self.cond.notify_all()
+            for timer in due:
+                timer._fire()
+            if not due and step_to >= target:
+                break
+        if settle:
+            self.settle()
+
+    # Timers
+
+    def schedule_timer(self, timer, deadline_ms:float) -> None:
+        """Queue timer to fire at deadline_ms, replacing any earlier entry for the same timer."""
+        with self.cond:
+            self._sequence += 1
+            timer._sequence = self._sequence
+            heapq.heappush(self._timers, (deadline_ms, self._sequence, timer))
+            self.cond.notify_all()
+
+    def _next_event_ms(self) -> float:
+        """Earliest pending timer or firmware sleep deadline. Call with cond held."""
+        deadlines = [deadline for (kind, deadline) in self._waits.values() if kind == "sleep"]
+        for (deadline, sequence, timer) in self._timers:
+            if timer._is_current(sequence):
+                deadlines.append(deadline)
+        return min(deadlines, default=float("inf"))
+
+    def _pop_due_timers(self) -> list:
+        """Call with cond held."""
+        now = self.now_ms()
+        due = []
+        while self._timers and self._timers[0][0] <= now:
+            (deadline, sequence, timer) = heapq.heappop(self._timers)
+            if timer._is_current(sequence):
+                due.append(timer)
+        return due
+
+    def _dispatch(self) -> None:
+        """Fire timers in real time, for clocks with a speed above 0."""
+        while True:
+            with self.cond:
+                timeout = None
+                if self._timers:
+                    timeout = max(0, (self._timers[0][0]-self.now_ms())/1000/self.speed)
+                self.cond.wait(timeout)
+                due = self._pop_due_timers()
+            for timer in due:
+                timer._fire()
+
+    # Blocking
+
+    def sleep_ms(self, ms:float) -> None:
+        if self.speed == 0 and threading.get_ident() not in self._waits:
+            # Called from the thread that steps the clock, nobody else will move time along
+            self.run_for(ms)
+            return
+        deadline = self.now_ms()+ms
+        with self.cond:
+            self._set_wait(("sleep", deadline))
+            try:
+                while self.now_ms() < deadline:
+                    timeout = None
+                    if self.speed > 0:
+                        timeout = (deadline-self.now_ms())/1000/self.speed
+                    self.cond.wait(timeout)
+            finally:
+                self._set_wait(None)
+
+    def wait_readable(self, sock) -> None:
+        """Block until data arrives on a real socket. A thread waiting here counts as blocked while none is pending."""
+        with self.cond:
+            self._set_wait(("io", sock))
+        try:
+            select.select([sock], [], [])
+        finally:
+            with self.cond:
+                self._set_wait(None)
+
+    def register_thread(self) -> None:
+        with self.cond:
+            self._waits[threading.get_ident()] = (None, None)
+
+    def unregister_thread(self) -> None:
+        with self.cond:
+            self._waits.pop(threading.get_ident(), None)
+            self.cond.notify_all()
+
+    def _set_wait(self, wait) -> None:
+        """Record what the current firmware thread is blocked on. Call with cond held."""
+        ident = threading.get_ident()
+        if ident in self._waits:
+            self._waits[ident] = wait or (None, None)
+            self.cond.notify_all()
+
+    def _is_blocked(self, wait) -> bool:
+        (kind, detail) = wait
+        if kind == "lock":
+            return detail.locked()
+        if kind == "sleep":
+            return detail > self.now_ms()
+        if kind == "io":
+            return not select.select([detail], [], [], 0)[0]
+        return False
+
+    def settle(self) -> None:
+        """Wait until every firmware thread is blocked on a lock, a sleep or a quiet socket."""
+        give_up = time.monotonic()+SETTLE_TIMEOUT_S
+        with self.cond:
+            while not all(self._is_blocked(wait) for wait in self._waits.values()):
+                if time.monotonic() > give_up:
+                    raise TimeoutError("Firmware threads did not settle.")
+                self.cond.wait(0.001)
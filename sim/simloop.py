@@ -0,0 +1,57 @@
+"""asyncio event loop that runs on the SimClock, so the firmware's asyncio tasks keep
+the same time as its threads and timers.
+
+With a running clock, loop timeouts are scaled by the clock speed. With a stepped clock
+the loop steps the clock itself: when nothing is ready it moves the clock on to its next
+timer, so an event loop that is only waiting for time to pass runs as fast as it can.
+"""
+
+import asyncio
+import selectors
+
+import sim
+
+# Real time to wait for socket activity in a stepped run before the clock is moved on,
+# as the other end of a local connection is often in the same event loop.
+IO_GRACE_S = 0.005
+
+
+class SimSelector(selectors.DefaultSelector):
+    # The selector of the newest event loop, which machine.lightsleep() watches for network traffic
+    current = None
+
+    def __init__(self):
+        super().__init__()
+        SimSelector.current = self
+
+    def io_ready(self, timeout:float) -> bool:
+        """True if any socket of the loop gets ready within timeout real seconds, without handling it."""
+        return bool(super().select(timeout))
+
+    def select(self, timeout:float=None) -> list:
+        clock = sim.clock
+        if clock.speed > 0:
+            return super().select(None if timeout is None else timeout/clock.speed)
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        # Anything registered besides the loop's own wake-up socket may be about to get data
+        if len(self.get_map()) > 1 or timeout is None:
+            ready = super().select(IO_GRACE_S)
+            if ready or timeout is None:
+                return ready
+        clock.run_for(timeout*1000)
+        return super().select(0)
+
+
+class SimEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(SimSelector())
+
+    def time(self) -> float:
+        return sim.clock.now_ms()/1000
+
+
+class SimEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    def new_event_loop(self) -> asyncio.AbstractEventLoop:
+        return SimEventLoop()
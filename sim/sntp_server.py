@@ -0,0 +1,52 @@
+"""Local stand-in for an NTP server. Answers SNTP requests with the true time of the SimClock,
+after a simulated network delay, from a thread that runs on the SimClock like firmware threads."""
+
+import socket
+import struct
+
+import sim
+from sim import thread
+
+NTP_DELTA = 3155673600 # Seconds from 1900-01-01 to 2000-01-01
+PACKET_SIZE = 48
+
+
+class SntpServer:
+    """ Serves on a free port on 127.0.0.1, see address. The request and the reply each take
+        half of delay_ms. Set drop_next to ignore that many upcoming requests.
+    """
+    def __init__(self, clock, delay_ms:float=20.0):
+        self.clock = clock
+        self.delay_ms = delay_ms
+        self.drop_next = 0
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        thread.start_new_thread(self._serve, ())
+
+    def _serve(self) -> None:
+        clock = self.clock
+        while True:
+            clock.wait_readable(self.sock)
+            (request, client) = self.sock.recvfrom(512)
+            self.requests += 1
+            if self.drop_next > 0:
+                self.drop_next -= 1
+                continue
+            if len(request) < PACKET_SIZE or request[0] & 7 != 3:
+                continue
+            clock.sleep_ms(self.delay_ms/2)
+            (seconds, fraction) = self._timestamp()
+            reply = bytearray(PACKET_SIZE)
+            reply[0] = 0x24 # No leap second warning, version 4, server mode
+            reply[1] = 1    # Stratum 1
+            reply[24:32] = request[40:48]
+            struct.pack_into(">LLLL", reply, 32, seconds, fraction, seconds, fraction)
+            clock.sleep_ms(self.delay_ms/2)
+            self.sock.sendto(reply, client)
+
+    def _timestamp(self) -> tuple:
+        now = self.clock.wall_seconds() + NTP_DELTA
+        seconds = int(now)
+        return (seconds, int((now-seconds)*(1 << 32)))
@@ -0,0 +1,79 @@
+"""Stand-in for MicroPython's _thread. Locks and threads report to the SimClock
+when they block, so stepped simulations can tell when the firmware is idle."""
+
+import _thread as _host_thread
+import threading
+
+import sim
+
+error = RuntimeError
+
+
+class LockType:
+    def __init__(self):
+        self._locked = False
+
+    def acquire(self, waitflag:int=1, timeout:float=-1) -> bool:
+        clock = sim.clock
+        with clock.cond:
+            if not self._locked:
+                self._locked = True
+                return True
+            if not waitflag:
+                return False
+            clock._set_wait(("lock", self))
+            try:
+                while self._locked:
+                    if not clock.cond.wait(timeout if timeout >= 0 else None) and timeout >= 0:
+                        return False
+            finally:
+                clock._set_wait(None)
+            self._locked = True
+            return True
+
+    def release(self) -> None:
+        clock = sim.clock
+        with clock.cond:
+            if not self._locked:
+                raise RuntimeError("release unlocked lock")
+            self._locked = False
+            clock.cond.notify_all()
+
+    def locked(self) -> bool:
+        return self._locked
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def allocate_lock() -> LockType:
+    return LockType()
+
+
+def start_new_thread(function, args:tuple, kwargs:dict=None) -> int:
+    started = threading.Event()
+
+    def run():
+        sim.clock.register_thread()
+        started.set()
+        try:
+            function(*args, **(kwargs or {}))
+        finally:
+            sim.clock.unregister_thread()
+    thread = threading.Thread(target=run, daemon=True, name="firmware")
+    thread.start()
+    # Only return once the clock knows about the thread, so it is included in settle()
+    started.wait()
+    return thread.ident
+
+
+def get_ident() -> int:
+    return _host_thread.get_ident()
+
+
+def stack_size(size:int=0) -> int:
+    return 0
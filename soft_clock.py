@@ -0,0 +1,102 @@
+"""Software clock that reads the DS1307 once in a while and extrapolates
+the wall time from the tick counter in between, so asking for the time
+does not cost any I2C traffic. The drift of the DS1307, once known, is
+corrected for from the last time the RTC was set."""
+
+from micropython import const
+from tools import days_since_2000, civil_from_days
+import time
+
+REANCHOR_INTERVAL_MS = const(60000) # How often to re-read the RTC by default.
+
+class SoftClock:
+    def __init__(self, rtc, reanchor_interval_ms:int=REANCHOR_INTERVAL_MS):
+        self.rtc = rtc
+        self.weekdays = rtc.weekdays
+        self.reanchor_interval_ms = reanchor_interval_ms
+        # How fast the RTC runs, in ppm, and the RTC time when it was last set
+        self.drift_ppm = 0.0
+        self._set_at = None
+        # (ticks_ms when the RTC was read, seconds since 2000-01-01 at that time)
+        self._anchor = None
+        self.anchor()
+        
+    def set_drift(self, ppm:float) -> None:
+        """Correct the RTC time for this drift, from the next time the RTC is read."""
+        self.drift_ppm = ppm
+        
+    def correction(self, rtc_seconds:int) -> int:
+        """Seconds the RTC has gained by rtc_seconds since it was last set."""
+        if self._set_at is None:
+            return 0
+        return round((rtc_seconds-self._set_at)*self.drift_ppm/1000000)
+        
+    def anchor(self) -> None:
+        """ Read the RTC and use it as the new reference point.
+            If the RTC can't be read the clock keeps extrapolating from the old anchor,
+            and tries again after another reanchor interval.
+        """
+        anchor = self._anchor
+        try:
+            seconds = self.rtc.epoch_seconds()
+        except OSError as e:
+            if anchor is None:
+                raise
+            print(f"Could not read the RTC, keeping the software time: {e}")
+            elapsed = time.ticks_diff(time.ticks_ms(), anchor[0])//1000
+            self._anchor = (time.ticks_add(anchor[0], elapsed*1000), anchor[1]+elapsed)
+            return
+        seconds -= self.correction(seconds)
+        now = time.ticks_ms()
+        if anchor is not None and seconds == anchor[1] + time.ticks_diff(now, anchor[0])//1000:
+            # Still in agreement with the RTC. Keep the old anchor, it has better sub-second phase.
+            self._anchor = (time.ticks_add(anchor[0], time.ticks_diff(now, anchor[0])//1000*1000), seconds)
+        else:
+            self._anchor = (now, seconds)
+        
+    def epoch_seconds(self) -> int:
+        """Seconds since 2000-01-01 00:00:00."""
+        anchor = self._anchor
+        elapsed = time.ticks_diff(time.ticks_ms(), anchor[0])
+        if elapsed >= self.reanchor_interval_ms or elapsed < 0:
+            self.anchor()
+            anchor = self._anchor
+            elapsed = time.ticks_diff(time.ticks_ms(), anchor[0])
+        return anchor[1] + elapsed//1000
+    
+    def minute_of_day(self) -> int:
+        """Minutes since midnight."""
+        return self.epoch_seconds()//60 % 1440
+    
+    def datetime(self, datetime=None):
+        """ Get or set datetime, using the same tuple layout as DS1307.datetime().
+            Setting the time writes it to the RTC and re-anchors the clock.
+        """
+        if datetime is not None:
+            self.rtc.datetime(datetime)
+            (year,month,mday,weekday,hour,minute,second) = datetime
+            self._set_at = days_since_2000(year, month, mday)*86400 + hour*3600 + minute*60 + second
+            self._anchor = None
+            self.anchor()
+            return
+        seconds = self.epoch_seconds()
+        days = seconds//86400
+        seconds -= days*86400
+        (year, month, mday) = civil_from_days(days)
+        # 2000-01-01 was a Saturday
+        weekday = (days+5) % 7
+        return (year, month, mday, weekday, seconds//3600, seconds//60 % 60, seconds % 60)
+    
+    def get_formatted_time(self) -> str:
+        """Get the time in ISO8601 format"""
+        (year,month,mday,weekday,hour,minute,second) = self.datetime()
+        return f"{year:04d}-{month:02d}-{mday:02d} {hour:02d}:{minute:02d}:{second:02d}"
+    
+    def get_weekday(self) -> str:
+        """Get an English string representation of the current weekday."""
+        return self.weekdays[self.datetime()[3]]
+    
+    def get_weekday_and_time(self) -> str:
+        """Get the weekday and the time in ISO8601 format, e.g. "Monday 2026-03-02 07:00:00"."""
+        (year,month,mday,weekday,hour,minute,second) = self.datetime()
+        return f"{self.weekdays[weekday]} {year:04d}-{month:02d}-{mday:02d} {hour:02d}:{minute:02d}:{second:02d}"
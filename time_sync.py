@@ -0,0 +1,273 @@
+"""Module that keeps the RTC in step with an NTP server without blocking the event loop.
+
+The time is asked for with SNTP over a non-blocking UDP socket, which is polled from the
+event loop, and the server's time is corrected by half the measured round-trip delay.
+Every sync also measures how far the RTC has drifted since it was last set, to the
+millisecond, by waiting for its seconds to tick over. This gives an estimate of how fast
+the DS1307 runs, in ppm, which the SoftClock corrects for between syncs. Once the drift
+is known, syncs are stretched from hourly to daily.
+Apart from the first one, no sync is done near a feeding time, as moving the clock could
+then repeat or skip a feeding.
+Looking up the server's address blocks the event loop, and with it the timers that stop the
+servo, so it is only done when needed and allowed: once the network is up, then daily or after
+a few failed syncs, never while the caller says it must not block, and with a growing wait
+after failed lookups.
+"""
+
+from micropython import const
+from feeding_scheduler import FeedingScheduler
+from soft_clock import SoftClock
+from tools import civil_from_days
+import asyncio
+import metrics
+import struct
+import time
+
+NTP_HOST = "pool.ntp.org"
+NTP_PORT = const(123)
+NTP_DELTA = 3155673600 # Seconds from 1900-01-01, the NTP epoch, to 2000-01-01
+PACKET_SIZE = const(48)
+
+ATTEMPTS            = const(4)    # Requests sent per sync before giving up.
+REPLY_TIMEOUT_MS    = const(1000) # How long to wait for each reply.
+POLL_INTERVAL_MS    = const(10)   # How often the socket, or the RTC while waiting for it to tick, is checked.
+RTC_TICK_TIMEOUT_MS = const(1500) # Give up waiting for the RTC's seconds to change after this long.
+RTC_TICK_MARGIN_MS  = const(100)  # Start polling the RTC this long before its seconds are expected to change.
+
+SHORT_INTERVAL_S    = const(3600)  # Time between syncs until the drift is known...
+LONG_INTERVAL_S     = const(86400) # ...and after.
+RETRY_INTERVAL_S    = const(60)    # Time to wait after a failed sync, or when a feeding is close.
+NETWORK_WAIT_S      = const(1)     # How often to check for the network before the first sync.
+
+ADDRESS_TTL_S       = const(86400) # Look the server up again after this long...
+ADDRESS_FAILURES    = const(3)     # ...or after this many failed syncs in a row.
+LOOKUP_RETRY_S      = const(60)    # Wait after a failed lookup, doubled after every one that follows...
+MAX_LOOKUP_RETRY_S  = const(3600)  # ...up to this.
+
+MIN_DRIFT_SPAN_MS   = const(1800000)  # Only estimate the drift over at least this long...
+MAX_DRIFT_WEIGHT_MS = const(604800000) # ...and let estimates older than this fade out.
+MAX_DRIFT_PPM       = const(500)      # Anything more is not drift, the clock was set some other way.
+
+class TimeSync:
+    def __init__(self, clock:SoftClock, scheduler:FeedingScheduler, host:str=NTP_HOST, port:int=NTP_PORT):
+        self.clock = clock
+        self.scheduler = scheduler
+        self.host = host
+        self.port = port
+        self._address = None
+        self._resolved_at = None
+        self._failures = 0 # Failed syncs in a row
+        self._lookup_retry_s = LOOKUP_RETRY_S
+        self._next_lookup = None # ticks_ms before which no lookup is tried, after one failed
+        self._request = bytearray(PACKET_SIZE)
+        self._requests = 0
+        self._listeners = []
+        # Time of the last successful sync, in seconds since 2000, None before the first one
+        self.last_sync = None
+        self.syncs = 0
+        # ticks_ms when run() next does something, None while it is busy
+        self._due = None
+        # When the RTC was last set and how far ahead of the true time it was right after, in ms
+        self._set_at_ms = None
+        self._residual_ms = 0
+        # The drift estimate is an average weighted by the time spans it was measured over
+        self.drift_ppm = 0.0
+        self._drift_weight_ms = 0
+
+    def add_listener(self, listener) -> None:
+        """listener() is called after every successful sync."""
+        self._listeners.append(listener)
+
+    @property
+    def interval_s(self) -> int:
+        return LONG_INTERVAL_S if self._drift_weight_ms else SHORT_INTERVAL_S
+
+    async def run(self, network_up, may_block=None) -> None:
+        """ Sync whenever one is due, forever. network_up() tells if the network can be used,
+            and may_block(), if given, if the event loop may be blocked by an address lookup now.
+        """
+        while True:
+            if not network_up():
+                delay_s = NETWORK_WAIT_S
+            elif not self._has_address(may_block):
+                delay_s = RETRY_INTERVAL_S
+            elif self.last_sync is not None and self.scheduler.in_guard(self.clock.minute_of_day()):
+                delay_s = RETRY_INTERVAL_S
+            elif await self.sync():
+                delay_s = self.interval_s
+            else:
+                delay_s = RETRY_INTERVAL_S
+            self._due = time.ticks_add(time.ticks_ms(), delay_s*1000)
+            await asyncio.sleep(delay_s)
+            self._due = None
+
+    def ms_until_due(self) -> int:
+        """ms until run() next checks for or carries out a sync, 0 while it is busy."""
+        if self._due is None:
+            return 0
+        return max(time.ticks_diff(self._due, time.ticks_ms()), 0)
+
+    def _has_address(self, may_block=None) -> bool:
+        """Look the server up if that is due and allowed. Returns True if there is an address to sync with."""
+        now = time.ticks_ms()
+        due = (self._address is None or self._failures >= ADDRESS_FAILURES
+               or time.ticks_diff(now, self._resolved_at) >= ADDRESS_TTL_S*1000)
+        waiting = self._next_lookup is not None and time.ticks_diff(now, self._next_lookup) < 0
+        if due and not waiting and (may_block is None or may_block()):
+            self.resolve()
+        return self._address is not None
+
+    def resolve(self) -> bool:
+        """Look up the server's address. This blocks. Returns True on success, a failure keeps the old address."""
+        import socket
+        try:
+            self._address = socket.getaddrinfo(self.host, self.port)[0][-1]
+        except OSError as e:
+            print(f"Could not look up {self.host}: {e}")
+            self._next_lookup = time.ticks_add(time.ticks_ms(), self._lookup_retry_s*1000)
+            self._lookup_retry_s = min(self._lookup_retry_s*2, MAX_LOOKUP_RETRY_S)
+            return False
+        self._resolved_at = time.ticks_ms()
+        self._failures = 0
+        self._next_lookup = None
+        self._lookup_retry_s = LOOKUP_RETRY_S
+        return True
+
+    async def sync(self) -> bool:
+        """Set the RTC to the NTP time and update the drift estimate. Returns True on success."""
+        if self._address is None:
+            return False
+        if await self._sync():
+            self._failures = 0
+            return True
+        self._failures += 1
+        return False
+
+    async def _sync(self) -> bool:
+        try:
+            reply = None
+            for attempt in range(ATTEMPTS):
+                reply = await self._query()
+                if reply is not None:
+                    break
+            if reply is None:
+                print("No reply from the NTP server.")
+                return False
+            (server_ms, server_tick, delay_ms) = reply
+            metrics.record(metrics.NTP_DELAY, delay_ms*1000)
+            if self._set_at_ms is not None:
+                # There is something to measure the drift against
+                edge = await self._wait_for_rtc_tick(server_ms, server_tick)
+                if edge is None:
+                    print("The RTC is not ticking.")
+                else:
+                    (rtc_seconds, edge_tick) = edge
+                    true_ms = server_ms + time.ticks_diff(edge_tick, server_tick)
+                    self._update_drift(true_ms, rtc_seconds*1000-true_ms)
+            await self._set_rtc(server_ms, server_tick)
+        except OSError as e:
+            print(f"Time sync failed: {e}")
+            return False
+        metrics.count(metrics.TIME_SYNCS)
+        self.syncs += 1
+        self.last_sync = self.clock.epoch_seconds()
+        print(f"Time synced to {self.clock.get_formatted_time()}, delay {delay_ms} ms, drift {self.drift_ppm:.2f} ppm.")
+        for listener in self._listeners:
+            listener()
+        return True
+
+    async def _query(self) -> tuple:
+        """ Send one SNTP request. Returns (server time in ms since 2000, ticks_ms when it was that time,
+            round-trip delay in ms), or None if no valid reply came in time.
+        """
+        import socket
+        request = self._request
+        for i in range(PACKET_SIZE):
+            request[i] = 0
+        request[0] = 0x1B # No leap second warning, version 3, client mode
+        sent = time.ticks_ms()
+        # The server echoes the transmit timestamp, any value that tells replies apart will do
+        self._requests += 1
+        struct.pack_into(">LL", request, 40, sent, self._requests)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.sendto(request, self._address)
+            while time.ticks_diff(time.ticks_ms(), sent) < REPLY_TIMEOUT_MS:
+                await asyncio.sleep(POLL_INTERVAL_MS/1000)
+                try:
+                    reply = sock.recv(PACKET_SIZE)
+                except OSError:
+                    # Nothing yet
+                    continue
+                received = time.ticks_ms()
+                if len(reply) < PACKET_SIZE or reply[0] & 7 != 4 or reply[1] == 0 or reply[24:32] != request[40:48]:
+                    # Not a reply to this request, or the server does not know the time
+                    continue
+                (receive_s, receive_f, transmit_s, transmit_f) = struct.unpack_from(">LLLL", reply, 32)
+                transmit_ms = ntp_to_ms(transmit_s, transmit_f)
+                delay_ms = time.ticks_diff(received, sent) - (transmit_ms-ntp_to_ms(receive_s, receive_f))
+                return (transmit_ms + delay_ms//2, received, delay_ms)
+        finally:
+            sock.close()
+        return None
+
+    async def _wait_for_rtc_tick(self, server_ms:int, server_tick:int) -> tuple:
+        """ Wait for the RTC's seconds to change. Returns (RTC time in seconds since 2000, ticks_ms when
+            it changed, to within half the poll interval), or None if it did not change in time.
+            The RTC is only polled from shortly before the change is expected, to save I2C traffic.
+        """
+        now_ms = server_ms + time.ticks_diff(time.ticks_ms(), server_tick)
+        rtc_ms = now_ms + self._residual_ms + int((now_ms-self._set_at_ms)*self.drift_ppm/1000000)
+        wait_ms = 1000 - rtc_ms % 1000
+        if wait_ms < RTC_TICK_MARGIN_MS:
+            wait_ms += 1000
+        await asyncio.sleep((wait_ms-RTC_TICK_MARGIN_MS)/1000)
+        rtc = self.clock.rtc
+        first = rtc.epoch_seconds()
+        polled = time.ticks_ms()
+        started = polled
+        while time.ticks_diff(polled, started) < RTC_TICK_TIMEOUT_MS:
+            await asyncio.sleep(POLL_INTERVAL_MS/1000)
+            seconds = rtc.epoch_seconds()
+            now = time.ticks_ms()
+            if seconds != first:
+                return (seconds, time.ticks_add(polled, time.ticks_diff(now, polled)//2))
+            polled = now
+        return None
+
+    def _update_drift(self, true_ms:int, offset_ms:int) -> None:
+        """Fold the offset of the RTC from the true time into the drift estimate."""
+        if self._set_at_ms is None:
+            return
+        elapsed_ms = true_ms-self._set_at_ms
+        if elapsed_ms < MIN_DRIFT_SPAN_MS:
+            return
+        ppm = (offset_ms-self._residual_ms)*1000000/elapsed_ms
+        if abs(ppm) > MAX_DRIFT_PPM:
+            print(f"RTC was {offset_ms} ms off, not counting it as drift.")
+            return
+        weight = min(self._drift_weight_ms, MAX_DRIFT_WEIGHT_MS)
+        self.drift_ppm = (self.drift_ppm*weight + ppm*elapsed_ms)/(weight+elapsed_ms)
+        self._drift_weight_ms = weight+elapsed_ms
+        self.clock.set_drift(self.drift_ppm)
+
+    async def _set_rtc(self, server_ms:int, server_tick:int) -> None:
+        """Set the RTC on a second boundary, as writing the seconds restarts the DS1307's countdown."""
+        now_ms = server_ms + time.ticks_diff(time.ticks_ms(), server_tick)
+        await asyncio.sleep((1000 - now_ms % 1000)/1000)
+        now_ms = server_ms + time.ticks_diff(time.ticks_ms(), server_tick)
+        seconds = (now_ms+500)//1000
+        days = seconds//86400
+        (year, month, mday) = civil_from_days(days)
+        second_of_day = seconds - days*86400
+        # 2000-01-01 was a Saturday
+        self.clock.datetime((year, month, mday, (days+5) % 7,
+                             second_of_day//3600, second_of_day//60 % 60, second_of_day % 60))
+        self._set_at_ms = now_ms
+        self._residual_ms = seconds*1000 - now_ms
+
+
+def ntp_to_ms(seconds:int, fraction:int) -> int:
+    """NTP timestamp to ms since 2000-01-01."""
+    return (seconds-NTP_DELTA)*1000 + (fraction*1000 >> 32)